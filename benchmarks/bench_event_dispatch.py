@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+生成事件分发基准测试
+
+模拟一个生成任务向同一进程中的 N 个订阅者（标签页）推送 stream_update 事件，对比
+- channel layer：每个事件 group_send 到会话组，订阅者从各自的 channel 中接收后处理（旧实现）；
+- 本地直投：chat.event_dispatch.ConversationEventDispatcher 直接调用订阅者的 broadcast_event。
+使用进程内的 InMemoryChannelLayer，不需要 Redis 和数据库；使用 Redis channel layer 时
+旧实现每个事件还要额外经过 Redis 往返和序列化，差距会更大。
+
+用法:
+    python benchmarks/bench_event_dispatch.py
+    python benchmarks/bench_event_dispatch.py --events 5000 --subscribers 1 2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('DJANGO_LOG_LEVEL', 'WARNING')
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.layers import InMemoryChannelLayer  # noqa: E402
+
+import chat.event_dispatch as event_dispatch  # noqa: E402
+
+GROUP = 'chat_1'
+
+
+class FakeConsumer:
+    """只记录收到的事件数量，代替向 WebSocket 发送。"""
+
+    def __init__(self, channel_name):
+        self.channel_name = channel_name
+        self.received = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def broadcast_event(self, message):
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+
+async def run_channel_layer(events, subscribers):
+    layer = InMemoryChannelLayer()
+    consumers = []
+    receivers = []
+    for _ in range(subscribers):
+        consumer = FakeConsumer(await layer.new_channel())
+        consumer.expected = events
+        await layer.group_add(GROUP, consumer.channel_name)
+        consumers.append(consumer)
+
+        async def _receive(consumer=consumer):
+            while consumer.received < consumer.expected:
+                await consumer.broadcast_event(await layer.receive(consumer.channel_name))
+        receivers.append(asyncio.create_task(_receive()))
+
+    start = time.perf_counter()
+    for seq in range(events):
+        message = {'type': 'broadcast_event', 'event': {'type': 'stream_update', 'data': {'content': 'x', 'seq': seq}}}
+        await layer.group_send(GROUP, message)
+        if seq % 50 == 0:
+            await asyncio.sleep(0)  # 让订阅者处理，避免超出 channel 容量
+    await asyncio.gather(*receivers)
+    return time.perf_counter() - start
+
+
+async def run_local(events, subscribers):
+    layer = InMemoryChannelLayer()
+    event_dispatch.get_channel_layer = lambda: layer
+    dispatcher = event_dispatch.ConversationEventDispatcher(None)
+    consumers = []
+    for index in range(subscribers):
+        consumer = FakeConsumer(f"local.{index}")
+        consumer.expected = events
+        await dispatcher.subscribe(GROUP, consumer)
+        consumers.append(consumer)
+
+    start = time.perf_counter()
+    for seq in range(events):
+        await dispatcher.dispatch(1, 'stream_update', {'content': 'x', 'seq': seq})
+    await asyncio.gather(*(consumer.done.wait() for consumer in consumers))
+    return time.perf_counter() - start
+
+
+async def main_async(args):
+    print(f"每轮 {args.events} 个事件")
+    print(f"{'订阅者':>6} | {'channel layer':>13} | {'本地直投':>8} | {'加速':>6}")
+    for subscribers in args.subscribers:
+        layer_time = await run_channel_layer(args.events, subscribers)
+        local_time = await run_local(args.events, subscribers)
+        print(
+            f"{subscribers:>6} | {layer_time / args.events * 1e6:>10.1f}µs/事件"
+            f" | {local_time / args.events * 1e6:>5.1f}µs/事件 | {layer_time / local_time:>5.1f}x"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20000, help='推送的事件数量')
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[1, 2, 4], help='同一会话的本地订阅者数量')
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
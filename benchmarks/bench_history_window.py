@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+历史消息查询基准测试
+
+对比旧实现（取出会话的全部消息后在 Python 中截取最后 N 条）与
+chat.context_builder.fetch_history_window（数据库端倒序取前 N 条）
+在不同会话长度下的耗时和内存峰值。使用临时的 SQLite 数据库，不会影响现有数据。
+
+用法:
+    python benchmarks/bench_history_window.py
+    python benchmarks/bench_history_window.py --sizes 1000 10000 50000 --window 20 --content-size 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_db_dir = tempfile.mkdtemp(prefix='bench_history_')
+os.environ['DATABASE_PATH'] = os.path.join(_db_dir, 'bench.sqlite3')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('DJANGO_LOG_LEVEL', 'WARNING')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+
+from chat.context_builder import fetch_history_window  # noqa: E402
+from chat.models import Conversation, Message  # noqa: E402
+from chat.tokens import estimate_tokens  # noqa: E402
+
+
+def run_legacy(conversation_id, window, user_message_id=None, is_regenerate=False):
+    """旧实现：与重构前 services.py 中的逻辑一致。"""
+    if is_regenerate:
+        user_message = Message.objects.get(id=user_message_id)
+        history_qs = Message.objects.filter(
+            conversation_id=conversation_id,
+            timestamp__lte=user_message.timestamp
+        ).order_by('timestamp')
+    else:
+        history_qs = Message.objects.filter(conversation_id=conversation_id).order_by('timestamp')
+    history_messages = list(history_qs)
+    if len(history_messages) > window:
+        history_messages = history_messages[-window:]
+    return history_messages
+
+
+def run_windowed(conversation_id, window, user_message_id=None, is_regenerate=False):
+    return fetch_history_window(conversation_id, window, user_message_id, is_regenerate)
+
+
+def populate(user, size, content_size):
+    """创建一个包含 size 条消息的会话，返回 (会话, 中间位置的一条用户消息)。"""
+    conversation = Conversation.objects.create(user=user, title=f'bench-{size}')
+    content = ('历史消息 history message ' * (content_size // 24 + 1))[:content_size]
+    batch = []
+    for i in range(size):
+        text = f"{i}: {content}"
+        batch.append(Message(conversation=conversation, content=text, is_user=(i % 2 == 0), token_count=estimate_tokens(text)))
+        if len(batch) >= 2000:
+            Message.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Message.objects.bulk_create(batch)
+    anchor = Message.objects.filter(conversation=conversation, is_user=True).order_by('timestamp')[size // 4]
+    return conversation, anchor
+
+
+def measure(func, repeat, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(*args)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10_000, 20_000], help='会话中的消息数量')
+    parser.add_argument('--window', type=int, default=20, help='max_history_messages')
+    parser.add_argument('--content-size', type=int, default=2000, help='每条消息的字符数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数（取最快一次）')
+    args = parser.parse_args()
+
+    call_command('migrate', verbosity=0)
+    user = User.objects.create(username='bench')
+
+    print(f"窗口大小: {args.window} 条, 每条消息 {args.content_size} 个字符")
+    print(f"{'消息数':>8} | {'场景':<6} | {'旧实现耗时':>10} | {'旧实现内存':>10} | {'窗口查询耗时':>12} | {'窗口查询内存':>12}")
+    for size in args.sizes:
+        conversation, anchor = populate(user, size, args.content_size)
+        scenarios = [
+            ('新消息', (conversation.id, args.window)),
+            ('重新生成', (conversation.id, args.window, anchor.id, True)),
+        ]
+        for title, call_args in scenarios:
+            legacy_time, legacy_peak, legacy_result = measure(run_legacy, args.repeat, *call_args)
+            window_time, window_peak, window_result = measure(run_windowed, args.repeat, *call_args)
+            if [m.id for m in legacy_result] != [m.id for m in window_result]:
+                print("警告: 两种实现返回的消息不一致！")
+            print(
+                f"{size:>8} | {title:<6} | {legacy_time * 1000:>8.1f}ms | {legacy_peak / 1024 / 1024:>8.2f}MB"
+                f" | {window_time * 1000:>10.2f}ms | {window_peak / 1024 / 1024:>10.2f}MB"
+            )
+
+    with connection.cursor() as cursor:
+        sql, params = (
+            Message.objects.filter(conversation_id=conversation.id).order_by('-timestamp')[:args.window].query.sql_with_params()
+        )
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        print("\n窗口查询的执行计划:")
+        for row in cursor.fetchall():
+            print(f"  {row[-1]}")
+
+
+if __name__ == '__main__':
+    main()
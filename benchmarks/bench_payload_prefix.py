@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+请求体序列化基准测试
+
+模拟同一会话连续多轮请求：每轮在历史末尾追加一问一答，然后构建发给上游的请求体。对比
+- 完整序列化：每轮把整个 messages 数组重新 json.dumps（旧实现）；
+- 增量拼接：历史消息的 JSON 字节缓存在上下文缓存的条目上（chat.context_builder._text_message），
+  每轮只序列化新追加的消息，其余直接拼接（chat.request_body.StreamingJSONBody）。
+两种实现生成的请求体解析后完全相同。不需要数据库。
+
+用法:
+    python benchmarks/bench_payload_prefix.py
+    python benchmarks/bench_payload_prefix.py --history 20 100 400 --content-size 800 --turns 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('DJANGO_LOG_LEVEL', 'WARNING')
+
+import django  # noqa: E402
+
+django.setup()
+
+from chat.context_builder import _text_message  # noqa: E402
+from chat.request_body import StreamingJSONBody  # noqa: E402
+
+REQUEST_PARAMS = {"model": "bench", "stream": True, "temperature": 0.7}
+
+
+def make_entry(index, content_size):
+    content = (f"第 {index} 条消息：这是一段包含中文和 English 的历史内容。\n" * (content_size // 30 + 1))[:content_size]
+    return SimpleNamespace(id=index, role="user" if index % 2 == 0 else "assistant", content=content, file_path=None, encoded=None)
+
+
+def run_full(history):
+    messages = [{"role": entry.role, "content": entry.content} for entry in history]
+    return json.dumps({"messages": messages, **REQUEST_PARAMS}, ensure_ascii=False).encode('utf-8')
+
+
+def run_incremental(history):
+    messages = [_text_message(entry) for entry in history]
+    return b''.join(StreamingJSONBody({"messages": messages, **REQUEST_PARAMS}))
+
+
+def simulate(func, history_size, content_size, turns):
+    """返回每轮平均耗时和最后一轮的请求体。"""
+    entries = [make_entry(i, content_size) for i in range(history_size)]
+    func(entries)  # 预热：第一轮之前的历史已在之前的请求中序列化过
+    elapsed = 0.0
+    body = None
+    for turn in range(turns):
+        entries.extend([make_entry(history_size + 2 * turn, content_size), make_entry(history_size + 2 * turn + 1, content_size)])
+        window = entries[-history_size:]
+        start = time.perf_counter()
+        body = func(window)
+        elapsed += time.perf_counter() - start
+    return elapsed / turns, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, nargs='+', default=[20, 100, 400], help='每轮请求包含的历史消息数量')
+    parser.add_argument('--content-size', type=int, default=800, help='每条消息的字符数')
+    parser.add_argument('--turns', type=int, default=50, help='模拟的轮数')
+    args = parser.parse_args()
+
+    print(f"每条消息 {args.content_size} 个字符, {args.turns} 轮")
+    print(f"{'历史消息数':>10} | {'请求体':>8} | {'完整序列化':>10} | {'增量拼接':>10} | {'加速':>6}")
+    for history_size in args.history:
+        full_time, full_body = simulate(run_full, history_size, args.content_size, args.turns)
+        incremental_time, incremental_body = simulate(run_incremental, history_size, args.content_size, args.turns)
+        if json.loads(full_body) != json.loads(incremental_body):
+            print("警告: 两种实现生成的请求体不一致！")
+        print(
+            f"{history_size:>10} | {len(full_body) / 1024:>6.0f}KB | {full_time * 1000:>8.2f}ms"
+            f" | {incremental_time * 1000:>8.2f}ms | {full_time / incremental_time:>5.1f}x"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+多模态请求体内存基准测试
+
+对比旧实现（每张图片 base64 编码为字符串，嵌入 request_data 后整体 json.dumps 并编码为字节）与
+chat.request_body.StreamingJSONBody（发送时从存储中分块读取并编码）在不同图片数量和大小下的内存峰值。
+两种实现都只生成请求体字节，不发送网络请求；图片写入临时的 MEDIA_ROOT，不会影响现有数据。
+
+用法:
+    python benchmarks/bench_request_body.py
+    python benchmarks/bench_request_body.py --counts 1 4 --sizes-mb 1 5 10
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('DJANGO_LOG_LEVEL', 'WARNING')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.files.base import ContentFile  # noqa: E402
+from django.core.files.storage import default_storage  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from chat.request_body import StoredDataURL, StreamingJSONBody  # noqa: E402
+
+
+def build_messages(paths, url_for):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for index, path in enumerate(paths):
+        messages.append({"role": "user", "content": [
+            {"type": "text", "text": f"第 {index + 1} 张图片"},
+            {"type": "image_url", "image_url": {"url": url_for(path)}},
+        ]})
+    return {"model": "bench", "messages": messages, "stream": True}
+
+
+def legacy_data_url(path):
+    """旧实现：与重构前 context_builder 中的逻辑一致。"""
+    with default_storage.open(path, 'rb') as f:
+        return f"data:image/jpeg;base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+
+def run_legacy(paths):
+    request_data = build_messages(paths, legacy_data_url)
+    body = json.dumps(request_data).encode('utf-8')
+    return len(body)
+
+
+def run_streaming(paths):
+    body = StreamingJSONBody(build_messages(paths, StoredDataURL))
+    sent = 0
+    for chunk in body:
+        sent += len(chunk)
+    return sent
+
+
+def measure(func, paths):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = func(paths)
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 4], help='每个请求中的图片数量')
+    parser.add_argument('--sizes-mb', type=float, nargs='+', default=[1, 5, 20], help='每张图片的大小（MB）')
+    args = parser.parse_args()
+
+    with override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='bench_request_body_')):
+        run(args)
+
+
+def run(args):
+    print(f"{'图片数':>6} | {'单张大小':>8} | {'请求体':>9} | {'旧实现耗时':>10} | {'旧实现内存':>10} | {'流式耗时':>8} | {'流式内存':>8}")
+    for size_mb in args.sizes_mb:
+        data = os.urandom(int(size_mb * 1024 * 1024))
+        for count in args.counts:
+            paths = [default_storage.save(f"uploads/bench_{size_mb}_{i}.jpg", ContentFile(data)) for i in range(count)]
+            legacy_time, legacy_peak, _legacy_size = measure(run_legacy, paths)
+            stream_time, stream_peak, stream_size = measure(run_streaming, paths)
+            print(
+                f"{count:>6} | {size_mb:>6.1f}MB | {stream_size / 1024 / 1024:>7.1f}MB"
+                f" | {legacy_time * 1000:>8.1f}ms | {legacy_peak / 1024 / 1024:>8.1f}MB"
+                f" | {stream_time * 1000:>6.1f}ms | {stream_peak / 1024 / 1024:>6.2f}MB"
+            )
+            for path in paths:
+                default_storage.delete(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+SSE 流解析微基准测试
+
+对比旧实现（bytes 拼接 + split + 字符串累加）与 chat.streaming.SSEDecoder/ContentAccumulator
+在长回复（默认 10 万个 token）上的耗时。
+
+用法:
+    python benchmarks/bench_sse_decoder.py
+    python benchmarks/bench_sse_decoder.py --tokens 200000 --read-size 4096
+    python benchmarks/bench_sse_decoder.py --file recorded_stream.txt   # 使用录制的原始 SSE 响应体
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat.streaming import SSEDecoder, ContentAccumulator  # noqa: E402
+
+
+def build_synthetic_stream(token_count):
+    """生成一个 OpenAI 兼容格式的 SSE 响应体，每个事件携带一个 token（中英文混合）。"""
+    words = ['Hello', ' world', '，', '你好', '世界', ' streaming', '。', ' token', '测试', '\n']
+    events = []
+    for i in range(token_count):
+        chunk = {
+            'id': 'chatcmpl-bench',
+            'object': 'chat.completion.chunk',
+            'choices': [{'index': 0, 'delta': {'content': words[i % len(words)]}, 'finish_reason': None}],
+        }
+        events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return ''.join(events).encode('utf-8')
+
+
+def build_large_event_stream(event_count, event_size):
+    """生成少量但非常大的事件（例如很长的工具调用参数），用于暴露旧实现在单个事件内反复 split 的二次开销。"""
+    events = []
+    for _ in range(event_count):
+        chunk = {'choices': [{'index': 0, 'delta': {'content': '大' * event_size}}]}
+        events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+    return ''.join(events).encode('utf-8')
+
+
+def split_reads(body, read_size):
+    return [body[i:i + read_size] for i in range(0, len(body), read_size)]
+
+
+def extract(chunk_json):
+    choices = chunk_json.get('choices')
+    if choices:
+        return choices[0].get('delta', {}).get('content')
+    return None
+
+
+def run_legacy(reads, parse_json=True):
+    """旧实现：与重构前 services.py 中的逻辑一致。"""
+    buffer = b''
+    full_content = ''
+    for chunk in reads:
+        buffer += chunk
+        messages = buffer.split(b'\n\n')
+        buffer = messages.pop()
+        for msg in messages:
+            if not msg:
+                continue
+            for line in msg.split(b'\n'):
+                line_str = line.decode('utf-8').strip()
+                if line_str.startswith('data: '):
+                    chunk_data = line_str[6:]
+                    if chunk_data == '[DONE]':
+                        continue
+                    piece = extract(json.loads(chunk_data)) if parse_json else chunk_data
+                    if piece:
+                        full_content += piece
+    return full_content
+
+
+def run_decoder(reads, parse_json=True):
+    decoder = SSEDecoder()
+    accumulator = ContentAccumulator()
+    for chunk in reads:
+        for chunk_data in decoder.feed(chunk):
+            accumulator.append(extract(json.loads(chunk_data)) if parse_json else chunk_data)
+    for chunk_data in decoder.close():
+        accumulator.append(extract(json.loads(chunk_data)) if parse_json else chunk_data)
+    return accumulator.getvalue()
+
+
+def best_of(func, reads, repeat, parse_json=True):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(reads, parse_json)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=100_000, help='合成流中的 token 数量')
+    parser.add_argument('--read-size', type=int, default=4096, help='每次读取的字节数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数（取最快一次）')
+    parser.add_argument('--file', help='录制的原始 SSE 响应体文件')
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            body = f.read()
+    else:
+        body = build_synthetic_stream(args.tokens)
+    scenarios = [
+        ("完整流程 (分帧 + JSON 解析 + 累加)", body, True),
+        ("仅分帧与累加 (不含 JSON 解析)", body, False),
+    ]
+    if not args.file:
+        scenarios.append(("少量超大事件 (8 x 256K 字符)", build_large_event_stream(8, 256 * 1024), True))
+
+    for title, payload, parse_json in scenarios:
+        reads = split_reads(payload, args.read_size)
+        legacy_time, legacy_result = best_of(run_legacy, reads, args.repeat, parse_json)
+        decoder_time, decoder_result = best_of(run_decoder, reads, args.repeat, parse_json)
+        print(f"\n== {title} ==")
+        print(f"响应体大小: {len(payload) / 1024 / 1024:.2f} MB, 读取次数: {len(reads)}")
+        if legacy_result != decoder_result:
+            print("警告: 两种实现的输出不一致！")
+        print(f"旧实现 (split + 字符串拼接): {legacy_time * 1000:.1f} ms")
+        print(f"SSEDecoder + ContentAccumulator: {decoder_time * 1000:.1f} ms")
+        print(f"加速比: {legacy_time / decoder_time:.2f}x")
+
+    # 额外演示：逐字节输入时多字节字符跨越块边界也能正确解码
+    byte_reads = split_reads(build_synthetic_stream(200), 1)
+    assert run_decoder(byte_reads) == run_legacy([b''.join(byte_reads)])
+    print("\n逐字节输入校验通过（跨块的多字节 UTF-8 字符解码正确）。")
+
+
+if __name__ == '__main__':
+    main()
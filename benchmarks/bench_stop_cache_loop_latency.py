@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+停止请求缓存的事件循环延迟基准测试
+
+模拟一个 worker 中的多个并发流式生成：每个流每收到一个数据块检查一次停止标志，
+每隔若干块为停止标志续期（与 chat.services.generate_ai_response 的循环一致）。对比
+- 同步：直接在事件循环中调用 chat.state_utils.RedisCache（阻塞的 redis 客户端，旧实现）；
+- 异步：chat.state_utils.AsyncRedisCache（redis.asyncio，新实现）。
+同时运行一个每 1ms 唤醒一次的计时任务，以其实际唤醒时间与预期时间之差作为事件循环延迟。
+需要可访问的 Redis（REDIS_HOST / REDIS_PORT / REDIS_DB_STOP_STATE / REDIS_PASSWORD），只读写 stop_request:bench-* 键。
+停止标志的近端缓存在此关闭，测量的是每次检查都访问 Redis 时的情况。
+
+用法:
+    python benchmarks/bench_stop_cache_loop_latency.py
+    python benchmarks/bench_stop_cache_loop_latency.py --streams 50 200 --chunks 100 --chunk-interval-ms 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('DJANGO_LOG_LEVEL', 'WARNING')
+
+import django  # noqa: E402
+
+django.setup()
+
+from chat.state_utils import AsyncRedisCache, RedisCache, StopFlagNearCache  # noqa: E402
+
+TICK_SECONDS = 0.001
+TOUCH_EVERY_CHUNKS = 20
+
+
+async def run_stream(index, chunks, chunk_interval, get, touch):
+    generation_id = f"bench-{index}"
+    for chunk in range(chunks):
+        await asyncio.sleep(chunk_interval)  # 等待上游的下一个数据块
+        if await get(generation_id):
+            return
+        if chunk % TOUCH_EVERY_CHUNKS == 0:
+            await touch(generation_id)
+
+
+async def measure_lag(stop_event, lags):
+    while not stop_event.is_set():
+        expected = time.perf_counter() + TICK_SECONDS
+        await asyncio.sleep(TICK_SECONDS)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+
+async def run_case(streams, chunks, chunk_interval, get, touch):
+    lags = []
+    stop_event = asyncio.Event()
+    ticker = asyncio.create_task(measure_lag(stop_event, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(run_stream(i, chunks, chunk_interval, get, touch) for i in range(streams)))
+    elapsed = time.perf_counter() - start
+    stop_event.set()
+    await ticker
+    return elapsed, lags
+
+
+def sync_adapters(cache):
+    async def get(generation_id):
+        return cache.get_stop_requested(generation_id)
+
+    async def touch(generation_id):
+        cache.touch_stop_request(generation_id)
+
+    return get, touch
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(label, streams, elapsed, lags):
+    lags_ms = [lag * 1000 for lag in lags] or [0.0]
+    print(
+        f"{streams:>6} | {label:<4} | {elapsed:>7.2f}s | {statistics.median(lags_ms):>8.2f}ms"
+        f" | {percentile(lags_ms, 0.99):>8.2f}ms | {max(lags_ms):>8.2f}ms"
+    )
+
+
+async def main_async(args):
+    # 关闭近端缓存，每次检查都访问 Redis
+    sync_cache = RedisCache()
+    sync_cache.near_cache = StopFlagNearCache(max_age=0)
+    async_cache = AsyncRedisCache(sync_cache.connection_kwargs, sync_cache.near_cache)
+    chunk_interval = args.chunk_interval_ms / 1000
+    print(f"每个流 {args.chunks} 个数据块，数据块间隔 {args.chunk_interval_ms}ms")
+    print(f"{'并发流':>6} | {'实现':<4} | {'总耗时':>7} | {'延迟 p50':>8} | {'延迟 p99':>8} | {'延迟 max':>8}")
+    try:
+        for streams in args.streams:
+            get, touch = sync_adapters(sync_cache)
+            elapsed, lags = await run_case(streams, args.chunks, chunk_interval, get, touch)
+            report("同步", streams, elapsed, lags)
+            elapsed, lags = await run_case(
+                streams, args.chunks, chunk_interval, async_cache.get_stop_requested, async_cache.touch_stop_request
+            )
+            report("异步", streams, elapsed, lags)
+    finally:
+        await async_cache.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, nargs='+', default=[200], help='并发流的数量')
+    parser.add_argument('--chunks', type=int, default=200, help='每个流的数据块数量')
+    parser.add_argument('--chunk-interval-ms', type=float, default=10, help='上游两个数据块之间的间隔（毫秒）')
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+共享内存停止标志表的多进程压力测试
+
+启动多个进程（模拟 gunicorn 的多个 worker）同时读写同一个 chat.shared_stop_table.SharedStopTable：
+1. 并发读写：每个进程反复对自己的 generation_id 执行 set -> get -> touch -> clear -> get，
+   并随机读取其他进程的键；自己的键在任何时刻都必须读到自己刚写入的状态。
+2. 跨进程可见性：每个进程写入一批键，所有进程随后都必须读到全部的键。
+3. TTL：写入短 TTL 的键，过期后所有进程都必须读不到。
+表文件写入临时目录，不影响运行中的服务。不需要数据库。任一检查失败时以非零状态退出。
+
+用法:
+    python benchmarks/stress_shared_stop_table.py
+    python benchmarks/stress_shared_stop_table.py --processes 8 --ops 20000 --slots 4096
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat.shared_stop_table import SharedStopTable  # noqa: E402
+
+TTL = 60
+SHORT_TTL = 0.5
+
+
+def worker(index, args, path, barrier, results):
+    table = SharedStopTable(path, args.slots)
+    errors = []
+    rng = random.Random(index)
+
+    # 1. 并发读写
+    barrier.wait()
+    start = time.perf_counter()
+    operations = 0
+    for i in range(args.ops):
+        key = f"worker-{index}-{i % args.keys_per_process}"
+        table.set(key, TTL)
+        if not table.get(key):
+            errors.append(f"set 之后读不到 {key}")
+        if not table.touch(key, TTL):
+            errors.append(f"无法续期 {key}")
+        table.clear(key)
+        if table.get(key):
+            errors.append(f"clear 之后仍能读到 {key}")
+        table.get(f"worker-{rng.randrange(args.processes)}-{rng.randrange(args.keys_per_process)}")
+        operations += 6
+    elapsed = time.perf_counter() - start
+
+    # 2. 跨进程可见性
+    for i in range(args.keys_per_process):
+        table.set(f"visible-{index}-{i}", TTL)
+    barrier.wait()
+    missing = sum(
+        1 for other in range(args.processes) for i in range(args.keys_per_process)
+        if not table.get(f"visible-{other}-{i}")
+    )
+    if missing:
+        errors.append(f"读不到其他进程写入的 {missing} 个键")
+    barrier.wait()
+    for i in range(args.keys_per_process):
+        table.clear(f"visible-{index}-{i}")
+
+    # 3. TTL
+    for i in range(args.keys_per_process):
+        table.set(f"ttl-{index}-{i}", SHORT_TTL)
+    barrier.wait()
+    time.sleep(SHORT_TTL + 0.2)
+    leftover = sum(
+        1 for other in range(args.processes) for i in range(args.keys_per_process)
+        if table.get(f"ttl-{other}-{i}")
+    )
+    if leftover:
+        errors.append(f"{leftover} 个键在过期后仍能读到")
+
+    table.close()
+    results.put((index, operations, elapsed, errors[:5], len(errors)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4, help='并发进程数')
+    parser.add_argument('--ops', type=int, default=5000, help='每个进程的 set/get/touch/clear 轮数')
+    parser.add_argument('--keys-per-process', type=int, default=200, help='每个进程使用的键数量')
+    parser.add_argument('--slots', type=int, default=16384, help='表的槽位数量')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='stress_shared_stop_table_'), 'table')
+    SharedStopTable(path, args.slots).close()
+    barrier = multiprocessing.Barrier(args.processes)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker, args=(index, args, path, barrier, results))
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    total_errors = 0
+    print(f"{'进程':>4} | {'操作数':>8} | {'耗时':>7} | {'吞吐':>12} | {'错误':>4}")
+    for index, operations, elapsed, sample, error_count in sorted(reports):
+        total_errors += error_count
+        print(f"{index:>4} | {operations:>8} | {elapsed:>6.2f}s | {operations / elapsed:>8.0f} op/s | {error_count:>4}")
+        for message in sample:
+            print(f"       - {message}")
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+    print("通过" if not total_errors else f"失败：共 {total_errors} 个错误")
+    sys.exit(1 if total_errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,17 @@
 from django.contrib import admin
-from .models import AIProvider, AIModel, Conversation, Message
+from .models import AIProvider, AIModel, Attachment, Conversation, Message
 
 @admin.register(AIProvider)
 class AIProviderAdmin(admin.ModelAdmin):
-    list_display = ('name', 'base_url', 'is_active', 'created_at')
+    list_display = ('name', 'base_url', 'max_concurrent_requests', 'max_queued_requests', 'is_active', 'created_at')
+    list_editable = ('max_concurrent_requests', 'max_queued_requests')
     list_filter = ('is_active',)
     search_fields = ('name', 'base_url')
 
 @admin.register(AIModel)
 class AIModelAdmin(admin.ModelAdmin):
-    list_display = ('display_name', 'provider', 'model_name', 'max_context', 'is_active')
-    list_filter = ('provider', 'is_active')
+    list_display = ('display_name', 'provider', 'model_name', 'equivalence_group', 'max_context', 'max_concurrent_requests', 'response_cache_enabled', 'is_active')
+    list_filter = ('provider', 'equivalence_group', 'response_cache_enabled', 'is_active')
     search_fields = ('display_name', 'model_name')
 
 @admin.register(Conversation)
@@ -19,6 +20,12 @@ class ConversationAdmin(admin.ModelAdmin):
     list_filter = ('user', 'selected_model')
     search_fields = ('title',)
     date_hierarchy = 'created_at'
+    readonly_fields = ('summary', 'summary_until')
+
+class AttachmentInline(admin.TabularInline):
+    model = Attachment
+    extra = 0
+    readonly_fields = ('file_path', 'derivative_path', 'mime_type', 'size', 'width', 'height', 'sha256', 'created_at')
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
@@ -26,6 +33,7 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ('is_user', 'model_used', 'conversation')
     search_fields = ('content',)
     date_hierarchy = 'timestamp'
+    inlines = [AttachmentInline]
     
     def get_snippet(self, obj):
         return obj.content[:50] + "..." if len(obj.content) > 50 else obj.content
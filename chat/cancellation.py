@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import redis
+
+from .state_utils import (
+    STOP_INVALIDATION_CHANNEL, RedisCache, SharedMemoryCache, async_stop_request_manager, stop_request_manager,
+    get_stop_requested_async, set_stop_requested_async, set_stop_requested_sync,
+)
+
+logger = logging.getLogger(__name__)
+
+# 用于在 worker 之间广播停止请求的 Redis 频道
+STOP_CHANNEL = "generation_stop"
+
+# 订阅断开后的重连间隔（秒）
+LISTENER_RETRY_DELAY = 2
+
+# 共享内存模式下轮询停止标志表的间隔（秒）
+try:
+    STOP_REQUEST_SHM_POLL_INTERVAL = float(os.getenv('STOP_REQUEST_SHM_POLL_INTERVAL', '0.2'))
+except (ValueError, TypeError):
+    STOP_REQUEST_SHM_POLL_INTERVAL = 0.2
+
+
+class CancellationToken:
+    """
+    单个生成任务的取消令牌。
+    生成循环只需检查本地的 `cancelled` 标志，无需任何网络或阻塞调用。
+    在 arm() 与 disarm() 之间（通常用 armed() 包住单次上游读取）收到停止请求时，还会直接取消正在等待上游数据的任务；
+    发送事件、写入事件日志等操作必须在 disarm() 之后进行，不会被停止请求从中途打断。
+    """
+
+    __slots__ = ('generation_id', 'loop', 'event', 'cancelled', '_task')
+
+    def __init__(self, generation_id, loop):
+        self.generation_id = generation_id
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.cancelled = False
+        self._task = None
+
+    def arm(self, task=None):
+        """在等待上游响应期间，允许停止请求直接取消该任务。"""
+        self._task = task or asyncio.current_task()
+
+    def disarm(self):
+        self._task = None
+
+    @contextmanager
+    def armed(self):
+        """只在 with 块内允许停止请求直接取消当前任务。"""
+        self.arm()
+        try:
+            yield
+        finally:
+            self.disarm()
+
+    def trigger(self):
+        """标记为已取消（必须在令牌所属的事件循环中调用）。"""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.event.set()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+class CancellationRegistry:
+    """
+    worker 级的取消注册表，将停止请求映射到本进程中对应生成任务的 CancellationToken。
+    - Redis 模式：停止请求通过 Redis pub/sub 发布一次，各 worker 的监听任务将其投递给本地令牌。
+    - 共享内存模式：停止请求写入同一主机上所有 worker 共享的停止标志表，
+      各 worker 的监听任务每隔 STOP_REQUEST_SHM_POLL_INTERVAL 秒检查本地令牌对应的标志。
+    - 内存模式：直接投递给本进程中注册的令牌。
+    两种模式下都会同时写入 state_utils 中带 TTL 的停止标志，供线程化的 HTTP 路径
+    以及在停止请求之后才注册的任务使用。
+    Redis 模式下监听任务同时订阅 STOP_INVALIDATION_CHANNEL，维护本 worker 停止标志近端缓存的一致性。
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._listener_task = None
+
+    @property
+    def uses_pubsub(self):
+        return isinstance(self._cache, RedisCache)
+
+    @property
+    def uses_polling(self):
+        return isinstance(self._cache, SharedMemoryCache)
+
+    # --- 生成任务侧 ---
+    def register(self, generation_id):
+        """为生成任务注册取消令牌（必须在事件循环中调用）。"""
+        token = CancellationToken(str(generation_id), asyncio.get_running_loop())
+        with self._lock:
+            self._tokens[token.generation_id] = token
+        self.ensure_listener()
+        return token
+
+    def unregister(self, token):
+        with self._lock:
+            if self._tokens.get(token.generation_id) is token:
+                del self._tokens[token.generation_id]
+
+    async def check_pending(self, token):
+        """注册后检查一次共享停止标志，覆盖在注册之前就已发出的停止请求。"""
+        if await get_stop_requested_async(token.generation_id):
+            token.trigger()
+        return token.cancelled
+
+    def _deliver(self, generation_id):
+        """将停止请求投递给本进程中的令牌（线程安全）。"""
+        with self._lock:
+            token = self._tokens.get(str(generation_id))
+        if token is None:
+            return False
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is token.loop:
+            token.trigger()
+        elif not token.loop.is_closed():
+            token.loop.call_soon_threadsafe(token.trigger)
+        logger.info(f"已将停止请求投递给本地生成任务 {generation_id}。")
+        return True
+
+    # --- 请求停止侧 ---
+    def request_stop_sync(self, generation_id):
+        """发布停止请求（同步版本，供 HTTP 视图使用）。"""
+        if not generation_id:
+            return
+        set_stop_requested_sync(generation_id)
+        if self.uses_pubsub:
+            try:
+                self._cache.client.publish(STOP_CHANNEL, str(generation_id))
+            except redis.RedisError as e:
+                logger.error(f"发布停止请求 {generation_id} 失败: {e}")
+        else:
+            self._deliver(generation_id)
+
+    async def request_stop(self, generation_id):
+        """发布停止请求（异步版本，供 WebSocket consumer 使用）。"""
+        if not generation_id:
+            return
+        await set_stop_requested_async(generation_id)
+        if self.uses_pubsub:
+            try:
+                await async_stop_request_manager.publish(STOP_CHANNEL, str(generation_id))
+            except redis.RedisError as e:
+                logger.error(f"发布停止请求 {generation_id} 失败: {e}")
+        else:
+            self._deliver(generation_id)
+
+    # --- Redis pub/sub 监听 / 共享内存轮询 ---
+    def ensure_listener(self):
+        """在 Redis 或共享内存模式下启动（或重启）本 worker 的停止请求监听任务。"""
+        if self.uses_pubsub:
+            listener = self._listen
+        elif self.uses_polling:
+            listener = self._poll
+        else:
+            return
+        if self._listener_task is not None and not self._listener_task.done():
+            return
+        self._listener_task = asyncio.get_running_loop().create_task(listener())
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(STOP_REQUEST_SHM_POLL_INTERVAL)
+            with self._lock:
+                pending = [token for token in self._tokens.values() if not token.cancelled]
+            for token in pending:
+                try:
+                    # 内存映射读取，不涉及网络 I/O，可直接在事件循环中执行
+                    if self._cache.get_stop_requested(token.generation_id):
+                        self._deliver(token.generation_id)
+                except Exception as e:
+                    logger.error(f"轮询停止请求 {token.generation_id} 失败: {e}")
+
+    async def _listen(self):
+        import redis.asyncio as aioredis
+
+        while True:
+            client = aioredis.Redis(connection_pool=aioredis.ConnectionPool(**self._cache.connection_kwargs))
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            near_cache = self._cache.near_cache
+            try:
+                await pubsub.subscribe(STOP_CHANNEL, STOP_INVALIDATION_CHANNEL)
+                logger.info(f"已订阅停止请求频道 '{STOP_CHANNEL}' 和 '{STOP_INVALIDATION_CHANNEL}'。")
+                near_cache.set_subscribed(True)
+                # 订阅建立（或重建）后检查一次已注册的任务，补上断线期间错过的停止请求
+                with self._lock:
+                    pending = list(self._tokens.values())
+                for token in pending:
+                    if not token.cancelled:
+                        await self.check_pending(token)
+                async for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    if message['channel'] == STOP_INVALIDATION_CHANNEL:
+                        near_cache.invalidate(message['data'])
+                    else:
+                        self._deliver(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"停止请求订阅中断: {e}，{LISTENER_RETRY_DELAY} 秒后重试。")
+                await asyncio.sleep(LISTENER_RETRY_DELAY)
+            finally:
+                if near_cache.subscribed:
+                    near_cache.set_subscribed(False)
+                try:
+                    await pubsub.close()
+                    await client.close()
+                except Exception:
+                    pass
+
+    async def shutdown(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._listener_task = None
+
+
+# 进程级单例
+cancellation_registry = CancellationRegistry(stop_request_manager)
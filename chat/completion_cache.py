@@ -0,0 +1,238 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .request_body import json_default
+
+logger = logging.getLogger(__name__)
+
+# --- 回复缓存配置 ---
+# 条目有效期和条目数上限在 config/settings.py 中配置（COMPLETION_CACHE_TTL / COMPLETION_CACHE_MAX_ENTRIES）：
+# 内存模式下由 'completions' 缓存的 MAX_ENTRIES 限制，Redis 模式下由 CompletionCache 维护的条目索引限制
+CACHE_ALIAS = 'completions'
+
+# Redis 模式下的条目索引（有序集合，成员为完整的缓存键，分数为写入时间）
+INDEX_KEY = 'reply_index'
+
+# 单条回复的最大字节数，超过时不缓存
+try:
+    COMPLETION_CACHE_MAX_ENTRY_BYTES = int(os.getenv('COMPLETION_CACHE_MAX_ENTRY_BYTES', '262144'))
+except (ValueError, TypeError):
+    COMPLETION_CACHE_MAX_ENTRY_BYTES = 262144
+
+# 重放时每个合成增量包含的字符数
+REPLAY_DELTA_CHARS = 64
+
+
+def _normalize_content(content):
+    # 多模态内容（列表）原样参与哈希，其中的图片以 StoredDataURL 的指纹（路径、大小、修改时间）代替
+    if isinstance(content, str):
+        return content.replace('\r\n', '\n').strip()
+    return content
+
+
+def _synthetic_sse(text):
+    """把完整回复切分为 chat/completions 流式格式的 SSE 数据。"""
+    parts = []
+    for start in range(0, len(text), REPLAY_DELTA_CHARS):
+        delta = json.dumps({'choices': [{'delta': {'content': text[start:start + REPLAY_DELTA_CHARS]}}]}, ensure_ascii=False)
+        parts.append(f"data: {delta}\n\n")
+    parts.append("data: [DONE]\n\n")
+    return ''.join(parts).encode('utf-8')
+
+
+class _SyntheticBody:
+    """提供与 aiohttp 的 response.content 相同的 read() 接口。"""
+
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    async def read(self, n=-1):
+        end = len(self._data) if n is None or n < 0 else self._offset + n
+        chunk = self._data[self._offset:end]
+        self._offset += len(chunk)
+        return chunk
+
+
+class CachedResponse:
+    """
+    把缓存的回复伪装成上游响应，生成循环无需区分缓存命中和真实请求：
+    - 异步：response.content.read(n) 和 response.json()（aiohttp 接口）
+    - 同步：response.iter_content(chunk_size)（requests 接口）
+    """
+
+    status = 200
+
+    def __init__(self, text):
+        self.text = text
+        self._sse = _synthetic_sse(text)
+        self.content = _SyntheticBody(self._sse)
+
+    async def json(self):
+        return {'choices': [{'message': {'role': 'assistant', 'content': self.text}}]}
+
+    def iter_content(self, chunk_size=4096):
+        for start in range(0, len(self._sse), chunk_size):
+            yield self._sse[start:start + chunk_size]
+
+
+class CachedCompletion:
+    """与 upstream.UpstreamAttempt 接口一致的缓存命中结果。"""
+
+    def __init__(self, model, text):
+        self.model = model
+        self.response = CachedResponse(text)
+        self.first_chunk = None
+
+    async def aclose(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class CompletionCache:
+    """
+    精确匹配的回复缓存，存放在 Django 的 'completions' 缓存中。
+    - 键为 (model_name, 规范化后的消息, 默认参数) 的 SHA-256。
+    - 只有开启了 response_cache_enabled 且默认参数中 temperature 为 0 的模型才会使用。
+    - 按模型记录命中/未命中次数，计数器同样存放在缓存中，Redis 模式下所有 worker 共享。
+    - Redis 不按条目数淘汰：写入时同时把键记入有序集合 INDEX_KEY，超过 COMPLETION_CACHE_MAX_ENTRIES 时删除最早写入的条目。
+    缓存后端出错时只记录日志，不影响生成。
+    """
+
+    def __init__(self, alias=CACHE_ALIAS):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _index_client(self):
+        """缓存后端为 django-redis 时返回其 Redis 连接，用于维护条目索引；其他后端自带条目数上限，返回 None。"""
+        from django_redis.cache import RedisCache
+        if not isinstance(self.cache, RedisCache):
+            return None
+        from django_redis import get_redis_connection
+        return get_redis_connection(self.alias)
+
+    def _trim_index(self, client, key):
+        """把新写入的键记入索引，并删除已过期的索引成员和超出条目数上限的最早条目。"""
+        index = self.cache.make_key(INDEX_KEY)
+        now = time.time()
+        pipe = client.pipeline()
+        pipe.zadd(index, {self.cache.make_key(key): now})
+        pipe.zremrangebyscore(index, '-inf', now - settings.COMPLETION_CACHE_TTL)
+        pipe.zcard(index)
+        pipe.expire(index, settings.COMPLETION_CACHE_TTL)
+        size = pipe.execute()[2]
+        excess = size - settings.COMPLETION_CACHE_MAX_ENTRIES
+        if excess > 0:
+            # ZPOPMIN 是原子的，并发的写入不会重复淘汰同一个条目
+            evicted = [member for member, _score in client.zpopmin(index, excess)]
+            if evicted:
+                client.delete(*evicted)
+
+    @staticmethod
+    def is_enabled_for(model):
+        if not model.get('response_cache_enabled'):
+            return False
+        return (model.get('default_params') or {}).get('temperature') == 0
+
+    @staticmethod
+    def make_key(model, messages):
+        params = {k: v for k, v in (model.get('default_params') or {}).items() if k != 'stream'}
+        normalized = [{**message, 'content': _normalize_content(message.get('content'))} for message in messages]
+        payload = json.dumps(
+            {'model': model['model_name'], 'messages': normalized, 'params': params},
+            sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=json_default
+        )
+        return f"reply:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+    def _count(self, model_id, kind):
+        key = f"stats:{model_id}:{kind}"
+        try:
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                # 计数器不存在：创建它；并发创建失败时说明另一方已创建，再次递增
+                if not self.cache.add(key, 1, timeout=None):
+                    self.cache.incr(key)
+        except Exception as e:
+            logger.warning(f"CompletionCache: 更新命中统计失败: {e}")
+
+    # --- 同步接口 ---
+    def lookup(self, model, messages, bypass=False):
+        """
+        返回 (key, 缓存的回复)；模型未启用缓存时返回 (None, None)，未命中时回复为 None。
+        bypass 为真时（重新生成：用户要的是另一个回复）不读取缓存也不计入统计，只返回键，新的回复仍会写入缓存。
+        """
+        if not self.is_enabled_for(model):
+            return None, None
+        key = self.make_key(model, messages)
+        if bypass:
+            return key, None
+        try:
+            text = self.cache.get(key)
+        except Exception as e:
+            logger.error(f"CompletionCache: 读取回复缓存失败: {e}")
+            return key, None
+        self._count(model['id'], 'hits' if text is not None else 'misses')
+        if text is not None:
+            logger.info(f"CompletionCache: 模型 {model['id']} 命中回复缓存。")
+        return key, text
+
+    def store(self, key, text):
+        if not key or not text:
+            return
+        size = len(text.encode('utf-8'))
+        if size > COMPLETION_CACHE_MAX_ENTRY_BYTES:
+            logger.debug(f"CompletionCache: 回复大小 {size} 字节超过上限，不缓存。")
+            return
+        try:
+            self.cache.set(key, text)
+            client = self._index_client()
+            if client is not None:
+                self._trim_index(client, key)
+        except Exception as e:
+            logger.error(f"CompletionCache: 写入回复缓存失败: {e}")
+
+    def stats(self, model_ids):
+        """返回 {model_id: {'hits': n, 'misses': n}}。"""
+        keys = {f"stats:{model_id}:{kind}": (model_id, kind) for model_id in model_ids for kind in ('hits', 'misses')}
+        result = {model_id: {'hits': 0, 'misses': 0} for model_id in model_ids}
+        try:
+            values = self.cache.get_many(list(keys))
+        except Exception as e:
+            logger.error(f"CompletionCache: 读取命中统计失败: {e}")
+            return result
+        for key, value in values.items():
+            model_id, kind = keys[key]
+            result[model_id][kind] = value
+        return result
+
+    # --- 协程接口 ---
+    async def alookup(self, model, messages, bypass=False):
+        if not self.is_enabled_for(model):
+            return None, None
+        if bypass:
+            return self.make_key(model, messages), None
+        return await sync_to_async(self.lookup, thread_sensitive=False)(model, messages)
+
+    async def astore(self, key, text):
+        if key and text:
+            await sync_to_async(self.store, thread_sensitive=False)(key, text)
+
+
+# 进程级单例
+completion_cache = CompletionCache()
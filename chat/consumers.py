@@ -9,6 +9,7 @@ import logging
 import threading
 import json
 import uuid # Import uuid
+from urllib.parse import parse_qs
 import aiohttp
 import asyncio
 import logging
@@ -16,10 +17,16 @@ import logging
 
 from .models import Conversation, Message, AIModel
 # --- Import new state utils ---
-from .state_utils import get_stop_requested_sync, set_stop_requested_sync, clear_stop_request_sync, touch_stop_request_sync
+from .state_utils import get_stop_requested_async
 # --- Import response handlers ---
 from .response_handlers import extract_response_content, ResponseExtractionError
 from .services import generate_ai_response
+from .cancellation import cancellation_registry
+from .event_dispatch import event_dispatcher
+from .event_log import find_gap, generation_event_log
+from .generation_manager import generation_manager
+from .generation_registry import generation_registry
+from .image_pipeline import ImageValidationError, base64_decoded_size, validate_image_upload
 import asyncio # 导入 asyncio
 
 logger = logging.getLogger(__name__)
@@ -57,7 +64,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 return
             self.conversation_group_name = f'chat_{self.conversation_id}'
 
-        # 加入对话组
+        # 加入对话组（channel layer 的消息在 connect 返回之后才会被处理）
         await self.channel_layer.group_add(
             self.conversation_group_name,
             self.channel_name
@@ -70,15 +77,76 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.stop_requested = False
         self.termination_message_sent = False  # 标记是否已发送终止消息
         self.current_generation_id = None # Add generation ID tracking
+        self.owned_generation_ids = set()  # 由本连接发起的生成任务（任务本身由 generation_manager 持有）
         # 添加一个锁，用于同步终止请求和发送回复
         self.response_lock = asyncio.Lock()
 
         # 连接时无需进行状态清理
         logger.info(f"Consumer connected for conversation {self.conversation_id or 'new'}.")
 
+        # 登记为本进程的订阅者（生成事件在没有远程订阅者时直接投递，见 event_dispatch）。
+        # 直接投递与重放并发进行，重放结束前收到的事件先缓冲，之后丢弃已重放过的部分再按顺序发送
+        self.replay_buffer = []
+        await event_dispatcher.subscribe(self.conversation_group_name, self)
+
+        # 断线重连时，客户端可携带 ?generation_id=...&last_seq=... 只重放错过的事件；
+        # 否则如果该会话有正在进行的生成任务，从头重放以接入进行中的流
+        replayed = None
+        try:
+            replayed = await self.replay_missed_events()
+        finally:
+            await self.flush_replay_buffer(replayed)
+
+    async def flush_replay_buffer(self, replayed):
+        """发送重放期间缓冲的直接投递事件，跳过 replayed = (generation_id, seq) 及之前的事件。"""
+        generation_id, replayed_seq = replayed or (None, 0)
+        while self.replay_buffer:
+            event = self.replay_buffer.pop(0)
+            data = event.get('data') or {}
+            if generation_id and str(data.get('generation_id')) == generation_id and 'seq' in data and data['seq'] <= replayed_seq:
+                continue
+            await self.send(text_data=json.dumps(event))
+        # 发送过程中新到的事件已追加到缓冲区并在上面的循环中发送，此后直接发送
+        self.replay_buffer = None
+
+    async def replay_missed_events(self):
+        """
+        根据连接 URL 中的 (generation_id, last_seq) 游标，或会话当前的生成任务，重放事件日志。
+        返回 (generation_id, 最后发送的序号)，没有重放时返回 None。
+        """
+        if not self.conversation_id:
+            return None
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        generation_id = (query.get('generation_id') or [None])[0]
+        if not generation_id:
+            current_generation_id = await self.get_current_generation_id(self.conversation_id)
+            if not current_generation_id:
+                return None
+            generation_id = str(current_generation_id)
+        try:
+            last_seq = int((query.get('last_seq') or ['0'])[0])
+        except ValueError:
+            last_seq = 0
+
+        owner_conversation_id = await generation_event_log.aget_conversation_id(generation_id)
+        if owner_conversation_id != str(self.conversation_id):
+            logger.info(f"Consumer: No replayable event log for GenID {generation_id} in conversation {self.conversation_id}.")
+            return None
+
+        events = await generation_event_log.aread_since(generation_id, last_seq)
+        gap = find_gap(generation_id, last_seq, events)
+        if gap is not None:
+            logger.warning(f"Consumer: Events after seq {last_seq} of GenID {generation_id} were trimmed from the log; replaying from seq {gap['data']['first_seq']}.")
+            await self.send(text_data=json.dumps(gap))
+        for event in events:
+            await self.send(text_data=json.dumps(event))
+        logger.info(f"Consumer: Replayed {len(events)} events for GenID {generation_id} after seq {last_seq}.")
+        return generation_id, events[-1]['data']['seq'] if events else last_seq
+
     async def disconnect(self, close_code):
         # 检查属性是否存在，如果存在才离开对话组
         if hasattr(self, 'conversation_group_name'):
+            await event_dispatcher.unsubscribe(self.conversation_group_name, self)
             await self.channel_layer.group_discard(
                 self.conversation_group_name,
                 self.channel_name
@@ -89,6 +157,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.active_request_task.cancel()
             self.active_request_task = None
 
+        # 生成任务由 generation_manager 持有：分离模式下继续运行并保存结果，否则请求停止
+        owned_generation_ids = getattr(self, 'owned_generation_ids', None)
+        if owned_generation_ids:
+            await generation_manager.detach(owned_generation_ids)
+
         # 断开连接时，状态由TTL自动管理，无需手动清理
         logger.info(f"Consumer disconnected for conversation {self.conversation_id or 'new'}.")
 
@@ -105,8 +178,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 logger.info(f"收到终止生成请求 (来自WebSocket): 会话ID {self.conversation_id}, 目标 GenID: {generation_id_to_stop}")
 
                 if generation_id_to_stop:
-                    # 设置初始的停止信号，后续由 aiserivce 的心跳机制来维持
-                    set_stop_requested_sync(generation_id_to_stop)
+                    # 发布一次停止请求，由拥有该生成任务的 worker 推送到其本地取消令牌
+                    await cancellation_registry.request_stop(generation_id_to_stop)
                 else:
                     logger.warning(f"停止请求缺少 'generation_id'，无法处理。")
 
@@ -138,8 +211,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 # 更新 group name 并重新订阅
                 old_group_name = self.conversation_group_name
                 self.conversation_group_name = f'chat_{self.conversation_id}'
+                await event_dispatcher.unsubscribe(old_group_name, self)
                 await self.channel_layer.group_discard(old_group_name, self.channel_name)
                 await self.channel_layer.group_add(self.conversation_group_name, self.channel_name)
+                await event_dispatcher.subscribe(self.conversation_group_name, self)
                 
                 # 通知客户端新的会话ID
                 await self.send(text_data=json.dumps({
@@ -175,7 +250,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }))
 
                 # Pass the single, trusted generation_id to the service
-                asyncio.create_task(
+                self.owned_generation_ids.add(generation_id)
+                generation_manager.start(
+                    generation_id,
                     generate_ai_response(
                         conversation_id=self.conversation_id,
                         model_id=model_id,
@@ -199,7 +276,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     return
                 
                 # Pass the single, trusted generation_id to the service
-                asyncio.create_task(
+                self.owned_generation_ids.add(generation_id)
+                generation_manager.start(
+                    generation_id,
                     generate_ai_response(
                         conversation_id=self.conversation_id,
                         model_id=model_id,
@@ -228,6 +307,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     await self.send_error("缺少必要参数 (model_id, generation_id, temp_id, file_data)")
                     return
 
+                # 在解码之前校验图片的类型和大小
+                try:
+                    validate_image_upload(file_name, file_type, base64_decoded_size(file_data))
+                except ImageValidationError as e:
+                    await self.send_error(str(e))
+                    return
+
                 # 保存用户消息（包含文本和图片信息）
                 display_message = message if message.strip() else '[图片上传]'
                 user_message = await self.save_user_message(self.conversation_id, display_message, model_id)
@@ -243,7 +329,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }))
 
                 # 调用统一的服务函数处理图片上传
-                asyncio.create_task(
+                self.owned_generation_ids.add(generation_id)
+                generation_manager.start(
+                    generation_id,
                     generate_ai_response(
                         conversation_id=self.conversation_id,
                         model_id=model_id,
@@ -289,7 +377,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # 如果是AI回复（非用户消息），进行最终的发送前检查
         if not is_user:
             # 使用新的、以 generation_id 为中心的检查
-            if get_stop_requested_sync(event_generation_id):
+            if await get_stop_requested_async(event_generation_id):
                 logger.warning(f"chat_message: 检测到针对 GenID {event_generation_id} 的停止请求。在发送到前端前拦截消息 (MsgID: {message_id})。")
                 # 消息已经保存在数据库中，但我们阻止它被发送到前端
                 return  # 停止处理，不发送消息
@@ -374,6 +462,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         接收来自 channel layer 的事件并将其广播到客户端。
         'event_data' 的格式为: {'event': {'type': '...', 'data': {...}}}
         """
+        if getattr(self, 'replay_buffer', None) is not None:
+            # 连接时的重放尚未结束，先缓冲（见 flush_replay_buffer）
+            self.replay_buffer.append(event_data['event'])
+            return
         # 直接将 'event' 字典发送给客户端
         await self.send(text_data=json.dumps(event_data['event']))
 
@@ -410,17 +502,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.error(traceback.format_exc())
             return None
 
-    @database_sync_to_async
-    def get_current_generation_id(self, conversation_id):
-        """获取当前会话正在进行的 Generation ID"""
-        try:
-            conversation = Conversation.objects.filter(id=conversation_id).only('current_generation_id').first()
-            if conversation:
-                return conversation.current_generation_id
-            return None
-        except Exception as e:
-            logger.error(f"获取当前 Generation ID 失败: {str(e)}")
-            return None
+    async def get_current_generation_id(self, conversation_id):
+        """获取当前会话正在进行的 Generation ID（来自 generation_registry，不查询数据库）"""
+        return await generation_registry.acurrent_generation_id(conversation_id)
 
     @database_sync_to_async
     def delete_subsequent_ai_messages(self, conversation_id, user_message_timestamp):
@@ -444,40 +528,6 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.error(traceback.format_exc())
             return 0
 
-    # --- ADDED: Database helper functions for generation ID ---
-    @database_sync_to_async
-    def set_db_generation_id(self, conversation_id, generation_id):
-        """Sets the current_generation_id in the Conversation model."""
-        try:
-            conversation = Conversation.objects.filter(id=conversation_id).first()
-            if conversation:
-                conversation.current_generation_id = generation_id
-                conversation.save(update_fields=['current_generation_id', 'updated_at'])
-                logger.info(f"DB: Set current_generation_id to {generation_id} for conversation {conversation_id}")
-            else:
-                logger.error(f"DB: Failed to set generation ID - Conversation {conversation_id} not found.")
-        except Exception as e:
-            logger.error(f"DB: Error setting generation ID for conversation {conversation_id}: {e}")
-
-    @database_sync_to_async
-    def clear_db_generation_id(self, conversation_id, generation_id_to_clear):
-        """Clears the current_generation_id in the Conversation model ONLY IF it matches generation_id_to_clear."""
-        try:
-            conversation = Conversation.objects.filter(id=conversation_id).first()
-            if conversation:
-                # Compare as strings for safety with UUIDs
-                if str(conversation.current_generation_id) == str(generation_id_to_clear):
-                    conversation.current_generation_id = None
-                    conversation.save(update_fields=['current_generation_id'])
-                    logger.info(f"DB: Cleared matching generation ID {generation_id_to_clear} for conversation {conversation_id}")
-                elif conversation.current_generation_id is not None:
-                    logger.info(f"DB: Did not clear generation ID for conversation {conversation_id}. DB ID ({conversation.current_generation_id}) != Provided ID ({generation_id_to_clear}).")
-                # else: logger.debug(f"DB: Generation ID already None for conversation {conversation_id}.")
-            # else: logger.warning(f"DB: Failed to clear generation ID - Conversation {conversation_id} not found.") # Less noisy
-        except Exception as e:
-            logger.error(f"DB: Error clearing generation ID for conversation {conversation_id}: {e}")
-    # --- END ADDED ---
-
     # --- ADDED: Handle generation_start ---
     async def generation_start(self, event):
         """Handles the generation_start signal from the API view."""
@@ -0,0 +1,193 @@
+import logging
+import os
+
+from django.core.files.storage import default_storage
+from django.db.models import Subquery
+
+from .context_cache import context_cache
+from .image_config import IMAGE_CONTEXT_STRATEGY, MAX_IMAGES_IN_CONTEXT, IMAGE_TOKEN_ESTIMATE
+from .models import Message
+from .request_body import PreEncodedMessage, StoredDataURL, encode_message
+from .tokens import MESSAGE_OVERHEAD_TOKENS, estimate_message_tokens, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# --- 上下文预算配置 ---
+# 模型默认参数中没有 max_tokens 时，为回复预留的 token 数
+try:
+    CONTEXT_RESPONSE_RESERVE_TOKENS = int(os.getenv('CONTEXT_RESPONSE_RESERVE_TOKENS', '1024'))
+except (ValueError, TypeError):
+    CONTEXT_RESPONSE_RESERVE_TOKENS = 1024
+
+class ContextBudgetError(Exception):
+    """最新的消息本身就超出了模型的上下文预算，无需请求上游即可判定失败。"""
+
+
+def context_budget(model):
+    """
+    返回 (历史消息可用的 token 数, 上下文上限, 为回复预留的 token 数)。
+    上限未配置（<= 0），或预留的 token 数不小于上限（配置不一致，无法计算预算）时预算为 None，不按 token 裁剪。
+    """
+    max_context = model.get('max_context') or 0
+    if max_context <= 0:
+        return None, max_context, 0
+    params = model.get('default_params') or {}
+    reserve = params.get('max_tokens') or params.get('max_completion_tokens') or CONTEXT_RESPONSE_RESERVE_TOKENS
+    if reserve >= max_context:
+        logger.warning(
+            f"模型 {model.get('model_name') or model.get('id')} 的回复预留 {reserve} tokens 不小于上下文上限 {max_context}，"
+            f"不按 token 预算裁剪历史。"
+        )
+        return None, max_context, reserve
+    return max_context - reserve, max_context, reserve
+
+
+def _message_cost(msg, include_image):
+    # token_count 在写入消息时计算；旧数据或未经 save() 写入的行回退到现场估算
+    tokens = msg.token_count if msg.token_count is not None else estimate_tokens(msg.content)
+    cost = tokens + MESSAGE_OVERHEAD_TOKENS
+    if include_image:
+        cost += IMAGE_TOKEN_ESTIMATE
+    return cost
+
+
+def _select_within_budget(history_messages, image_ids, budget, system_tokens, model):
+    """从最新的消息开始向前累加 token 数，返回预算内最长的一段连续历史。"""
+    if budget is None:
+        return history_messages
+    remaining = budget - system_tokens
+    start = len(history_messages)
+    for index in range(len(history_messages) - 1, -1, -1):
+        msg = history_messages[index]
+        cost = _message_cost(msg, msg.id in image_ids)
+        if cost > remaining:
+            if start == len(history_messages):
+                _budget, max_context, reserve = context_budget(model)
+                including = "（含系统提示词）" if system_tokens else ""
+                raise ContextBudgetError(
+                    f"消息过长：约 {cost + system_tokens} 个 token{including}，"
+                    f"超出模型上下文上限 {max_context}（已为回复预留 {reserve}）。"
+                )
+            break
+        remaining -= cost
+        start = index
+    if start:
+        logger.info(f"上下文预算 {budget} tokens：裁剪了最早的 {start} 条历史消息。")
+    return history_messages[start:]
+
+
+def _image_content(entry):
+    """
+    返回包含图片的多模态消息；优先发送上传时生成的缩放副本。
+    图片以 StoredDataURL 占位，发送请求时才从存储中流式编码（见 request_body）。
+    """
+    try:
+        if entry.derivative_path and default_storage.exists(entry.derivative_path):
+            image_path = entry.derivative_path
+        elif default_storage.exists(entry.file_path):
+            image_path = entry.file_path
+        else:
+            logger.warning(f"文件 '{entry.file_path}' 在消息 {entry.id} 中被引用但未找到。")
+            return {"role": entry.role, "content": f"{entry.content}\n[图片上传失败: 文件不存在]"}
+        multi_modal_content = [
+            {"type": "text", "text": entry.content},
+            {"type": "image_url", "image_url": {"url": StoredDataURL(image_path)}}
+        ]
+        logger.info(f"已将图片消息 {entry.id} 的完整内容添加到上下文中。")
+        return {"role": entry.role, "content": multi_modal_content}
+    except Exception as e:
+        logger.error(f"处理消息 {entry.id} 中的文件 '{entry.file_path}' 时出错: {e}", exc_info=True)
+        return {"role": entry.role, "content": f"{entry.content}\n[图片处理失败]"}
+
+
+def _text_message(entry):
+    """
+    返回以文本形式发送的历史消息。消息内容只由条目决定，序列化结果缓存在条目上：
+    条目随 context_cache 跨轮复用，编辑或删除消息时条目被替换，缓存随之失效。
+    """
+    if entry.file_path:
+        # 较旧的图片消息只发送文本描述
+        image_description = f"[用户上传了图片: {os.path.basename(entry.file_path)}]"
+        content = f"{entry.content}\n{image_description}" if entry.content else image_description
+    else:
+        content = entry.content
+    if entry.encoded is None:
+        entry.encoded = encode_message({"role": entry.role, "content": content})
+    return PreEncodedMessage({"role": entry.role, "content": content}, entry.encoded)
+
+
+def fetch_history_window(conversation_id, limit, user_message_id=None, is_regenerate=False):
+    """
+    只从数据库取出会话最近的 limit 条消息，按时间正序返回（limit <= 0 表示不限制）。
+    倒序取前 N 条由 (conversation, timestamp) 复合索引支持，耗时和内存与会话总长度无关。
+    重新生成时只取该用户消息及之前的消息，用户消息的时间戳以子查询获取，不需要额外的查询。
+    """
+    history_qs = Message.objects.filter(conversation_id=conversation_id)
+    if is_regenerate:
+        anchor = Message.objects.filter(id=user_message_id).values('timestamp')[:1]
+        history_qs = history_qs.filter(timestamp__lte=Subquery(anchor))
+    history_qs = history_qs.order_by('-timestamp')
+    if limit > 0:
+        history_qs = history_qs[:limit]
+    # 附件随消息一次性取出，构建上下文时不再逐条查询
+    history_messages = list(history_qs.prefetch_related('attachments'))
+    if is_regenerate and not history_messages:
+        raise Message.DoesNotExist(f"要重新生成的用户消息 {user_message_id} 不存在。")
+    history_messages.reverse()
+    return history_messages
+
+
+def conversation_summary(conversation):
+    """返回会话的 (摘要, 摘要覆盖到的消息时间戳)；没有摘要时返回 None。需要 select_related('summary_until')。"""
+    if not conversation.summary or conversation.summary_until is None:
+        return None
+    return conversation.summary, conversation.summary_until.timestamp
+
+
+def build_history_messages(conversation_id, system_prompt, model, user_message_id, is_regenerate, summary=None):
+    """
+    准备用于API请求的消息历史记录，支持多模态内容。
+    - 先取出最近的 max_history_messages 条消息（优先来自 context_cache），再按模型的 max_context 裁剪到 token 预算内。
+    - 会话有摘要（见 summarizer）时，只发送摘要之后的消息，摘要作为系统消息放在历史之前。
+    - 每条消息的 token 数来自写入时缓存的 Message.token_count，预算计算与消息长度无关。
+    - 最新的消息本身超出预算时抛出 ContextBudgetError，不再请求上游。
+    WebSocket 路径和 HTTP 回退路径共用此函数（同步，需在线程中调用）。
+    """
+    history_messages = context_cache.get_window(conversation_id, model['max_history_messages'], user_message_id, is_regenerate)
+
+    summary_message = None
+    if summary is not None:
+        summary_text, summary_until = summary
+        # 重新生成摘要覆盖范围内的旧消息时，摘要包含了之后的内容，此时不使用摘要
+        if history_messages and history_messages[-1].timestamp > summary_until:
+            history_messages = [msg for msg in history_messages if msg.timestamp > summary_until]
+            summary_message = {"role": "system", "content": f"以下是此前对话的摘要：\n{summary_text}"}
+
+    # 根据策略确定哪些图片需要被完整包含
+    all_image_message_ids = [msg.id for msg in history_messages if msg.file_path]
+    image_ids = set()
+    if IMAGE_CONTEXT_STRATEGY == "all":
+        image_ids = set(all_image_message_ids)
+    elif IMAGE_CONTEXT_STRATEGY == "latest_only":
+        image_ids = set(all_image_message_ids[-MAX_IMAGES_IN_CONTEXT:])
+
+    budget, _max_context, _reserve = context_budget(model)
+    system_tokens = estimate_message_tokens(system_prompt) if system_prompt else 0
+    if summary_message is not None:
+        system_tokens += estimate_message_tokens(summary_message['content'])
+    history_messages = _select_within_budget(history_messages, image_ids, budget, system_tokens, model)
+
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    if summary_message is not None:
+        messages.append(summary_message)
+
+    for msg in history_messages:
+        if msg.id in image_ids:
+            messages.append(_image_content(msg))
+        else:
+            messages.append(_text_message(msg))
+
+    logger.info(f"准备了 {len(messages)} 条消息用于API请求，图片策略: {IMAGE_CONTEXT_STRATEGY}")
+    return messages
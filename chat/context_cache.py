@@ -0,0 +1,205 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# --- 上下文缓存配置 ---
+# 最多缓存的会话数量（LRU）
+try:
+    CONTEXT_CACHE_MAX_CONVERSATIONS = int(os.getenv('CONTEXT_CACHE_MAX_CONVERSATIONS', '256'))
+except (ValueError, TypeError):
+    CONTEXT_CACHE_MAX_CONVERSATIONS = 256
+
+# 每个会话最多缓存的最近消息数量；max_history_messages 超过该值的模型直接查询数据库
+try:
+    CONTEXT_CACHE_MAX_MESSAGES = int(os.getenv('CONTEXT_CACHE_MAX_MESSAGES', '64'))
+except (ValueError, TypeError):
+    CONTEXT_CACHE_MAX_MESSAGES = 64
+
+
+class ContextEntry:
+    """构建上下文所需的单条消息：角色映射和附件信息在写入时取出一次，序列化结果随条目一起缓存。"""
+
+    __slots__ = ('id', 'timestamp', 'is_user', 'role', 'content', 'token_count', 'file_path', 'derivative_path', 'encoded')
+
+    def __init__(self, message, attachments=None):
+        """attachments 为 None 时读取 message.attachments（已 prefetch 时不产生查询）。"""
+        self.id = message.id
+        self.timestamp = message.timestamp
+        self.is_user = message.is_user
+        self.role = "user" if message.is_user else "assistant"
+        self.content = message.content
+        self.token_count = message.token_count
+        if attachments is None:
+            attachments = message.attachments.all()
+        attachment = next(iter(attachments), None)
+        self.file_path = attachment.file_path if attachment else None
+        self.derivative_path = attachment.derivative_path if attachment else ''
+        # 以文本形式发送时该消息的 JSON 字节，首次构建请求时生成（见 context_builder._text_message）
+        self.encoded = None
+
+
+class _CachedConversation:
+    __slots__ = ('entries', 'complete', 'version')
+
+    def __init__(self, entries, complete, version):
+        self.entries = entries      # 按时间正序的最近若干条消息
+        self.complete = complete    # entries 是否包含了会话的全部消息
+        self.version = version
+
+
+class ConversationContextCache:
+    """
+    worker 级的会话上下文缓存（LRU），保存每个会话最近的消息（ContextEntry）。
+    - 消息的创建、编辑和删除时增量更新缓存，正常的一轮对话只追加两条，无需重新查询整段历史。
+    - 每个会话在 Django 缓存中有一个版本号，每次写入消息时递增。Redis 模式下版本号在所有 worker 间共享，
+      其他 worker 写入后本地缓存的版本号不再匹配，下次读取时从数据库重新加载。
+    - 其他模式下 Django 缓存是每个进程各自的 LocMem，无法感知其他 worker 的写入，缓存关闭，每次直接查询数据库。
+    """
+
+    VERSION_KEY = "context_version:{}"
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # --- 版本号 ---
+    def _version_key(self, conversation_id):
+        return self.VERSION_KEY.format(conversation_id)
+
+    def _get_version(self, conversation_id):
+        try:
+            return cache.get(self._version_key(conversation_id), 0)
+        except Exception as e:
+            logger.error(f"ContextCache: 读取会话 {conversation_id} 的版本号失败: {e}")
+            return None
+
+    def _bump_version(self, conversation_id):
+        """递增并返回会话的版本号，失败时返回 None。"""
+        key = self._version_key(conversation_id)
+        try:
+            try:
+                return cache.incr(key)
+            except ValueError:
+                if cache.add(key, 1, timeout=None):
+                    return 1
+                return cache.incr(key)
+        except Exception as e:
+            logger.error(f"ContextCache: 更新会话 {conversation_id} 的版本号失败: {e}")
+            return None
+
+    # --- 读取 ---
+    def _load(self, conversation_id, version):
+        from .context_builder import fetch_history_window
+        messages = fetch_history_window(conversation_id, CONTEXT_CACHE_MAX_MESSAGES + 1)
+        complete = len(messages) <= CONTEXT_CACHE_MAX_MESSAGES
+        entries = [ContextEntry(message) for message in messages[-CONTEXT_CACHE_MAX_MESSAGES:]]
+        if version is None:
+            return entries, complete
+        with self._lock:
+            self._items[conversation_id] = _CachedConversation(entries, complete, version)
+            self._items.move_to_end(conversation_id)
+            while len(self._items) > CONTEXT_CACHE_MAX_CONVERSATIONS:
+                self._items.popitem(last=False)
+        return entries, complete
+
+    def get_window(self, conversation_id, limit, user_message_id=None, is_regenerate=False):
+        """
+        返回会话最近的 limit 条消息（ContextEntry 列表，按时间正序；limit <= 0 表示不限制）。
+        重新生成时只返回 user_message_id 及之前的消息。缓存无法满足时回退到数据库查询。
+        """
+        conversation_id = int(conversation_id)
+        if not self.enabled:
+            return self._fetch(conversation_id, limit, user_message_id, is_regenerate)
+        version = self._get_version(conversation_id)
+        with self._lock:
+            cached = self._items.get(conversation_id)
+            if cached is not None and cached.version == version:
+                self._items.move_to_end(conversation_id)
+                entries, complete = cached.entries, cached.complete
+                self.hits += 1
+            else:
+                entries = None
+                self.misses += 1
+        if entries is None:
+            entries, complete = self._load(conversation_id, version)
+
+        if is_regenerate:
+            index = next((i for i, entry in enumerate(entries) if entry.id == int(user_message_id)), None)
+            if index is None:
+                return self._fetch(conversation_id, limit, user_message_id, is_regenerate)
+            entries = entries[:index + 1]
+        if limit > 0 and len(entries) >= limit:
+            return entries[-limit:]
+        if complete:
+            return list(entries)
+        return self._fetch(conversation_id, limit, user_message_id, is_regenerate)
+
+    @staticmethod
+    def _fetch(conversation_id, limit, user_message_id, is_regenerate):
+        from .context_builder import fetch_history_window
+        return [ContextEntry(message) for message in fetch_history_window(conversation_id, limit, user_message_id, is_regenerate)]
+
+    # --- 写入（由 Message 的 post_save 信号和 Message/MessageQuerySet 的 delete 调用） ---
+    def _apply(self, conversation_id, mutate):
+        """递增版本号；本地缓存恰好是上一个版本时原地更新，否则丢弃。"""
+        if not self.enabled:
+            return
+        version = self._bump_version(conversation_id)
+        with self._lock:
+            cached = self._items.get(conversation_id)
+            if cached is None:
+                return
+            if version is None or cached.version != version - 1 or not mutate(cached):
+                del self._items[conversation_id]
+                return
+            cached.version = version
+
+    def on_message_saved(self, message, attachments=None):
+        entry = ContextEntry(message, attachments)
+
+        def mutate(cached):
+            for index, existing in enumerate(cached.entries):
+                if existing.id == entry.id:
+                    cached.entries[index] = entry
+                    return True
+            if cached.entries and entry.timestamp < cached.entries[-1].timestamp:
+                return False  # 不是追加到末尾的消息，重新加载
+            cached.entries.append(entry)
+            if len(cached.entries) > CONTEXT_CACHE_MAX_MESSAGES:
+                del cached.entries[0]
+                cached.complete = False
+            return True
+
+        self._apply(message.conversation_id, mutate)
+
+    def on_message_deleted(self, conversation_id, message_id):
+        def mutate(cached):
+            cached.entries = [entry for entry in cached.entries if entry.id != message_id]
+            return True
+
+        self._apply(conversation_id, mutate)
+
+    def on_conversation_changed(self, conversation_id):
+        """批量删除等无法增量更新的写入：递增版本号并丢弃本地缓存。"""
+        self._apply(conversation_id, lambda cached: False)
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._items.pop(int(conversation_id), None)
+
+    def stats(self):
+        with self._lock:
+            return {'enabled': self.enabled, 'conversations': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+# 进程级单例（版本号只有在 Redis 模式下才在 worker 间共享）
+context_cache = ConversationContextCache(enabled=settings.BACKEND_TYPE == 'redis')
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CancelOnDisconnectMiddleware:
+    """
+    客户端断开时取消 HTTP 请求的处理任务（ASGI 中间件）。
+    Django 4.2 在读完请求体后不再监听 http.disconnect，uvicorn 对已断开的连接的 send 直接忽略，
+    流式响应（SSE）因此会一直运行到自身结束。这里在请求体读完之后代为监听，收到 http.disconnect 时取消处理任务，
+    正在迭代的异步生成器随之收到 CancelledError / GeneratorExit（见 chat.views.user_api.http_chat_view）。
+    响应已经完整发送之后的断开不会取消任务，以免打断 Django 的收尾工作。
+    只处理 paths 中列出的路径（长时间运行的流式接口），其他请求不经过这里的额外任务和监听。
+    """
+
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = frozenset(paths)
+
+    def _applies_to(self, scope):
+        if scope['type'] != 'http':
+            return False
+        path = scope['path']
+        root_path = scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        return path in self.paths
+
+    async def __call__(self, scope, receive, send):
+        if not self._applies_to(scope):
+            return await self.app(scope, receive, send)
+
+        body_complete = asyncio.Event()
+        response_complete = False
+
+        async def receive_body():
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body', False):
+                body_complete.set()
+            return message
+
+        async def send_tracked(message):
+            nonlocal response_complete
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete = True
+            await send(message)
+
+        app_task = asyncio.ensure_future(self.app(scope, receive_body, send_tracked))
+
+        async def listen_for_disconnect():
+            # 请求体由 Django 读取，读完之后 receive 只会再返回 http.disconnect
+            await body_complete.wait()
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    if not response_complete:
+                        app_task.cancel()
+                    return
+
+        listener = asyncio.ensure_future(listen_for_disconnect())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not (listener.done() and not listener.cancelled()):
+                raise  # 外层取消（如 worker 关闭），不是客户端断开
+            logger.debug(f"客户端已断开，取消请求 {scope.get('path')}")
+        finally:
+            listener.cancel()
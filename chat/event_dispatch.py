@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+from .generation_registry import WORKER_ID
+from .state_utils import RedisCache, stop_request_manager
+
+logger = logging.getLogger(__name__)
+
+# 订阅者记录的保留时间（秒），与 channels_redis 的 group_expiry 默认值一致；崩溃的 worker 遗留的记录由此过期
+SUBSCRIBER_PRESENCE_TTL = 86400
+
+# 订阅者分布变化的广播频道，消息内容为 "<worker 标识> <会话组>"
+SUBSCRIBER_PRESENCE_CHANNEL = "chat_subscribers_changed"
+
+# 每个 worker 在本地缓存“会话组是否有远程订阅者”的时间（秒），订阅者变化通过 pub/sub 失效；
+# 订阅断开期间不缓存，每个事件都查询 Redis。设置为 0 时不缓存
+try:
+    SUBSCRIBER_PRESENCE_CACHE_TTL = float(os.getenv('SUBSCRIBER_PRESENCE_CACHE_TTL', '5'))
+except (ValueError, TypeError):
+    SUBSCRIBER_PRESENCE_CACHE_TTL = 5.0
+
+# 本地缓存最多保存的会话组数量
+SUBSCRIBER_PRESENCE_CACHE_MAX_ENTRIES = 10000
+
+# 订阅断开后的重连间隔（秒）
+LISTENER_RETRY_DELAY = 2
+
+
+class RedisSubscriberPresence:
+    """
+    记录每个会话组的订阅者分布在哪些 worker 上：哈希 `chat_subscribers:<group>`，字段为 channel_name，值为 worker 标识。
+    遗留的记录只会让分发器认为存在远程订阅者而改走 channel layer，不会丢失事件。
+    查询结果在本 worker 内缓存 cache_ttl 秒，订阅者登记或注销时向 SUBSCRIBER_PRESENCE_CHANNEL 广播，
+    各 worker 的订阅据此删除对应的缓存条目；与停止标志近端缓存一样，查询期间收到失效消息时不写入查询结果。
+    """
+
+    KEY_PREFIX = "chat_subscribers:"
+
+    def __init__(self, connection_kwargs, cache_ttl=SUBSCRIBER_PRESENCE_CACHE_TTL, clock=time.monotonic):
+        self._connection_kwargs = connection_kwargs
+        self._async_client = None
+        self.cache_ttl = cache_ttl
+        self.subscribed = False
+        self._cache = OrderedDict()  # group -> (是否有远程订阅者, 读取时间)
+        self._version = 0
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._listener_task = None
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _key(self, group):
+        return f"{self.KEY_PREFIX}{group}"
+
+    def _get_async_client(self):
+        if self._async_client is None:
+            import redis.asyncio as aioredis
+            self._async_client = aioredis.Redis(connection_pool=aioredis.ConnectionPool(**self._connection_kwargs))
+        return self._async_client
+
+    async def add(self, group, channel_name):
+        self.ensure_listener()
+        key = self._key(group)
+        pipe = self._get_async_client().pipeline(transaction=False)
+        pipe.hset(key, channel_name, WORKER_ID)
+        pipe.expire(key, SUBSCRIBER_PRESENCE_TTL)
+        pipe.publish(SUBSCRIBER_PRESENCE_CHANNEL, f"{WORKER_ID} {group}")
+        await pipe.execute()
+
+    async def remove(self, group, channel_name):
+        pipe = self._get_async_client().pipeline(transaction=False)
+        pipe.hdel(self._key(group), channel_name)
+        pipe.publish(SUBSCRIBER_PRESENCE_CHANNEL, f"{WORKER_ID} {group}")
+        await pipe.execute()
+
+    async def _fetch_has_remote(self, group):
+        workers = await self._get_async_client().hvals(self._key(group))
+        return any(worker != WORKER_ID for worker in workers)
+
+    async def has_remote(self, group):
+        ttl = self.cache_ttl if self.subscribed else 0
+        with self._lock:
+            entry = self._cache.get(group)
+            if entry is not None and self._clock() - entry[1] < ttl:
+                self._cache.move_to_end(group)
+                self._counters['hits'] += 1
+                return entry[0]
+            self._counters['misses'] += 1
+            version = self._version
+        has_remote = await self._fetch_has_remote(group)
+        if ttl > 0:
+            with self._lock:
+                if version == self._version:
+                    self._cache[group] = (has_remote, self._clock())
+                    self._cache.move_to_end(group)
+                    while len(self._cache) > SUBSCRIBER_PRESENCE_CACHE_MAX_ENTRIES:
+                        self._cache.popitem(last=False)
+        return has_remote
+
+    def invalidate(self, group):
+        with self._lock:
+            self._version += 1
+            self._cache.pop(group, None)
+            self._counters['invalidations'] += 1
+
+    def set_subscribed(self, subscribed):
+        """订阅建立或断开时调用：此前的条目可能错过了失效消息，全部丢弃。"""
+        with self._lock:
+            self.subscribed = subscribed
+            self._version += 1
+            self._cache.clear()
+
+    # --- pub/sub 监听 ---
+    def ensure_listener(self):
+        if self.cache_ttl <= 0:
+            return
+        if self._listener_task is not None and not self._listener_task.done():
+            return
+        self._listener_task = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _listen(self):
+        import redis.asyncio as aioredis
+
+        while True:
+            client = aioredis.Redis(connection_pool=aioredis.ConnectionPool(**self._connection_kwargs))
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(SUBSCRIBER_PRESENCE_CHANNEL)
+                logger.info(f"已订阅订阅者分布频道 '{SUBSCRIBER_PRESENCE_CHANNEL}'。")
+                self.set_subscribed(True)
+                async for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    worker_id, _sep, group = message['data'].partition(' ')
+                    if worker_id != WORKER_ID:
+                        self.invalidate(group)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"订阅者分布订阅中断: {e}，{LISTENER_RETRY_DELAY} 秒后重试。")
+                await asyncio.sleep(LISTENER_RETRY_DELAY)
+            finally:
+                if self.subscribed:
+                    self.set_subscribed(False)
+                try:
+                    await pubsub.close()
+                    await client.close()
+                except Exception:
+                    pass
+
+    async def shutdown(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._listener_task = None
+
+    def stats(self):
+        with self._lock:
+            return {'subscribed': self.subscribed, 'cached_groups': len(self._cache), **self._counters}
+
+
+class ConversationEventDispatcher:
+    """
+    感知订阅者分布的生成事件分发器。
+    - 会话组的订阅者全部是本进程中的 ChatConsumer 时，直接调用它们的 broadcast_event，不经过 channel layer；
+    - 存在其他 worker 上的订阅者（例如另一个 worker 上打开的第二个标签页）时，照常 group_send 给整个组。
+    每个生成任务的投递路径只会从直接投递切换到 channel layer，不会切回：直接投递在返回前已交给连接发送，
+    切换之后的事件不会越过之前的事件；反过来切换时，直接投递的事件可能越过仍在 channel layer 队列中的事件，
+    客户端会把迟到的事件当作重复事件丢弃。生成任务结束（generation_end）后忘记其路径。
+    远程订阅者是否存在在每个事件写入事件日志之后检查（结果由 RedisSubscriberPresence 在本地缓存）。
+    新的订阅者先登记再从事件日志重放；登记的广播到达之前发出的事件如果既不在重放中也没有经过 channel layer，
+    客户端会发现序号不连续，在生成结束后从数据库同步该会话。
+    在其他事件循环中调用时使用 channel layer。
+    """
+
+    def __init__(self, presence):
+        self._presence = presence
+        self._local = {}  # group -> {consumer: 事件循环}
+        self._channel_layer_generations = set()  # 已经改走 channel layer 的生成任务
+        self._lock = threading.Lock()
+        self._counters = {'local': 0, 'channel_layer': 0}
+
+    async def subscribe(self, group, consumer):
+        with self._lock:
+            self._local.setdefault(group, {})[consumer] = asyncio.get_running_loop()
+        if self._presence is not None:
+            try:
+                await self._presence.add(group, consumer.channel_name)
+            except redis.RedisError as e:
+                logger.error(f"登记会话组 {group} 的订阅者失败: {e}")
+
+    async def unsubscribe(self, group, consumer):
+        with self._lock:
+            consumers = self._local.get(group)
+            if consumers is not None:
+                consumers.pop(consumer, None)
+                if not consumers:
+                    del self._local[group]
+        if self._presence is not None:
+            try:
+                await self._presence.remove(group, consumer.channel_name)
+            except redis.RedisError as e:
+                logger.error(f"注销会话组 {group} 的订阅者失败: {e}")
+
+    def _local_consumers(self, group):
+        """返回可以直接投递的本地订阅者；有订阅者不在当前事件循环中时返回 None。"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            consumers = self._local.get(group)
+            if not consumers or any(consumer_loop is not loop for consumer_loop in consumers.values()):
+                return None
+            return list(consumers)
+
+    async def _has_remote(self, group, channel_layer):
+        if isinstance(channel_layer, InMemoryChannelLayer):
+            # 进程内的 channel layer 本来就无法送达其他 worker
+            return False
+        if self._presence is None:
+            return True
+        try:
+            return await self._presence.has_remote(group)
+        except redis.RedisError as e:
+            logger.error(f"查询会话组 {group} 的订阅者失败，改用 channel layer: {e}")
+            return True
+
+    async def _use_local(self, group, generation_id, channel_layer):
+        """决定本事件的投递路径，返回本地订阅者列表；应改走 channel layer 时返回 None。"""
+        if generation_id in self._channel_layer_generations:
+            return None
+        consumers = self._local_consumers(group)
+        if consumers and not await self._has_remote(group, channel_layer):
+            return consumers
+        if generation_id is not None:
+            self._channel_layer_generations.add(generation_id)
+        return None
+
+    async def dispatch(self, conversation_id, event_type, data):
+        group = f'chat_{conversation_id}'
+        message = {'type': 'broadcast_event', 'event': {'type': event_type, 'data': data}}
+        channel_layer = get_channel_layer()
+        generation_id = data.get('generation_id')
+        try:
+            consumers = await self._use_local(group, generation_id, channel_layer)
+            if consumers is not None:
+                for consumer in consumers:
+                    try:
+                        await consumer.broadcast_event(message)
+                    except Exception as e:
+                        logger.warning(f"向本地订阅者 {consumer.channel_name} 投递 {event_type} 失败: {e}")
+                self._counters['local'] += 1
+                return
+            await channel_layer.group_send(group, message)
+            self._counters['channel_layer'] += 1
+        finally:
+            if event_type == 'generation_end':
+                self._channel_layer_generations.discard(generation_id)
+
+    async def shutdown(self):
+        if self._presence is not None:
+            await self._presence.shutdown()
+
+    def stats(self):
+        with self._lock:
+            local_subscribers = sum(len(consumers) for consumers in self._local.values())
+        stats = {'local_subscribers': local_subscribers, 'channel_layer_generations': len(self._channel_layer_generations), **self._counters}
+        if self._presence is not None:
+            stats['presence'] = self._presence.stats()
+        return stats
+
+
+# --- 工厂和单例实例 ---
+def _get_presence_instance():
+    # 与事件日志一样跟随停止请求缓存的后端：Redis 可用时记录订阅者分布，否则无法判断，有远程订阅者的可能时始终走 channel layer
+    if isinstance(stop_request_manager, RedisCache):
+        return RedisSubscriberPresence(stop_request_manager.connection_kwargs)
+    return None
+
+
+# 进程级单例
+event_dispatcher = ConversationEventDispatcher(_get_presence_instance())
@@ -0,0 +1,521 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+
+import redis
+
+from .state_utils import RedisCache, SharedMemoryCache, stop_request_manager
+
+logger = logging.getLogger(__name__)
+
+# --- 事件日志配置 ---
+# 每个生成任务最多保留的事件数量
+try:
+    EVENT_LOG_MAX_EVENTS = int(os.getenv('EVENT_LOG_MAX_EVENTS', '2000'))
+except (ValueError, TypeError):
+    EVENT_LOG_MAX_EVENTS = 2000
+
+# 事件日志在最后一次写入后的保留时间（秒）
+try:
+    EVENT_LOG_TTL = int(os.getenv('EVENT_LOG_TTL', '600'))
+except (ValueError, TypeError):
+    EVENT_LOG_TTL = 600
+
+# 内存和共享内存模式下最多保留的生成任务数量
+try:
+    EVENT_LOG_MAX_GENERATIONS = int(os.getenv('EVENT_LOG_MAX_GENERATIONS', '1000'))
+except (ValueError, TypeError):
+    EVENT_LOG_MAX_GENERATIONS = 1000
+
+# 共享内存模式下事件日志文件所在的目录，同一主机上的所有 worker 必须使用相同的目录
+EVENT_LOG_SHM_DIR = os.getenv('EVENT_LOG_SHM_DIR') or os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'my-chatbox-events'
+)
+
+# 共享内存模式下等待其他 worker 写入的事件时，检查日志文件的间隔（秒）
+try:
+    EVENT_LOG_SHM_POLL_INTERVAL = float(os.getenv('EVENT_LOG_SHM_POLL_INTERVAL', '0.2'))
+except (ValueError, TypeError):
+    EVENT_LOG_SHM_POLL_INTERVAL = 0.2
+
+# 共享内存模式下清理过期日志文件的间隔（秒）
+EVENT_LOG_SHM_SWEEP_INTERVAL = 60
+
+
+class GenerationEventLog(ABC):
+    """
+    按生成任务记录事件的、有界且带 TTL 的追加日志。
+    每个事件带有从 1 开始递增的序号 (seq)，断线重连的客户端可以凭 (generation_id, last_seq)
+    只重放错过的事件。返回的事件格式为 {'type': ..., 'data': {..., 'seq': n}}。
+    日志超过 EVENT_LOG_MAX_EVENTS 条时丢弃最早的事件，重放方用 find_gap() 发现并告知客户端。
+    """
+
+    @abstractmethod
+    def append(self, generation_id, conversation_id, event_type, data):
+        """追加一个事件，返回其序号；无法分配序号（后端不可用）时返回 None。"""
+
+    @abstractmethod
+    def read_since(self, generation_id, last_seq=0):
+        """返回序号大于 last_seq 的所有事件。"""
+
+    @abstractmethod
+    async def await_for_events(self, generation_id, last_seq, timeout):
+        """在事件循环中等待序号大于 last_seq 的事件（最多 timeout 秒），返回事件列表（可能为空）。"""
+
+    @abstractmethod
+    def get_conversation_id(self, generation_id):
+        """返回事件日志所属的会话ID，日志不存在时返回 None。"""
+
+    async def aappend(self, generation_id, conversation_id, event_type, data):
+        return self.append(generation_id, conversation_id, event_type, data)
+
+    async def aread_since(self, generation_id, last_seq=0):
+        return self.read_since(generation_id, last_seq)
+
+    async def aget_conversation_id(self, generation_id):
+        return self.get_conversation_id(generation_id)
+
+
+def find_gap(generation_id, last_seq, events):
+    """
+    读到的第一个事件与 last_seq 不连续（其间的事件已被截断）时，返回告知客户端的 generation_gap 事件，否则返回 None。
+    客户端收到后在生成结束时从数据库同步该会话（sync_conversation_api）。
+    """
+    if events and events[0]['data']['seq'] > last_seq + 1:
+        return {'type': 'generation_gap', 'data': {
+            'generation_id': str(generation_id), 'last_seq': last_seq, 'first_seq': events[0]['data']['seq'],
+        }}
+    return None
+
+
+# --- 本进程内的等待者 ---
+class _LocalWaiters:
+    """本进程中等待某个生成任务新事件的协程，可能属于不同的事件循环；写入方可以在任意线程中唤醒它们。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}  # generation_id -> {(事件循环, asyncio.Event)}
+
+    def wake(self, key):
+        with self._lock:
+            waiters = list(self._waiters.get(key, ()))
+        # 写入者可能在工作线程中（HTTP 回退路径），通过各等待者所在的事件循环唤醒它们
+        for loop, woken in waiters:
+            try:
+                loop.call_soon_threadsafe(woken.set)
+            except RuntimeError:
+                pass  # 等待者的事件循环已关闭
+
+    async def wait(self, key, read, timeout, poll_interval=None):
+        """反复调用 read() 直到返回事件或超时；poll_interval 不为 None 时即使没有被唤醒也按该间隔重新读取。"""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        deadline = loop.time() + timeout
+        with self._lock:
+            self._waiters.setdefault(key, set()).add(waiter)
+        try:
+            while True:
+                # 先清除再读取：读取之后的写入一定会重新唤醒
+                waiter[1].clear()
+                events = read()
+                remaining = deadline - loop.time()
+                if events or remaining <= 0:
+                    return events
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining if poll_interval is None else min(remaining, poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(key)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters[key]
+
+
+# --- 内存实现 ---
+class _RingBuffer:
+    __slots__ = ('conversation_id', 'events', 'next_seq', 'expires_at')
+
+    def __init__(self, conversation_id, max_events):
+        self.conversation_id = str(conversation_id)
+        self.events = deque(maxlen=max_events)
+        self.next_seq = 1
+        self.expires_at = 0
+
+
+class InMemoryEventLog(GenerationEventLog):
+    """使用环形缓冲区的内存事件日志（仅在单进程内有效）。"""
+
+    def __init__(self, max_events=EVENT_LOG_MAX_EVENTS, clock=time.monotonic):
+        self.max_events = max_events
+        self._logs = OrderedDict()
+        self._lock = threading.Lock()
+        self._waiters = _LocalWaiters()
+        self._clock = clock
+
+    def _get_live(self, generation_id):
+        ring = self._logs.get(str(generation_id))
+        if ring is not None and ring.expires_at <= self._clock():
+            del self._logs[str(generation_id)]
+            return None
+        return ring
+
+    def _evict(self):
+        now = self._clock()
+        while self._logs:
+            oldest_id, oldest = next(iter(self._logs.items()))
+            if len(self._logs) <= EVENT_LOG_MAX_GENERATIONS and oldest.expires_at > now:
+                break
+            del self._logs[oldest_id]
+
+    def append(self, generation_id, conversation_id, event_type, data):
+        key = str(generation_id)
+        with self._lock:
+            ring = self._get_live(key)
+            if ring is None:
+                ring = _RingBuffer(conversation_id, self.max_events)
+                self._logs[key] = ring
+            else:
+                self._logs.move_to_end(key)
+            seq = ring.next_seq
+            ring.next_seq += 1
+            ring.events.append({'type': event_type, 'data': {**data, 'seq': seq}})
+            ring.expires_at = self._clock() + EVENT_LOG_TTL
+            self._evict()
+        self._waiters.wake(key)
+        return seq
+
+    def read_since(self, generation_id, last_seq=0):
+        with self._lock:
+            ring = self._get_live(generation_id)
+            if ring is None:
+                return []
+            return [event for event in ring.events if event['data']['seq'] > last_seq]
+
+    async def await_for_events(self, generation_id, last_seq, timeout):
+        key = str(generation_id)
+        return await self._waiters.wait(key, lambda: self.read_since(key, last_seq), timeout)
+
+    def get_conversation_id(self, generation_id):
+        with self._lock:
+            ring = self._get_live(generation_id)
+            return ring.conversation_id if ring else None
+
+
+# --- 共享内存实现 ---
+class SharedFileEventLog(GenerationEventLog):
+    """
+    共享内存模式下的事件日志：每个生成任务一个只追加的文件（默认位于 /dev/shm），同一主机上的任意 worker 都可以重放和续传。
+    - 文件第一行记录所属的会话，之后每行一个事件，格式为 "<seq>\t<JSON>"，按序号过滤时无需解析 JSON；
+    - 生成任务只在一个 worker 中运行，序号由该 worker 在进程内分配，每个事件以一次 write 追加，读者忽略不完整的最后一行；
+    - 超过 max_events 条时把文件压缩为最近的一半（写入临时文件后原子替换），被丢弃的部分由 find_gap() 报告；
+    - 文件的修改时间即最后一次写入的时间，超过 EVENT_LOG_TTL 秒视为过期；写入方定期删除过期的文件，
+      以及超过 EVENT_LOG_MAX_GENERATIONS 个的最旧文件；
+    - 本 worker 写入的事件立即唤醒等待者，其他 worker 写入的事件每隔 poll_interval 秒检查一次。
+    """
+
+    def __init__(self, directory=EVENT_LOG_SHM_DIR, max_events=EVENT_LOG_MAX_EVENTS,
+                 poll_interval=EVENT_LOG_SHM_POLL_INTERVAL, clock=time.time):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.directory = directory
+        self.max_events = max_events
+        self.poll_interval = poll_interval
+        self._clock = clock  # 墙上时间，与文件的修改时间比较
+        self._lock = threading.Lock()
+        self._writers = OrderedDict()  # generation_id -> [下一个序号, 文件中的事件数]
+        self._waiters = _LocalWaiters()
+        self._last_sweep = 0
+
+    def _path(self, generation_id):
+        # generation_id 来自客户端，文件名使用其摘要，不直接拼接到路径中
+        digest = hashlib.blake2b(str(generation_id).encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.directory, f"{digest}.log")
+
+    def _expired(self, mtime):
+        return mtime + EVENT_LOG_TTL <= self._clock()
+
+    def _touch(self, path):
+        now = self._clock()
+        os.utime(path, (now, now))
+
+    @staticmethod
+    def _parse(lines, last_seq):
+        """解析完整的事件行（不含文件头），返回序号大于 last_seq 的事件。"""
+        events = []
+        for line in lines.split(b'\n')[:-1]:
+            seq, _sep, payload = line.partition(b'\t')
+            if int(seq) > last_seq:
+                events.append(json.loads(payload))
+        return events
+
+    def _load(self, path):
+        """返回 (会话ID, 文件内容中的事件部分)；文件不存在、已过期或文件头尚未写完时返回 None。"""
+        try:
+            with open(path, 'rb') as f:
+                if self._expired(os.fstat(f.fileno()).st_mtime):
+                    return None
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        header, sep, body = content.partition(b'\n')
+        if not sep:
+            return None
+        # 最后一行可能尚未写完，只保留完整的行
+        return json.loads(header)['c'], body[:body.rfind(b'\n') + 1]
+
+    def _writer_state(self, key, path, conversation_id):
+        state = self._writers.get(key)
+        if state is not None and os.path.exists(path):
+            self._writers.move_to_end(key)
+            return state
+        loaded = self._load(path)
+        if loaded is None:
+            with open(path, 'wb') as f:
+                f.write(json.dumps({'c': str(conversation_id)}).encode('utf-8') + b'\n')
+            state = [1, 0]
+        else:
+            # 本 worker 的写入状态已被淘汰而文件仍在：接着文件中最后一个序号继续
+            events = self._parse(loaded[1], 0)
+            state = [events[-1]['data']['seq'] + 1 if events else 1, len(events)]
+        self._writers[key] = state
+        while len(self._writers) > EVENT_LOG_MAX_GENERATIONS:
+            self._writers.popitem(last=False)
+        return state
+
+    def _compact(self, path, state):
+        """只保留最近一半的事件：写入临时文件后原子替换，正在读取旧文件的读者不受影响。"""
+        with open(path, 'rb') as f:
+            header, _sep, body = f.read().partition(b'\n')
+        lines = body.split(b'\n')[:-1][-max(self.max_events // 2, 1):]
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(header + b'\n' + b''.join(line + b'\n' for line in lines))
+        self._touch(temp_path)
+        os.replace(temp_path, path)
+        state[1] = len(lines)
+
+    def sweep(self):
+        """删除过期的日志文件，以及超过 EVENT_LOG_MAX_GENERATIONS 个的最旧文件。"""
+        live = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    mtime = entry.stat().st_mtime
+                    if self._expired(mtime):
+                        os.unlink(entry.path)
+                    elif entry.name.endswith('.log'):
+                        live.append((mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+        live.sort()
+        for _mtime, path in live[:max(len(live) - EVENT_LOG_MAX_GENERATIONS, 0)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def append(self, generation_id, conversation_id, event_type, data):
+        key = str(generation_id)
+        path = self._path(key)
+        try:
+            with self._lock:
+                state = self._writer_state(key, path, conversation_id)
+                seq = state[0]
+                line = json.dumps({'type': event_type, 'data': {**data, 'seq': seq}})
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+                try:
+                    os.write(fd, f"{seq}\t{line}\n".encode('utf-8'))
+                finally:
+                    os.close(fd)
+                self._touch(path)
+                state[0] += 1
+                state[1] += 1
+                if state[1] > self.max_events:
+                    self._compact(path, state)
+                if self._clock() - self._last_sweep >= EVENT_LOG_SHM_SWEEP_INTERVAL:
+                    self._last_sweep = self._clock()
+                    self.sweep()
+        except OSError as e:
+            logger.error(f"写入生成事件日志文件 '{path}' 失败: {e}")
+            return None
+        self._waiters.wake(key)
+        return seq
+
+    def read_since(self, generation_id, last_seq=0):
+        loaded = self._load(self._path(generation_id))
+        return self._parse(loaded[1], last_seq) if loaded else []
+
+    async def await_for_events(self, generation_id, last_seq, timeout):
+        key = str(generation_id)
+        path = self._path(key)
+        cursor = {'inode': None, 'size': 0}
+
+        def read_if_changed():
+            # 文件没有变化时不重新读取；压缩会替换文件（inode 变化），此时重新读取整个文件
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return []
+            if (stat.st_ino, stat.st_size) == (cursor['inode'], cursor['size']):
+                return []
+            cursor['inode'], cursor['size'] = stat.st_ino, stat.st_size
+            return self.read_since(key, last_seq)
+
+        return await self._waiters.wait(key, read_if_changed, timeout, self.poll_interval)
+
+    def get_conversation_id(self, generation_id):
+        loaded = self._load(self._path(generation_id))
+        return loaded[0] if loaded else None
+
+
+# --- Redis 实现 ---
+class RedisStreamEventLog(GenerationEventLog):
+    """
+    使用 Redis Stream 的事件日志，所有 worker 共享。
+    事件以显式的 ID `0-<seq>` 写入，重放时用 XRANGE 从 last_seq 之后读取。
+    序号由 Redis 中按生成任务的计数器（INCR）分配，与事件日志同样带 TTL：
+    worker 重启或生成任务在其他 worker 上继续写入时序号仍然递增，不会与已有的条目冲突。
+    分配序号和写入条目在同一个 Lua 脚本中原子执行，每个事件只需一次往返；
+    并发的写入（如合并器的定时发送与其他事件）按分配顺序写入，不会因为到达顺序不同而被 XADD 拒绝。
+    """
+
+    KEY_PREFIX = "gen_events:"
+    SEQ_KEY_PREFIX = "gen_events_seq:"
+
+    # KEYS: 事件日志, 序号计数器; ARGV: TTL, 最大条目数, 会话ID, 事件 JSON（不含 seq）。
+    # 计数器丢失（如被 maxmemory 策略淘汰）而日志仍在时，从日志最后一个条目的序号继续
+    APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[2])
+local last = redis.call('XREVRANGE', KEYS[1], '+', '-', 'COUNT', 1)[1]
+if last then
+    local last_seq = tonumber(string.match(last[1], '%-(%d+)$'))
+    if last_seq >= seq then
+        seq = last_seq + 1
+        redis.call('SET', KEYS[2], seq)
+    end
+end
+redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '0-' .. seq, 'c', ARGV[3], 'e', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return seq
+"""
+
+    def __init__(self, connection_kwargs):
+        self._connection_kwargs = connection_kwargs
+        self.client = redis.Redis(connection_pool=redis.ConnectionPool(**connection_kwargs))
+        self._append_script = self.client.register_script(self.APPEND_SCRIPT)
+        self._async_client = None
+        self._async_append_script = None
+
+    def _key(self, generation_id):
+        return f"{self.KEY_PREFIX}{generation_id}"
+
+    def _seq_key(self, generation_id):
+        return f"{self.SEQ_KEY_PREFIX}{generation_id}"
+
+    def _get_async_client(self):
+        if self._async_client is None:
+            import redis.asyncio as aioredis
+            self._async_client = aioredis.Redis(connection_pool=aioredis.ConnectionPool(**self._connection_kwargs))
+            self._async_append_script = self._async_client.register_script(self.APPEND_SCRIPT)
+        return self._async_client
+
+    def _script_args(self, generation_id, conversation_id, event_type, data):
+        keys = [self._key(generation_id), self._seq_key(generation_id)]
+        args = [EVENT_LOG_TTL, EVENT_LOG_MAX_EVENTS, str(conversation_id), json.dumps({'type': event_type, 'data': data})]
+        return keys, args
+
+    @staticmethod
+    def _parse(entries):
+        events = []
+        for entry_id, fields in entries:
+            event = json.loads(fields['e'])
+            # 序号即条目 ID 的第二部分
+            event['data']['seq'] = int(entry_id.rpartition('-')[2])
+            events.append(event)
+        return events
+
+    def append(self, generation_id, conversation_id, event_type, data):
+        keys, args = self._script_args(generation_id, conversation_id, event_type, data)
+        try:
+            return int(self._append_script(keys=keys, args=args))
+        except redis.RedisError as e:
+            logger.error(f"写入生成事件日志 '{keys[0]}' 失败: {e}")
+            return None
+
+    async def aappend(self, generation_id, conversation_id, event_type, data):
+        keys, args = self._script_args(generation_id, conversation_id, event_type, data)
+        try:
+            self._get_async_client()
+            return int(await self._async_append_script(keys=keys, args=args))
+        except redis.RedisError as e:
+            logger.error(f"写入生成事件日志 '{keys[0]}' 失败: {e}")
+            return None
+
+    def read_since(self, generation_id, last_seq=0):
+        try:
+            return self._parse(self.client.xrange(self._key(generation_id), min=f"0-{int(last_seq) + 1}"))
+        except redis.RedisError as e:
+            logger.error(f"读取生成事件日志失败: {e}")
+            return []
+
+    async def aread_since(self, generation_id, last_seq=0):
+        try:
+            entries = await self._get_async_client().xrange(self._key(generation_id), min=f"0-{int(last_seq) + 1}")
+            return self._parse(entries)
+        except redis.RedisError as e:
+            logger.error(f"读取生成事件日志失败: {e}")
+            return []
+
+    async def await_for_events(self, generation_id, last_seq, timeout):
+        key = self._key(generation_id)
+        try:
+            result = await self._get_async_client().xread({key: f"0-{int(last_seq)}"}, block=max(int(timeout * 1000), 1))
+        except redis.RedisError as e:
+            logger.error(f"等待生成事件日志失败: {e}")
+            return []
+        if not result:
+            return []
+        return self._parse(result[0][1])
+
+    def get_conversation_id(self, generation_id):
+        try:
+            entries = self.client.xrange(self._key(generation_id), count=1)
+        except redis.RedisError as e:
+            logger.error(f"读取生成事件日志失败: {e}")
+            return None
+        return entries[0][1].get('c') if entries else None
+
+    async def aget_conversation_id(self, generation_id):
+        try:
+            entries = await self._get_async_client().xrange(self._key(generation_id), count=1)
+        except redis.RedisError as e:
+            logger.error(f"读取生成事件日志失败: {e}")
+            return None
+        return entries[0][1].get('c') if entries else None
+
+
+# --- 工厂和单例实例 ---
+def _get_event_log_instance():
+    # 与停止请求缓存使用同一个后端：Redis 可用时使用 Redis Stream，共享内存模式下使用同一主机上共享的日志文件，
+    # 否则回退到内存环形缓冲区
+    if isinstance(stop_request_manager, RedisCache):
+        return RedisStreamEventLog(stop_request_manager.connection_kwargs)
+    if isinstance(stop_request_manager, SharedMemoryCache):
+        try:
+            return SharedFileEventLog()
+        except OSError as e:
+            logger.warning(f"无法创建共享事件日志目录 ({e})。回退到内存事件日志，续传只能在同一个 worker 上进行。")
+    return InMemoryEventLog()
+
+
+generation_event_log = _get_event_log_instance()
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import os
+import threading
+
+from .cancellation import cancellation_registry
+
+logger = logging.getLogger(__name__)
+
+# --- 后台生成配置 ---
+# 分离模式：客户端断开连接后生成任务继续运行并保存结果，之后的订阅者可以重新接入。
+# 设置为 false 时，发起生成的连接断开后会请求停止该生成任务。
+GENERATION_DETACHED = os.getenv('GENERATION_DETACHED', 'true').lower() == 'true'
+
+# worker 关闭时等待进行中的生成任务完成的最长时间（秒），超时后取消
+try:
+    GENERATION_SHUTDOWN_GRACE = int(os.getenv('GENERATION_SHUTDOWN_GRACE', '30'))
+except (ValueError, TypeError):
+    GENERATION_SHUTDOWN_GRACE = 30
+
+
+class GenerationManager:
+    """
+    worker 级的生成任务管理器。
+    生成任务（WebSocket 路径的协程和 HTTP 回退路径的线程）由管理器而不是连接持有，
+    连接断开不会影响任务的运行；任务的事件通过 event_log 和 channel layer 发布，
+    任何订阅者都可以随时接入。
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    # --- 启动任务 ---
+    def start(self, generation_id, coro):
+        """在当前事件循环中启动一个生成协程，并由管理器持有其引用。"""
+        key = str(generation_id)
+        task = asyncio.get_running_loop().create_task(coro)
+        with self._lock:
+            self._tasks[key] = task
+        task.add_done_callback(lambda t: self._on_done(self._tasks, key, t))
+        return task
+
+    def submit(self, generation_id, fn, /, *args, **kwargs):
+        """将同步的生成函数提交到 HTTP 工作线程池中运行。"""
+        from .services import http_worker_pool
+        key = str(generation_id)
+        future = http_worker_pool.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._futures[key] = future
+        future.add_done_callback(lambda f: self._on_done(self._futures, key, f))
+        return future
+
+    def _on_done(self, registry, key, task_or_future):
+        with self._lock:
+            if registry.get(key) is task_or_future:
+                del registry[key]
+        if task_or_future.cancelled():
+            return
+        error = task_or_future.exception()
+        if error is not None:
+            logger.error(f"GenerationManager: 生成任务 {key} 异常结束: {error}", exc_info=error)
+
+    # --- 查询 ---
+    def is_running(self, generation_id):
+        key = str(generation_id)
+        with self._lock:
+            return key in self._tasks or key in self._futures
+
+    def active_count(self):
+        with self._lock:
+            return len(self._tasks) + len(self._futures)
+
+    # --- 连接断开 ---
+    async def detach(self, generation_ids):
+        """发起生成的连接断开时调用：分离模式下任务继续运行，否则请求停止仍在运行的任务。"""
+        if GENERATION_DETACHED:
+            return
+        for generation_id in generation_ids:
+            if self.is_running(generation_id):
+                logger.info(f"GenerationManager: 连接已断开，停止生成任务 {generation_id}。")
+                await cancellation_registry.request_stop(generation_id)
+
+    def detach_sync(self, generation_ids):
+        if GENERATION_DETACHED:
+            return
+        for generation_id in generation_ids:
+            if self.is_running(generation_id):
+                logger.info(f"GenerationManager: 连接已断开，停止生成任务 {generation_id}。")
+                cancellation_registry.request_stop_sync(generation_id)
+
+    # --- 关闭 ---
+    async def shutdown(self, grace=None):
+        """等待本事件循环中的生成任务完成（最多 grace 秒），超时后取消剩余任务。"""
+        grace = GENERATION_SHUTDOWN_GRACE if grace is None else grace
+        with self._lock:
+            tasks = list(self._tasks.values())
+        if tasks:
+            logger.info(f"GenerationManager: 等待 {len(tasks)} 个进行中的生成任务完成（最多 {grace} 秒）。")
+            _done, pending = await asyncio.wait(tasks, timeout=grace)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning(f"GenerationManager: 已取消 {len(pending)} 个未能在关闭前完成的生成任务。")
+                await asyncio.gather(*pending, return_exceptions=True)
+        with self._lock:
+            running_threads = len(self._futures)
+        if running_threads:
+            logger.warning(f"GenerationManager: 仍有 {running_threads} 个 HTTP 生成线程在运行。")
+
+
+# 进程级单例
+generation_manager = GenerationManager()
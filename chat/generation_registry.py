@@ -0,0 +1,350 @@
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import redis
+
+from .state_utils import RedisCache, SharedMemoryCache, stop_request_manager
+
+logger = logging.getLogger(__name__)
+
+# --- 生成任务注册表配置 ---
+# 注册表条目的保留时间（秒）：正常情况下生成结束时立即删除，TTL 只用于清理崩溃的 worker 遗留的条目
+try:
+    GENERATION_REGISTRY_TTL = int(os.getenv('GENERATION_REGISTRY_TTL', '1800'))
+except (ValueError, TypeError):
+    GENERATION_REGISTRY_TTL = 1800
+
+# 是否同时把进行中的生成任务写入 Conversation.current_generation_id（用于排查崩溃现场，默认关闭）
+GENERATION_REGISTRY_DB_MIRROR = os.getenv('GENERATION_REGISTRY_DB_MIRROR', 'false').lower() in ('1', 'true', 'yes')
+
+# 共享内存模式下注册表文件的路径；同一主机上的所有 worker 必须使用同一路径
+GENERATION_REGISTRY_SHM_PATH = os.getenv('GENERATION_REGISTRY_SHM_PATH') or os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'my-chatbox-generations'
+)
+
+# 共享内存模式下注册表的槽位数量（每个槽位 24 + GENERATION_REGISTRY_SHM_VALUE_BYTES 字节），应明显大于同时进行生成的会话数量
+try:
+    GENERATION_REGISTRY_SHM_SLOTS = int(os.getenv('GENERATION_REGISTRY_SHM_SLOTS', '4096'))
+except (ValueError, TypeError):
+    GENERATION_REGISTRY_SHM_SLOTS = 4096
+
+# 共享内存注册表中每个条目（JSON）最多占用的字节数
+GENERATION_REGISTRY_SHM_VALUE_BYTES = 256
+
+# 本 worker 的标识，记录在条目中
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _mirror_start(conversation_id, generation_id):
+    from .models import Conversation
+    Conversation.objects.filter(id=conversation_id).update(current_generation_id=generation_id)
+
+
+def _mirror_finish(conversation_id, generation_id):
+    from .models import Conversation
+    # 只清除仍指向本生成任务的记录，一条 UPDATE 完成比较和清除
+    return Conversation.objects.filter(id=conversation_id, current_generation_id=generation_id).update(current_generation_id=None)
+
+
+def _db_current_generation_id(conversation_id):
+    from .models import Conversation
+    return Conversation.objects.filter(id=conversation_id).values_list('current_generation_id', flat=True).first()
+
+
+class GenerationRegistry(ABC):
+    """
+    会话 -> 进行中生成任务的临时注册表，代替每次生成时对 Conversation.current_generation_id 的两次数据库写入。
+    条目格式为 {'generation_id', 'conversation_id', 'worker', 'started_at', 'model_id'}，
+    带 TTL；生成结束时只删除仍属于该生成任务的条目（同一会话的新任务可能已经覆盖了它）。
+    GENERATION_REGISTRY_DB_MIRROR 开启时，同时把生成任务ID写入数据库，供崩溃后排查。
+    """
+
+    # 注册表本身就是数据库时不再镜像
+    stored_in_db = False
+
+    @abstractmethod
+    def _put(self, conversation_id, entry):
+        pass
+
+    @abstractmethod
+    def _remove_if(self, conversation_id, generation_id):
+        """条目仍属于 generation_id 时删除，返回是否删除。"""
+
+    @abstractmethod
+    def get(self, conversation_id):
+        """返回会话进行中的生成任务条目，没有时返回 None。"""
+
+    async def _aput(self, conversation_id, entry):
+        self._put(conversation_id, entry)
+
+    async def _aremove_if(self, conversation_id, generation_id):
+        return self._remove_if(conversation_id, generation_id)
+
+    async def aget(self, conversation_id):
+        return self.get(conversation_id)
+
+    @staticmethod
+    def _entry(conversation_id, generation_id, model_id):
+        return {
+            'generation_id': str(generation_id),
+            'conversation_id': str(conversation_id),
+            'worker': WORKER_ID,
+            'started_at': time.time(),
+            'model_id': model_id,
+        }
+
+    # --- 同步接口（线程化的 HTTP 路径） ---
+    def start(self, conversation_id, generation_id, model_id=None):
+        self._put(str(conversation_id), self._entry(conversation_id, generation_id, model_id))
+        if GENERATION_REGISTRY_DB_MIRROR and not self.stored_in_db:
+            _mirror_start(conversation_id, generation_id)
+
+    def finish(self, conversation_id, generation_id):
+        self._remove_if(str(conversation_id), str(generation_id))
+        if GENERATION_REGISTRY_DB_MIRROR and not self.stored_in_db:
+            _mirror_finish(conversation_id, generation_id)
+
+    def current_generation_id(self, conversation_id):
+        entry = self.get(str(conversation_id))
+        return entry['generation_id'] if entry else None
+
+    # --- 异步接口（WebSocket 路径） ---
+    async def astart(self, conversation_id, generation_id, model_id=None):
+        await self._aput(str(conversation_id), self._entry(conversation_id, generation_id, model_id))
+        if GENERATION_REGISTRY_DB_MIRROR and not self.stored_in_db:
+            from channels.db import database_sync_to_async
+            await database_sync_to_async(_mirror_start)(conversation_id, generation_id)
+
+    async def afinish(self, conversation_id, generation_id):
+        await self._aremove_if(str(conversation_id), str(generation_id))
+        if GENERATION_REGISTRY_DB_MIRROR and not self.stored_in_db:
+            from channels.db import database_sync_to_async
+            await database_sync_to_async(_mirror_finish)(conversation_id, generation_id)
+
+    async def acurrent_generation_id(self, conversation_id):
+        entry = await self.aget(str(conversation_id))
+        return entry['generation_id'] if entry else None
+
+
+# --- 内存实现 ---
+class InMemoryGenerationRegistry(GenerationRegistry):
+    """进程内的注册表，用于内存模式（单进程部署，所有连接都由同一个 worker 处理）。"""
+
+    def __init__(self, clock=time.monotonic):
+        self._entries = {}  # conversation_id -> (条目, 过期时间)
+        self._lock = threading.Lock()
+        self._clock = clock
+
+    def _put(self, conversation_id, entry):
+        with self._lock:
+            self._entries[conversation_id] = (entry, self._clock() + GENERATION_REGISTRY_TTL)
+
+    def _remove_if(self, conversation_id, generation_id):
+        with self._lock:
+            item = self._entries.get(conversation_id)
+            if item is None or item[0]['generation_id'] != generation_id:
+                return False
+            del self._entries[conversation_id]
+            return True
+
+    def get(self, conversation_id):
+        with self._lock:
+            item = self._entries.get(conversation_id)
+            if item is None:
+                return None
+            if item[1] <= self._clock():
+                del self._entries[conversation_id]
+                return None
+            return item[0]
+
+
+# --- 共享内存实现 ---
+class SharedMemoryGenerationRegistry(GenerationRegistry):
+    """
+    使用同一主机上所有 worker 共享的内存映射哈希表（与共享内存停止标志表结构相同，见 shared_stop_table）的注册表，
+    用于共享内存模式：另一个 worker 上的重连和续传请求也能找到进行中的生成任务，不需要写数据库。
+    条目以 JSON 保存在槽位的定长值中，比较和删除在同一次加锁内完成。
+    """
+
+    def __init__(self, path=GENERATION_REGISTRY_SHM_PATH, slots=GENERATION_REGISTRY_SHM_SLOTS, clock=time.monotonic):
+        from .shared_stop_table import SharedStopTable
+
+        self._table = SharedStopTable(path, slots, clock=clock, value_size=GENERATION_REGISTRY_SHM_VALUE_BYTES)
+        logger.info(f"正在为生成任务注册表使用共享内存表: {self._table.path}（{self._table.slots} 个槽位）。")
+
+    def _encode(self, entry):
+        value = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+        if len(value) > self._table.value_size:
+            # 主机名过长时省略 worker 标识，其余字段长度有限
+            value = json.dumps({**entry, 'worker': None}, separators=(',', ':')).encode('utf-8')
+        return value
+
+    def _put(self, conversation_id, entry):
+        if self._table.set(conversation_id, GENERATION_REGISTRY_TTL, self._encode(entry)):
+            logger.warning("共享生成任务注册表的探测窗口已满，淘汰了最早过期的条目。考虑增大 GENERATION_REGISTRY_SHM_SLOTS。")
+
+    def _remove_if(self, conversation_id, generation_id):
+        return self._table.clear(
+            conversation_id, match=lambda value: (self._parse(value) or {}).get('generation_id') == generation_id
+        )
+
+    @staticmethod
+    def _parse(value):
+        if not value:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+
+    def get(self, conversation_id):
+        return self._parse(self._table.get_value(conversation_id))
+
+
+# --- 数据库实现 ---
+class DatabaseGenerationRegistry(GenerationRegistry):
+    """
+    使用 Conversation.current_generation_id 的注册表。无法打开共享内存注册表时作为 shm 模式的回退：
+    数据库在所有 worker 间共享，另一个 worker 上的重连和续传请求也能找到进行中的生成任务。条目只有 generation_id，没有 TTL。
+    """
+
+    stored_in_db = True
+
+    def _put(self, conversation_id, entry):
+        _mirror_start(conversation_id, entry['generation_id'])
+
+    def _remove_if(self, conversation_id, generation_id):
+        return bool(_mirror_finish(conversation_id, generation_id))
+
+    def get(self, conversation_id):
+        generation_id = _db_current_generation_id(conversation_id)
+        if generation_id is None:
+            return None
+        return {'generation_id': str(generation_id), 'conversation_id': conversation_id}
+
+    async def _aput(self, conversation_id, entry):
+        from channels.db import database_sync_to_async
+        await database_sync_to_async(self._put)(conversation_id, entry)
+
+    async def _aremove_if(self, conversation_id, generation_id):
+        from channels.db import database_sync_to_async
+        return await database_sync_to_async(self._remove_if)(conversation_id, generation_id)
+
+    async def aget(self, conversation_id):
+        from channels.db import database_sync_to_async
+        return await database_sync_to_async(self.get)(conversation_id)
+
+
+# --- Redis 实现 ---
+class RedisGenerationRegistry(GenerationRegistry):
+    """使用 Redis 字符串键（JSON 条目）的注册表，所有 worker 共享。"""
+
+    KEY_PREFIX = "active_generation:"
+
+    def __init__(self, connection_kwargs):
+        self._connection_kwargs = connection_kwargs
+        self.client = redis.Redis(connection_pool=redis.ConnectionPool(**connection_kwargs))
+        self._async_client = None
+
+    def _key(self, conversation_id):
+        return f"{self.KEY_PREFIX}{conversation_id}"
+
+    def _get_async_client(self):
+        if self._async_client is None:
+            import redis.asyncio as aioredis
+            self._async_client = aioredis.Redis(connection_pool=aioredis.ConnectionPool(**self._connection_kwargs))
+        return self._async_client
+
+    @staticmethod
+    def _parse(value):
+        if not value:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+
+    def _put(self, conversation_id, entry):
+        key = self._key(conversation_id)
+        try:
+            self.client.set(key, json.dumps(entry), ex=GENERATION_REGISTRY_TTL)
+        except redis.RedisError as e:
+            logger.error(f"写入生成任务注册表 '{key}' 失败: {e}")
+
+    async def _aput(self, conversation_id, entry):
+        key = self._key(conversation_id)
+        try:
+            await self._get_async_client().set(key, json.dumps(entry), ex=GENERATION_REGISTRY_TTL)
+        except redis.RedisError as e:
+            logger.error(f"写入生成任务注册表 '{key}' 失败: {e}")
+
+    def _remove_if(self, conversation_id, generation_id):
+        key = self._key(conversation_id)
+
+        def _compare_and_delete(pipe):
+            entry = self._parse(pipe.get(key))
+            pipe.multi()
+            if entry and entry.get('generation_id') == generation_id:
+                pipe.delete(key)
+
+        try:
+            # WATCH/MULTI：比较和删除之间条目被新的生成任务覆盖时，事务失败并重试
+            result = self.client.transaction(_compare_and_delete, key)
+            return bool(result and result[0])
+        except redis.RedisError as e:
+            logger.error(f"清除生成任务注册表 '{key}' 失败: {e}")
+            return False
+
+    async def _aremove_if(self, conversation_id, generation_id):
+        key = self._key(conversation_id)
+
+        async def _compare_and_delete(pipe):
+            entry = self._parse(await pipe.get(key))
+            pipe.multi()
+            if entry and entry.get('generation_id') == generation_id:
+                pipe.delete(key)
+
+        try:
+            result = await self._get_async_client().transaction(_compare_and_delete, key)
+            return bool(result and result[0])
+        except redis.RedisError as e:
+            logger.error(f"清除生成任务注册表 '{key}' 失败: {e}")
+            return False
+
+    def get(self, conversation_id):
+        try:
+            return self._parse(self.client.get(self._key(conversation_id)))
+        except redis.RedisError as e:
+            logger.error(f"读取生成任务注册表失败: {e}")
+            return None
+
+    async def aget(self, conversation_id):
+        try:
+            return self._parse(await self._get_async_client().get(self._key(conversation_id)))
+        except redis.RedisError as e:
+            logger.error(f"读取生成任务注册表失败: {e}")
+            return None
+
+
+# --- 工厂和单例实例 ---
+def _get_registry_instance():
+    # 与停止请求使用同一种共享方式：Redis、同一主机上的共享内存表，或者进程内（内存模式为单进程部署）
+    if isinstance(stop_request_manager, RedisCache):
+        return RedisGenerationRegistry(stop_request_manager.connection_kwargs)
+    if isinstance(stop_request_manager, SharedMemoryCache):
+        try:
+            return SharedMemoryGenerationRegistry()
+        except (ImportError, OSError, ValueError) as e:
+            # 多个 worker 的进程内状态互不可见，回退到它们共享的数据库
+            logger.warning(f"无法打开共享内存生成任务注册表 ({e})。回退到数据库。")
+            return DatabaseGenerationRegistry()
+    return InMemoryGenerationRegistry()
+
+
+generation_registry = _get_registry_instance()
@@ -0,0 +1,82 @@
+import logging
+import os
+import threading
+
+from .state_utils import DEFAULT_STOP_TTL, stop_request_manager
+
+logger = logging.getLogger(__name__)
+
+# --- 停止信号心跳配置 ---
+# 为进行中的生成任务续期停止信号 TTL 的间隔（秒）
+try:
+    STOP_HEARTBEAT_INTERVAL = float(os.getenv('STOP_HEARTBEAT_INTERVAL', '15'))
+except (ValueError, TypeError):
+    STOP_HEARTBEAT_INTERVAL = 15.0
+
+
+class StopHeartbeatService:
+    """
+    worker 级的停止信号心跳：记录本进程中所有进行中的生成任务，
+    每隔 STOP_HEARTBEAT_INTERVAL 秒用一次批量调用（Redis 模式下为一次管道往返）为它们的停止信号续期。
+    生成循环只需在开始和结束时调用 track() / untrack()，不再自行计时或访问 Redis。
+    续期在独立的守护线程中执行，WebSocket 路径和线程化的 HTTP 路径共用，不占用事件循环。
+    """
+
+    def __init__(self, cache, interval=STOP_HEARTBEAT_INTERVAL, ttl=DEFAULT_STOP_TTL):
+        self._cache = cache
+        self.interval = interval
+        self.ttl = ttl
+        self._active = {}  # generation_id -> 引用计数
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._beats = 0
+
+    def track(self, generation_id):
+        with self._lock:
+            generation_id = str(generation_id)
+            self._active[generation_id] = self._active.get(generation_id, 0) + 1
+            if self._thread is None or not self._thread.is_alive():
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self._run, name='stop-heartbeat', daemon=True)
+                self._thread.start()
+
+    def untrack(self, generation_id):
+        with self._lock:
+            generation_id = str(generation_id)
+            count = self._active.get(generation_id, 0) - 1
+            if count > 0:
+                self._active[generation_id] = count
+            else:
+                self._active.pop(generation_id, None)
+
+    def beat(self):
+        """为当前所有进行中的生成任务续期一次。"""
+        with self._lock:
+            generation_ids = list(self._active)
+        if generation_ids:
+            self._cache.touch_stop_requests(generation_ids, self.ttl)
+        self._beats += 1
+        return len(generation_ids)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                logger.error(f"StopHeartbeat: 续期停止信号失败: {e}", exc_info=True)
+
+    def stats(self):
+        with self._lock:
+            return {'active': len(self._active), 'interval': self.interval, 'beats': self._beats}
+
+    def shutdown(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        self._stop_event.set()
+        if thread is not None:
+            thread.join(timeout=5)
+
+
+# 进程级单例
+stop_heartbeat = StopHeartbeatService(stop_request_manager)
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# --- 连接池配置 ---
+# 每个 AIProvider 的最大并发连接数
+try:
+    PROVIDER_CONNECTION_LIMIT = int(os.getenv('AI_PROVIDER_CONNECTION_LIMIT', '64'))
+except (ValueError, TypeError):
+    PROVIDER_CONNECTION_LIMIT = 64
+
+# DNS 解析结果的缓存时间（秒）
+try:
+    PROVIDER_DNS_CACHE_TTL = int(os.getenv('AI_PROVIDER_DNS_CACHE_TTL', '300'))
+except (ValueError, TypeError):
+    PROVIDER_DNS_CACHE_TTL = 300
+
+# 空闲 keep-alive 连接的保留时间（秒）
+try:
+    PROVIDER_KEEPALIVE_TIMEOUT = float(os.getenv('AI_PROVIDER_KEEPALIVE_TIMEOUT', '60'))
+except (ValueError, TypeError):
+    PROVIDER_KEEPALIVE_TIMEOUT = 60.0
+
+
+class _SessionEntry:
+    """注册表中的一项：一个 ClientSession 及其元数据。"""
+
+    __slots__ = ('session', 'fingerprint', 'loop', 'in_use', 'stale')
+
+    def __init__(self, session, fingerprint, loop):
+        self.session = session
+        self.fingerprint = fingerprint
+        self.loop = loop
+        self.in_use = 0
+        self.stale = False
+
+
+class ProviderSessionRegistry:
+    """
+    进程级的 aiohttp.ClientSession 注册表，按 AIProvider 复用。
+    - 每个提供商一个带连接上限和 DNS 缓存的连接池，复用 keep-alive 连接。
+    - 当提供商的 base_url 或 api_key 变化时，旧会话在其进行中的请求结束后关闭并重建。
+    - 会话在首次使用时惰性创建，由 ASGI lifespan 统一关闭。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._retired = set()
+
+    @staticmethod
+    def _fingerprint(base_url, api_key):
+        return (base_url, api_key)
+
+    def _create_entry(self, provider_id, fingerprint, loop):
+        connector = aiohttp.TCPConnector(
+            limit=PROVIDER_CONNECTION_LIMIT,
+            limit_per_host=PROVIDER_CONNECTION_LIMIT,
+            use_dns_cache=True,
+            ttl_dns_cache=PROVIDER_DNS_CACHE_TTL,
+            keepalive_timeout=PROVIDER_KEEPALIVE_TIMEOUT,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        logger.info(f"为提供商 {provider_id} 创建了新的共享 HTTP 会话 (limit={PROVIDER_CONNECTION_LIMIT})。")
+        return _SessionEntry(session, fingerprint, loop)
+
+    def _retire(self, provider_id, entry):
+        """将会话标记为过期；没有进行中的请求时立即关闭。"""
+        entry.stale = True
+        if self._entries.get(provider_id) is entry:
+            del self._entries[provider_id]
+        if entry.in_use == 0:
+            self._schedule_close(entry)
+        else:
+            self._retired.add(entry)
+
+    def _schedule_close(self, entry):
+        self._retired.discard(entry)
+        if entry.session.closed:
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is entry.loop:
+            running_loop.create_task(entry.session.close())
+        elif not entry.loop.is_closed():
+            entry.loop.call_soon_threadsafe(lambda: entry.loop.create_task(entry.session.close()))
+
+    def _acquire_entry(self, provider_id, base_url, api_key):
+        loop = asyncio.get_running_loop()
+        fingerprint = self._fingerprint(base_url, api_key)
+        entry = self._entries.get(provider_id)
+        if entry is not None:
+            if entry.loop is not loop or entry.session.closed:
+                self._retire(provider_id, entry)
+                entry = None
+            elif entry.fingerprint != fingerprint:
+                logger.info(f"提供商 {provider_id} 的连接配置已变更，重建共享 HTTP 会话。")
+                self._retire(provider_id, entry)
+                entry = None
+        if entry is None:
+            entry = self._create_entry(provider_id, fingerprint, loop)
+            self._entries[provider_id] = entry
+        return entry
+
+    @asynccontextmanager
+    async def session_for(self, provider_id, base_url, api_key):
+        """
+        获取指定提供商的共享会话。
+        用法: async with provider_sessions.session_for(...) as session: ...
+        """
+        entry = self._acquire_entry(provider_id, base_url, api_key)
+        entry.in_use += 1
+        try:
+            yield entry.session
+        finally:
+            entry.in_use -= 1
+            if entry.stale and entry.in_use == 0:
+                self._schedule_close(entry)
+
+    def invalidate(self, provider_id):
+        """
+        使本 worker 中某个提供商的会话失效（提供商被修改或删除时），下次使用时重建。
+        可以在任意线程中调用（管理接口是同步视图），实际的注销在会话所属的事件循环中进行。
+        其他 worker 的会话在下次使用时按 base_url / api_key 的指纹判断是否需要重建。
+        """
+        entry = self._entries.get(provider_id)
+        if entry is None:
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is entry.loop:
+            self._retire(provider_id, entry)
+        elif not entry.loop.is_closed():
+            entry.loop.call_soon_threadsafe(self._retire, provider_id, entry)
+
+    async def startup(self):
+        logger.info("共享 HTTP 会话注册表已就绪。")
+
+    async def close_all(self):
+        """关闭所有会话，在 worker 关闭时调用。"""
+        entries = list(self._entries.values()) + list(self._retired)
+        self._entries.clear()
+        self._retired.clear()
+        loop = asyncio.get_running_loop()
+        for entry in entries:
+            if entry.loop is loop and not entry.session.closed:
+                await entry.session.close()
+        if entries:
+            logger.info(f"已关闭 {len(entries)} 个共享 HTTP 会话。")
+
+
+# 进程级单例
+provider_sessions = ProviderSessionRegistry()
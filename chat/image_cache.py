@@ -0,0 +1,92 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# --- 图片编码缓存配置 ---
+# 缓存的已编码图片总大小上限（MB），0 表示不缓存
+try:
+    IMAGE_DATA_URL_CACHE_MB = int(os.getenv('IMAGE_DATA_URL_CACHE_MB', '64'))
+except (ValueError, TypeError):
+    IMAGE_DATA_URL_CACHE_MB = 64
+
+# 单张图片编码后超过该大小（KB）时不缓存，始终从存储中流式编码（通常只有缩放副本会被缓存）
+try:
+    IMAGE_DATA_URL_CACHE_MAX_ENTRY_KB = int(os.getenv('IMAGE_DATA_URL_CACHE_MAX_ENTRY_KB', '2048'))
+except (ValueError, TypeError):
+    IMAGE_DATA_URL_CACHE_MAX_ENTRY_KB = 2048
+
+
+class DataURLCache:
+    """
+    worker 级的图片 base64 编码缓存，按字节数限制总大小（LRU）。
+    键为 StoredDataURL 的 (存储路径, 文件大小, 修改时间)，文件被替换后自动失效，无需显式清理。
+    StreamingJSONBody 发送图片时先查缓存：命中时直接发送已编码的字节，不再读取文件；
+    未命中且图片不超过单条上限时，在流式编码的同时收集编码结果，发送完成后写入缓存。
+    超过单条上限的图片（如未缩放的原图）不缓存，仍按块流式编码，请求的内存占用不随其大小增长。
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(stored):
+        return stored.path, stored.size, stored.modified
+
+    def admits(self, stored):
+        """图片编码后的大小是否在单条上限之内。"""
+        return stored.encoded_length() <= self.max_entry_bytes
+
+    def get(self, stored):
+        """返回图片的 base64 编码（不含 data URL 前缀），未缓存时返回 None。"""
+        key = self._key(stored)
+        with self._lock:
+            encoded = self._items.get(key)
+            if encoded is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+            return None
+
+    def put(self, stored, encoded):
+        size = len(encoded)
+        if size > self.max_entry_bytes:
+            return
+        key = self._key(stored)
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._items[key] = encoded
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _old_key, old_encoded = self._items.popitem(last=False)
+                self._bytes -= len(old_encoded)
+                self.evictions += 1
+        logger.debug(f"DataURLCache: 缓存了 {key[0]} 的编码（{size} 字节），当前占用 {self._bytes}/{self.max_bytes} 字节。")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'max_entry_bytes': self.max_entry_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# 进程级单例
+image_data_url_cache = DataURLCache(IMAGE_DATA_URL_CACHE_MB * 1024 * 1024, IMAGE_DATA_URL_CACHE_MAX_ENTRY_KB * 1024)
@@ -24,6 +24,13 @@ try:
 except (ValueError, TypeError):
     MAX_IMAGES_IN_CONTEXT = 1
 
+# 构建上下文时每张完整图片按多少个 token 计入预算
+# 从环境变量 "IMAGE_TOKEN_ESTIMATE" 读取，默认为 1500
+try:
+    IMAGE_TOKEN_ESTIMATE = int(os.environ.get("IMAGE_TOKEN_ESTIMATE", 1500))
+except (ValueError, TypeError):
+    IMAGE_TOKEN_ESTIMATE = 1500
+
 # 图片质量设置（未来扩展用）
 # 可以在这里添加图片压缩、尺寸调整等配置
 IMAGE_QUALITY_SETTINGS = {
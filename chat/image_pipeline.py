@@ -0,0 +1,108 @@
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .image_config import IMAGE_QUALITY_SETTINGS, MAX_IMAGE_SIZE, SUPPORTED_IMAGE_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# 发送给AI的图片副本与原图存放在同一目录，文件名为 <原文件名去掉扩展名>.ctx.jpg，路径记录在 Attachment.derivative_path
+DERIVATIVE_SUFFIX = '.ctx.jpg'
+
+
+class ImageValidationError(Exception):
+    """上传的图片类型或大小不符合 image_config 中的限制，或无法解码。"""
+
+
+def derivative_path(original_path):
+    """返回原图对应的、发送给AI的图片副本的默认存储路径。"""
+    root, _ext = os.path.splitext(original_path)
+    return f"{root}{DERIVATIVE_SUFFIX}"
+
+
+def base64_decoded_size(data):
+    """不解码即可得到 base64 字符串解码后的字节数。"""
+    data = data.strip()
+    return len(data) * 3 // 4 - (len(data) - len(data.rstrip('=')))
+
+
+def validate_image_upload(file_name, declared_type, size):
+    """
+    在读取和解码之前校验上传的图片：大小不超过 MAX_IMAGE_SIZE，类型属于 SUPPORTED_IMAGE_FORMATS。
+    不符合时抛出 ImageValidationError。
+    """
+    if size > MAX_IMAGE_SIZE:
+        raise ImageValidationError(f"图片过大：{size / 1024 / 1024:.1f} MB，最大允许 {MAX_IMAGE_SIZE / 1024 / 1024:.0f} MB。")
+    mime_type = declared_type or mimetypes.guess_type(file_name or '')[0]
+    if mime_type not in SUPPORTED_IMAGE_FORMATS:
+        raise ImageValidationError(f"不支持的图片格式：{mime_type or '未知'}，支持 {', '.join(SUPPORTED_IMAGE_FORMATS)}。")
+
+
+def _build_derivative(data):
+    """
+    解码图片并生成发送给AI的副本：按 EXIF 方向旋转，缩放到 IMAGE_QUALITY_SETTINGS 的最大尺寸以内，
+    透明背景合成到白底上，以 JPEG 重新压缩。
+    返回 (JPEG 字节, 原图 MIME 类型, 原图尺寸)；副本不比原图小且无需缩放时 JPEG 字节为 None。
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            mime_type = Image.MIME.get(image.format)
+            if mime_type not in SUPPORTED_IMAGE_FORMATS:
+                raise ImageValidationError(f"不支持的图片格式：{image.format}。")
+            image.seek(0)  # 动图只取第一帧
+            image = ImageOps.exif_transpose(image)
+            original_size = image.size
+            image.thumbnail((IMAGE_QUALITY_SETTINGS['max_width'], IMAGE_QUALITY_SETTINGS['max_height']), Image.LANCZOS)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=IMAGE_QUALITY_SETTINGS['quality'], optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ImageValidationError(f"无法解码图片: {e}")
+
+    derivative = output.getvalue()
+    if image.size == original_size and len(derivative) >= len(data):
+        derivative = None
+    return derivative, mime_type, original_size
+
+
+def save_image_upload(data, file_name, generation_id):
+    """
+    保存上传的图片，返回创建 Attachment 所需的字段（file_path, derivative_path, mime_type, size, width, height, sha256）。
+    同时在原图旁保存一份缩放、重新压缩后的副本（见 derivative_path），构建上下文时优先发送副本。
+    未安装 Pillow 时只保存原图，尺寸留空。
+    """
+    try:
+        derivative, mime_type, (width, height) = _build_derivative(data)
+    except ImportError:
+        logger.warning("未安装 Pillow，图片将以原图发送给AI。")
+        derivative, width, height = None, None, None
+        mime_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+
+    saved_path = default_storage.save(f"uploads/{generation_id}_{file_name}", ContentFile(data))
+    derived_path = ''
+    if derivative is not None:
+        # 同名文件已存在时存储后端会改名，实际路径记录在 Attachment.derivative_path 中
+        derived_path = default_storage.save(derivative_path(saved_path), ContentFile(derivative))
+        logger.info(f"图片 {saved_path} 已生成发送给AI的副本: {len(data)} -> {len(derivative)} 字节。")
+    return {
+        'file_path': saved_path,
+        'derivative_path': derived_path,
+        'mime_type': mime_type,
+        'size': len(data),
+        'width': width,
+        'height': height,
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
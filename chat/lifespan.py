@@ -0,0 +1,54 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def startup():
+    """worker 启动时初始化进程级资源。"""
+    from .cancellation import cancellation_registry
+    from .http_sessions import provider_sessions
+    await provider_sessions.startup()
+    cancellation_registry.ensure_listener()
+
+
+async def shutdown():
+    """worker 关闭时释放进程级资源。"""
+    from .cancellation import cancellation_registry
+    from .event_dispatch import event_dispatcher
+    from .generation_manager import generation_manager
+    from .heartbeat import stop_heartbeat
+    from .http_sessions import provider_sessions
+    from .state_utils import async_stop_request_manager
+    from .summarizer import conversation_summarizer
+    # 先让进行中的生成任务完成并保存，再关闭它们依赖的连接
+    await generation_manager.shutdown()
+    conversation_summarizer.shutdown()
+    stop_heartbeat.shutdown()
+    await cancellation_registry.shutdown()
+    await event_dispatcher.shutdown()
+    await async_stop_request_manager.close()
+    await provider_sessions.close_all()
+
+
+async def lifespan_app(scope, receive, send):
+    """
+    处理 ASGI lifespan 协议。
+    Django 自身不支持 lifespan，这里负责在 worker 生命周期的开始和结束时调用 startup/shutdown。
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await startup()
+            except Exception as e:
+                logger.error(f"lifespan 启动失败: {e}", exc_info=True)
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            try:
+                await shutdown()
+            except Exception as e:
+                logger.error(f"lifespan 关闭时出错: {e}", exc_info=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_generation_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimodel',
+            name='max_concurrent_requests',
+            field=models.PositiveIntegerField(default=0, help_text='每个 worker 同时使用该模型的最大请求数（同时受提供商上限约束），0 表示不单独限制', verbose_name='最大并发请求数'),
+        ),
+        migrations.AddField(
+            model_name='aiprovider',
+            name='max_concurrent_requests',
+            field=models.PositiveIntegerField(default=0, help_text='每个 worker 同时发往该提供商的最大请求数，0 表示不限制', verbose_name='最大并发请求数'),
+        ),
+        migrations.AddField(
+            model_name='aiprovider',
+            name='max_queued_requests',
+            field=models.PositiveIntegerField(default=100, help_text='达到并发上限后最多排队等待的请求数，队列满时新请求直接失败，0 表示不限制', verbose_name='最大排队请求数'),
+        ),
+    ]
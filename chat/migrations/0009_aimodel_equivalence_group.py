@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_provider_concurrency_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimodel',
+            name='equivalence_group',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='由不同提供商提供的同一上游模型使用相同的组名，用于对冲请求和故障转移；留空表示不参与', max_length=100, verbose_name='等价模型组'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_aimodel_equivalence_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimodel',
+            name='response_cache_enabled',
+            field=models.BooleanField(default=False, help_text='相同的模型、消息和参数直接返回缓存的回复；仅在默认参数中 temperature 为 0 时生效', verbose_name='启用回复缓存'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:53
+
+import math
+import re
+
+from django.db import migrations, models
+
+# 迁移不引用应用代码：估算规则按编写时的 chat.tokens.estimate_tokens 固定在这里
+_CJK_RE = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    other = len(_CJK_RE.sub('', text))
+    return (len(text) - other) + math.ceil(other / 4)
+
+
+def backfill_token_counts(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    batch = []
+    for message in Message.objects.filter(token_count__isnull=True).only('id', 'content').iterator(chunk_size=1000):
+        message.token_count = estimate_tokens(message.content)
+        batch.append(message)
+        if len(batch) >= 1000:
+            Message.objects.bulk_update(batch, ['token_count'])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ['token_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_aimodel_response_cache_enabled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='token_count',
+            field=models.PositiveIntegerField(blank=True, editable=False, help_text='消息内容的近似 token 数，写入消息时计算，用于按上下文长度裁剪历史', null=True, verbose_name='token 数'),
+        ),
+        migrations.RunPython(backfill_token_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,103 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:01
+
+import hashlib
+import mimetypes
+import os
+import re
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+import django.db.models.deletion
+
+FILE_RE = re.compile(r'\[file:(.*?)\]')
+IMAGE_PLACEHOLDER = '[图片上传]'
+# 迁移不引用应用代码：副本路径规则按编写时的 chat.image_pipeline.derivative_path 固定在这里
+DERIVATIVE_SUFFIX = '.ctx.jpg'
+
+
+def derivative_path(original_path):
+    root, _ext = os.path.splitext(original_path)
+    return f"{root}{DERIVATIVE_SUFFIX}"
+
+
+def _describe_file(file_path):
+    """读取已存储文件的大小、哈希和尺寸；文件不存在时只保留路径。"""
+    fields = {'mime_type': mimetypes.guess_type(file_path)[0] or ''}
+    if not default_storage.exists(file_path):
+        return fields
+    with default_storage.open(file_path, 'rb') as f:
+        data = f.read()
+    fields['size'] = len(data)
+    fields['sha256'] = hashlib.sha256(data).hexdigest()
+    try:
+        import io
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as image:
+            fields['width'], fields['height'] = image.size
+    except Exception:
+        pass
+    if default_storage.exists(derivative_path(file_path)):
+        fields['derivative_path'] = derivative_path(file_path)
+    return fields
+
+
+def move_file_references_to_attachments(apps, schema_editor):
+    """把消息内容中的 [file:路径] 引用转换为 Attachment，并从内容中移除。"""
+    Message = apps.get_model('chat', 'Message')
+    Attachment = apps.get_model('chat', 'Attachment')
+    for message in Message.objects.filter(content__contains='[file:').iterator(chunk_size=500):
+        file_paths = FILE_RE.findall(message.content)
+        if not file_paths:
+            continue
+        for file_path in file_paths:
+            Attachment.objects.create(message_id=message.id, file_path=file_path, **_describe_file(file_path))
+        text = FILE_RE.sub('', message.content).strip()
+        message.content = text or IMAGE_PLACEHOLDER
+        # 内容已改变；token 数留空，构建上下文时现场估算，下次保存消息时重新计算
+        message.token_count = None
+        message.save(update_fields=['content', 'token_count'])
+
+
+def restore_file_references(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    Attachment = apps.get_model('chat', 'Attachment')
+    for message in Message.objects.filter(attachments__isnull=False).distinct().iterator(chunk_size=500):
+        references = "\n".join(
+            f"[file:{file_path}]"
+            for file_path in Attachment.objects.filter(message_id=message.id).order_by('id').values_list('file_path', flat=True)
+        )
+        text = '' if message.content == IMAGE_PLACEHOLDER else message.content
+        message.content = f"{text}\n{references}" if text.strip() else references
+        message.token_count = None
+        message.save(update_fields=['content', 'token_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_message_conversation_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_path', models.CharField(max_length=500, verbose_name='存储路径')),
+                ('derivative_path', models.CharField(blank=True, default='', help_text='上传时生成的、缩放并重新压缩后发送给AI的副本；为空时发送原图', max_length=500, verbose_name='副本存储路径')),
+                ('mime_type', models.CharField(blank=True, default='', max_length=100, verbose_name='MIME 类型')),
+                ('size', models.PositiveIntegerField(blank=True, null=True, verbose_name='文件大小（字节）')),
+                ('width', models.PositiveIntegerField(blank=True, null=True, verbose_name='宽度')),
+                ('height', models.PositiveIntegerField(blank=True, null=True, verbose_name='高度')),
+                ('sha256', models.CharField(blank=True, db_index=True, default='', max_length=64, verbose_name='SHA-256')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='chat.message', verbose_name='所属消息')),
+            ],
+            options={
+                'verbose_name': '附件',
+                'verbose_name_plural': '附件',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.RunPython(move_file_references_to_attachments, restore_file_references),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_attachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimodel',
+            name='summary_model',
+            field=models.ForeignKey(blank=True, help_text='长对话中较早的消息由该模型在后台压缩为摘要，请求时发送摘要和最近的消息；留空表示不压缩', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.aimodel', verbose_name='摘要模型'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary',
+            field=models.TextField(blank=True, default='', editable=False, help_text='由摘要模型在后台生成，覆盖 summary_until 及之前的消息', verbose_name='历史摘要'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary_until',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message', verbose_name='摘要覆盖到的消息'),
+        ),
+    ]
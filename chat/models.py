@@ -2,12 +2,13 @@ from django.db import models
 from django.conf import settings
 import json
 import uuid
-import re
 import logging
 from django.core.files.storage import default_storage
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
+from .tokens import estimate_tokens
+
 logger = logging.getLogger(__name__)
 
 # Create your models here.
@@ -18,6 +19,8 @@ class AIProvider(models.Model):
     base_url = models.URLField(verbose_name="基础URL")
     api_key = models.CharField(max_length=500, verbose_name="API密钥")
     is_active = models.BooleanField(default=True, verbose_name="是否启用")
+    max_concurrent_requests = models.PositiveIntegerField(default=0, verbose_name="最大并发请求数", help_text="每个 worker 同时发往该提供商的最大请求数，0 表示不限制")
+    max_queued_requests = models.PositiveIntegerField(default=100, verbose_name="最大排队请求数", help_text="达到并发上限后最多排队等待的请求数，队列满时新请求直接失败，0 表示不限制")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
     
     class Meta:
@@ -35,6 +38,10 @@ class AIModel(models.Model):
     max_context = models.IntegerField(default=4096, verbose_name="最大上下文长度")
     max_history_messages = models.IntegerField(default=20, verbose_name="历史消息数量限制")
     default_params = models.JSONField(default=dict, verbose_name="默认参数",blank=True)
+    max_concurrent_requests = models.PositiveIntegerField(default=0, verbose_name="最大并发请求数", help_text="每个 worker 同时使用该模型的最大请求数（同时受提供商上限约束），0 表示不单独限制")
+    equivalence_group = models.CharField(max_length=100, blank=True, default="", db_index=True, verbose_name="等价模型组", help_text="由不同提供商提供的同一上游模型使用相同的组名，用于对冲请求和故障转移；留空表示不参与")
+    response_cache_enabled = models.BooleanField(default=False, verbose_name="启用回复缓存", help_text="相同的模型、消息和参数直接返回缓存的回复；仅在默认参数中 temperature 为 0 时生效")
+    summary_model = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', verbose_name="摘要模型", help_text="长对话中较早的消息由该模型在后台压缩为摘要，请求时发送摘要和最近的消息；留空表示不压缩")
     is_active = models.BooleanField(default=True, verbose_name="是否启用")
     
     class Meta:
@@ -55,6 +62,8 @@ class Conversation(models.Model):
     # 新增字段，用于跟踪当前API驱动的生成ID
     current_generation_id = models.UUIDField(null=True, blank=True, editable=False, help_text="当前正在处理的API生成的唯一ID")
     system_prompt = models.TextField(blank=True, null=True, verbose_name="系统提示词")
+    summary = models.TextField(blank=True, default="", editable=False, verbose_name="历史摘要", help_text="由摘要模型在后台生成，覆盖 summary_until 及之前的消息")
+    summary_until = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+', verbose_name="摘要覆盖到的消息")
 
     class Meta:
         verbose_name = "对话"
@@ -64,6 +73,26 @@ class Conversation(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.title}"
 
+class MessageQuerySet(models.QuerySet):
+    def delete(self):
+        """
+        批量删除消息。Message 上没有 delete 信号，Django 只需按主键批量删除；
+        附件由 Attachment 的信号逐个清理文件，涉及的会话的上下文缓存只失效一次。
+        """
+        from .context_cache import context_cache
+        earliest = self.values('conversation_id').annotate(earliest=models.Min('timestamp')).order_by()
+        conversation_ids = set()
+        for row in earliest:
+            conversation_ids.add(row['conversation_id'])
+            reset_covering_summary(row['conversation_id'], row['earliest'])
+        result = super().delete()
+        for conversation_id in conversation_ids:
+            context_cache.on_conversation_changed(conversation_id)
+        return result
+
+    delete.queryset_only = True
+
+
 class Message(models.Model):
     """消息"""
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, verbose_name="所属对话")
@@ -72,34 +101,94 @@ class Message(models.Model):
     model_used = models.ForeignKey(AIModel, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="使用的模型")
     timestamp = models.DateTimeField(auto_now_add=True, verbose_name="时间戳")
     generation_id = models.UUIDField(null=True, blank=True, help_text="与此消息相关的生成事件的唯一ID")
+    token_count = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="token 数", help_text="消息内容的近似 token 数，写入消息时计算，用于按上下文长度裁剪历史")
+
+    objects = MessageQuerySet.as_manager()
     
     class Meta:
         verbose_name = "消息"
         verbose_name_plural = "消息"
         ordering = ['timestamp']
+        indexes = [
+            # 构建上下文时按时间倒序取会话最近的 N 条消息
+            models.Index(fields=['conversation', 'timestamp'], name='chat_msg_conv_ts_idx'),
+        ]
     
     def __str__(self):
         return f"{'用户' if self.is_user else 'AI'}: {self.content[:50]}..."
 
-@receiver(post_delete, sender=Message)
-def delete_message_file_on_delete(sender, instance, **kwargs):
+    def delete(self, *args, **kwargs):
+        from .context_cache import context_cache
+        # 删除后 Django 会把实例的主键置为 None，需提前取出
+        conversation_id, message_id = self.conversation_id, self.id
+        reset_covering_summary(conversation_id, self.timestamp)
+        result = super().delete(*args, **kwargs)
+        context_cache.on_message_deleted(conversation_id, message_id)
+        return result
+
+class Attachment(models.Model):
+    """消息附件（上传的图片）"""
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='attachments', verbose_name="所属消息")
+    file_path = models.CharField(max_length=500, verbose_name="存储路径")
+    derivative_path = models.CharField(max_length=500, blank=True, default="", verbose_name="副本存储路径", help_text="上传时生成的、缩放并重新压缩后发送给AI的副本；为空时发送原图")
+    mime_type = models.CharField(max_length=100, blank=True, default="", verbose_name="MIME 类型")
+    size = models.PositiveIntegerField(null=True, blank=True, verbose_name="文件大小（字节）")
+    width = models.PositiveIntegerField(null=True, blank=True, verbose_name="宽度")
+    height = models.PositiveIntegerField(null=True, blank=True, verbose_name="高度")
+    sha256 = models.CharField(max_length=64, blank=True, default="", db_index=True, verbose_name="SHA-256")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+
+    class Meta:
+        verbose_name = "附件"
+        verbose_name_plural = "附件"
+        ordering = ['id']
+
+    def __str__(self):
+        return self.file_path
+
+def reset_covering_summary(conversation_id, timestamp):
+    """
+    编辑或删除的消息已被会话摘要覆盖（不晚于 summary_until）时清除摘要，由摘要任务之后重新生成；
+    否则请求中仍会带上摘要里的旧内容。
+    """
+    Conversation.objects.filter(id=conversation_id, summary_until__timestamp__gte=timestamp).update(
+        summary="", summary_until=None
+    )
+
+@receiver(pre_save, sender=Message)
+def set_message_token_count(sender, instance, **kwargs):
+    """写入消息时缓存其近似 token 数，构建上下文时无需重新计算整段历史。"""
+    instance.token_count = estimate_tokens(instance.content)
+
+@receiver(post_save, sender=Message)
+def update_context_cache_on_save(sender, instance, created, **kwargs):
+    """消息创建或编辑后，增量更新该会话的上下文缓存。"""
+    from .context_cache import context_cache
+    if not created:
+        reset_covering_summary(instance.conversation_id, instance.timestamp)
+    # 新建的消息还没有附件，无需查询
+    context_cache.on_message_saved(instance, attachments=() if created else None)
+
+@receiver(post_save, sender=Attachment)
+def update_context_cache_on_attachment_save(sender, instance, **kwargs):
+    """附件添加到已有消息上之后，更新该消息在上下文缓存中的条目。"""
+    from .context_cache import context_cache
+    context_cache.on_message_saved(instance.message)
+
+@receiver(post_delete, sender=Attachment)
+def delete_attachment_files_on_delete(sender, instance, **kwargs):
     """
-    当一个Message对象被删除时，通过信号触发，检查其内容是否包含文件引用。
-    如果包含，则删除对应的物理文件。
-    这个方法能确保所有删除方式（单条、批量、级联）都能清理文件。
+    删除附件时（单条、批量、随消息或会话级联删除）清理原图和发送给AI的副本。
+    只有带附件的消息会触发，删除普通消息不会逐条执行任何信号。
     """
-    try:
-        # 使用正则表达式从消息内容中提取文件路径
-        # 格式为 [file:path/to/your/file.jpg]
-        file_match = re.search(r'\[file:(.*?)\]', instance.content)
-        if file_match:
-            file_path = file_match.group(1)
-            # 检查文件是否存在于默认存储中
+    for file_path in (instance.file_path, instance.derivative_path):
+        if not file_path:
+            continue
+        try:
             if default_storage.exists(file_path):
-                # 删除文件
                 default_storage.delete(file_path)
-                logger.info(f"成功删除与消息 {instance.id} 关联的文件: {file_path}")
+                logger.info(f"成功删除与消息 {instance.message_id} 关联的文件: {file_path}")
             else:
-                logger.warning(f"尝试删除与消息 {instance.id} 关联的文件，但文件不存在: {file_path}")
-    except Exception as e:
-        logger.error(f"删除消息 {instance.id} 的关联文件时发生错误: {e}", exc_info=True)
+                logger.warning(f"尝试删除与消息 {instance.message_id} 关联的文件，但文件不存在: {file_path}")
+        except Exception as e:
+            logger.error(f"删除消息 {instance.message_id} 的关联文件 {file_path} 时发生错误: {e}", exc_info=True)
@@ -0,0 +1,238 @@
+import asyncio
+import base64
+import json
+import mimetypes
+import re
+import uuid
+
+from aiohttp import payload
+from django.core.files.storage import default_storage
+
+from .image_cache import image_data_url_cache
+
+# 每次从存储中读取的字节数，必须是 3 的倍数，分块编码的结果才能直接拼接
+READ_CHUNK_BYTES = 3 * 64 * 1024
+
+# 序列化时 StoredDataURL 的占位标记（每个进程随机生成，不会与消息内容冲突）
+_MARKER = f"@@stored-{uuid.uuid4().hex}-"
+_MARKER_RE = re.compile(f"{re.escape(_MARKER)}(\\d+)@@")
+
+
+class StoredFileChangedError(Exception):
+    """发送请求体时图片文件的大小与构建上下文时记录的不同，已声明的 Content-Length 无法兑现。"""
+
+
+class StoredDataURL:
+    """
+    消息中图片 data URL 的占位符：构建上下文时只记录存储路径、大小和 MIME 类型，
+    序列化请求体时（见 StreamingJSONBody）才从存储中分块读取并进行 base64 编码。
+    """
+
+    __slots__ = ('path', 'mime_type', 'size', 'modified')
+
+    def __init__(self, path):
+        self.path = path
+        self.mime_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.size = default_storage.size(path)
+        try:
+            self.modified = default_storage.get_modified_time(path).timestamp()
+        except NotImplementedError:
+            self.modified = None
+
+    @property
+    def prefix(self):
+        return f"data:{self.mime_type};base64,".encode('ascii')
+
+    def encoded_length(self):
+        return len(self.prefix) + 4 * ((self.size + 2) // 3)
+
+    def fingerprint(self):
+        """用于回复缓存键等需要稳定表示、但不需要图片内容的场景。"""
+        return f"stored:{self.path}:{self.size}:{self.modified}"
+
+    def __repr__(self):
+        return f"StoredDataURL({self.path!r}, {self.size} bytes)"
+
+
+def json_default(value):
+    """json.dumps 的 default：StoredDataURL 以指纹代替图片内容。"""
+    if isinstance(value, StoredDataURL):
+        return value.fingerprint()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class PreEncodedMessage(dict):
+    """
+    已序列化过的消息：内容与普通的消息字典相同，另外携带其 JSON 字节（encoded）。
+    StreamingJSONBody 直接拼接 encoded，不再重新序列化；其他场景（如回复缓存键）仍按普通字典处理。
+    """
+
+    __slots__ = ('encoded',)
+
+    def __init__(self, message, encoded):
+        super().__init__(message)
+        self.encoded = encoded
+
+
+def encode_message(message):
+    """以 StreamingJSONBody 使用的格式序列化单条消息。"""
+    return json.dumps(message, ensure_ascii=False).encode('utf-8')
+
+
+class StreamingJSONBody:
+    """
+    以流的方式发送的 JSON 请求体。除 StoredDataURL 以外的部分在构造时序列化为字节，
+    图片在发送时按 READ_CHUNK_BYTES 从存储中读取并编码，每个请求的内存占用与图片数量和大小无关；
+    较小的图片（缩放副本）的编码结果由 image_data_url_cache 跨请求复用。
+    messages 中的 PreEncodedMessage 直接拼接其缓存的字节，历史消息无需在每轮请求中重新序列化。
+    总长度可以预先算出，因此以 Content-Length 发送，而不是分块传输编码；
+    发送时文件大小与 StoredDataURL 记录的不一致则抛出 StoredFileChangedError 中止请求，不会发出长度不符的请求体。
+    同一个对象可以重复迭代（例如故障转移时重新发送）。
+    - 同步路径：作为 requests 的 data 参数（可迭代且有长度）。
+    - 异步路径：通过 as_aiohttp_payload() 作为 aiohttp 的 data 参数。
+    """
+
+    def __init__(self, request_data):
+        self._files = []
+        self._segments = []
+        messages = request_data.get('messages')
+        if isinstance(messages, list):
+            # messages 数组逐条拼接：PreEncodedMessage 直接使用已缓存的字节，其余消息在此序列化
+            self._append_bytes(b'{"messages": [')
+            for index, message in enumerate(messages):
+                if index:
+                    self._append_bytes(b', ')
+                if isinstance(message, PreEncodedMessage):
+                    self._append_bytes(message.encoded)
+                else:
+                    self._append_json(message)
+            rest = {key: value for key, value in request_data.items() if key != 'messages'}
+            self._append_json_text(']')
+            if rest:
+                self._append_json_text(', ')
+                self._append_json(rest, strip_braces=True)
+            self._append_json_text('}')
+        else:
+            self._append_json(request_data)
+        self._segments = [b''.join(segment) if isinstance(segment, list) else segment for segment in self._segments]
+        self._length = sum(
+            segment.encoded_length() if isinstance(segment, StoredDataURL) else len(segment)
+            for segment in self._segments
+        )
+
+    def _append_bytes(self, data):
+        # 相邻的字节片段合并为一个列表，最后一次性 join
+        if self._segments and type(self._segments[-1]) is list:
+            self._segments[-1].append(data)
+        else:
+            self._segments.append([data])
+
+    def _append_json_text(self, text):
+        self._append_bytes(text.encode('utf-8'))
+
+    def _append_json(self, value, strip_braces=False):
+        def _placeholder(item):
+            if isinstance(item, StoredDataURL):
+                self._files.append(item)
+                return f"{_MARKER}{len(self._files) - 1}@@"
+            raise TypeError(f"Object of type {type(item).__name__} is not JSON serializable")
+
+        files_before = len(self._files)
+        encoded = json.dumps(value, ensure_ascii=False, default=_placeholder)
+        if strip_braces:
+            encoded = encoded[1:-1]
+        if len(self._files) == files_before:
+            self._append_json_text(encoded)
+            return
+        parts = _MARKER_RE.split(encoded)
+        # parts 交替为：JSON 片段、文件序号、JSON 片段……
+        for index, part in enumerate(parts):
+            if index % 2:
+                self._segments.append(self._files[int(part)])
+            elif part:
+                self._append_json_text(part)
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def has_files(self):
+        return bool(self._files)
+
+    def __iter__(self):
+        for segment in self._segments:
+            if isinstance(segment, StoredDataURL):
+                yield segment.prefix
+                yield from self._iter_image(segment)
+            else:
+                yield segment
+
+    @staticmethod
+    def _iter_image(stored):
+        cacheable = image_data_url_cache.admits(stored)
+        if cacheable:
+            encoded = image_data_url_cache.get(stored)
+            if encoded is not None:
+                yield encoded
+                return
+        chunks = [] if cacheable else None
+        # 只读取构建上下文时记录的字节数，Content-Length 据此算出
+        remaining = stored.size
+        with default_storage.open(stored.path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(READ_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                chunk = base64.b64encode(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+                yield chunk
+            if remaining or f.read(1):
+                raise StoredFileChangedError(f"图片 {stored.path} 在构建上下文之后发生了变化（记录的大小为 {stored.size} 字节）")
+        if chunks is not None:
+            image_data_url_cache.put(stored, b''.join(chunks))
+
+    def as_aiohttp_payload(self):
+        return _AsyncBodyPayload(self)
+
+
+class _AsyncBodyPayload(payload.Payload):
+    """aiohttp 的请求体：文件读取在线程中执行，不阻塞事件循环。"""
+
+    def __init__(self, body):
+        super().__init__(body, content_type='application/json', encoding='utf-8')
+        self._size = len(body)
+
+    async def write(self, writer):
+        body = self._value
+        if not body.has_files:
+            for segment in body:
+                await writer.write(segment)
+            return
+        loop = asyncio.get_running_loop()
+        iterator = iter(body)
+        pending = None
+        try:
+            while True:
+                # 线程中的 next() 无法被取消：写入被取消（如对冲请求落败）时不等待它，由 finally 安排关闭
+                pending = loop.run_in_executor(None, next, iterator, None)
+                chunk = await asyncio.shield(pending)
+                if chunk is None:
+                    break
+                await writer.write(chunk)
+        finally:
+            if pending is not None and not pending.done():
+                # next() 仍在执行时关闭生成器会抛出 "generator already executing"，等它返回后再关闭
+                pending.add_done_callback(lambda future: _close_iterator(iterator, future))
+            else:
+                iterator.close()
+
+    def decode(self, encoding='utf-8', errors='strict'):
+        return b''.join(self._value).decode(encoding, errors)
+
+
+def _close_iterator(iterator, future):
+    if not future.cancelled():
+        future.exception()  # 写入已被取消，读取时的错误无需再抛出
+    iterator.close()
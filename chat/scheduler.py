@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from async_timeout import timeout
+
+logger = logging.getLogger(__name__)
+
+# --- 调度配置 ---
+# 请求在等待队列中的最长等待时间（秒），超时后生成失败
+try:
+    PROVIDER_QUEUE_TIMEOUT = int(os.getenv('PROVIDER_QUEUE_TIMEOUT', '120'))
+except (ValueError, TypeError):
+    PROVIDER_QUEUE_TIMEOUT = 120
+
+
+class ProviderBusyError(Exception):
+    """提供商的等待队列已满，或排队超时。"""
+
+
+class QueueAbortedError(Exception):
+    """排队期间收到了停止请求（同步路径）。"""
+
+
+# 名额已分配的通知标记
+_GRANTED = object()
+
+
+class _Waiter:
+    __slots__ = ('user_key', 'model_id', 'model_limit', 'notify', 'granted', 'position')
+
+    def __init__(self, user_key, model_id, model_limit, notify):
+        self.user_key = user_key
+        self.model_id = model_id
+        self.model_limit = model_limit
+        self.notify = notify  # 线程安全的回调：notify(position) 或 notify(_GRANTED)
+        self.granted = False
+        self.position = None
+
+
+class _Lane:
+    """单个提供商的并发状态：进行中的请求数，以及按用户分组的等待队列。"""
+
+    __slots__ = ('limit', 'queue_limit', 'active', 'model_active', 'queues')
+
+    def __init__(self):
+        self.limit = 0
+        self.queue_limit = 0
+        self.active = 0
+        self.model_active = {}
+        self.queues = OrderedDict()  # user_key -> deque[_Waiter]，顺序即轮转顺序
+
+    def waiting(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def has_capacity(self, model_id, model_limit):
+        if self.limit and self.active >= self.limit:
+            return False
+        if model_limit and self.model_active.get(model_id, 0) >= model_limit:
+            return False
+        return True
+
+    def take(self, model_id):
+        self.active += 1
+        self.model_active[model_id] = self.model_active.get(model_id, 0) + 1
+
+    def put_back(self, model_id):
+        self.active -= 1
+        remaining = self.model_active.get(model_id, 1) - 1
+        if remaining > 0:
+            self.model_active[model_id] = remaining
+        else:
+            self.model_active.pop(model_id, None)
+
+
+class ProviderScheduler:
+    """
+    worker 级的上游请求调度器，位于对 AI 提供商的调用之前。
+    - 按提供商（以及可选的按模型）限制同时进行的请求数，限制值来自 AIProvider/AIModel 的配置，0 表示不限制。
+    - 超出限制的请求进入有界的等待队列，队列满时立即失败，而不是继续压向提供商触发 429。
+    - 等待队列按用户分组并轮转出队，单个用户的大量请求不会饿死其他用户。
+    - 排队位置变化时通过回调通知调用方，由调用方推送 queue_position 事件。
+    同时支持事件循环中的协程（WebSocket 路径）和工作线程（HTTP 回退路径）。
+    """
+
+    def __init__(self):
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    # --- 内部状态操作（均在锁内调用） ---
+    def _lane_for(self, model):
+        lane = self._lanes.get(model['provider_id'])
+        if lane is None:
+            lane = self._lanes[model['provider_id']] = _Lane()
+        # 每次都使用最新的配置，管理员修改限制后无需重启
+        lane.limit = model.get('provider_max_concurrent') or 0
+        lane.queue_limit = model.get('provider_max_queued') or 0
+        return lane
+
+    def _dispatch(self, lane):
+        """按用户轮转的顺序，把空出的名额分配给可以运行的等待者。"""
+        while lane.queues:
+            if lane.limit and lane.active >= lane.limit:
+                return
+            for user_key, waiters in lane.queues.items():
+                head = waiters[0]
+                if lane.has_capacity(head.model_id, head.model_limit):
+                    break
+            else:
+                return  # 剩余的等待者都受限于各自模型的并发上限
+            waiters.popleft()
+            if waiters:
+                lane.queues.move_to_end(user_key)
+            else:
+                del lane.queues[user_key]
+            lane.take(head.model_id)
+            head.granted = True
+            head.notify(_GRANTED)
+
+    def _announce_positions(self, lane):
+        """计算每个等待者在轮转顺序下的位置（从 1 开始），仅在位置变化时通知。"""
+        lengths = [len(waiters) for waiters in lane.queues.values()]
+        for user_index, waiters in enumerate(lane.queues.values()):
+            for index, waiter in enumerate(waiters):
+                ahead = sum(min(length, index) for length in lengths)
+                ahead += sum(1 for length in lengths[:user_index] if length > index)
+                position = ahead + 1
+                if waiter.position != position:
+                    waiter.position = position
+                    waiter.notify(position)
+
+    def _enqueue(self, model, user_key, notify):
+        """立即获得名额时返回 None，否则返回进入等待队列的 _Waiter。"""
+        model_limit = model.get('max_concurrent') or 0
+        with self._lock:
+            lane = self._lane_for(model)
+            if not lane.queues and lane.has_capacity(model['id'], model_limit):
+                lane.take(model['id'])
+                return None
+            if lane.queue_limit and lane.waiting() >= lane.queue_limit:
+                raise ProviderBusyError(f"服务繁忙：提供商的等待队列已满（{lane.queue_limit}），请稍后重试。")
+            waiter = _Waiter(user_key, model['id'], model_limit, notify)
+            lane.queues.setdefault(user_key, deque()).append(waiter)
+            self._dispatch(lane)
+            self._announce_positions(lane)
+        logger.info(f"ProviderScheduler: 提供商 {model['provider_id']} 已达并发上限，请求进入等待队列。")
+        return waiter
+
+    def _release(self, model):
+        with self._lock:
+            lane = self._lanes.get(model['provider_id'])
+            if lane is None:
+                return
+            lane.put_back(model['id'])
+            self._dispatch(lane)
+            self._announce_positions(lane)
+
+    def _abandon(self, model, waiter):
+        """等待者放弃排队（取消、超时）：已分配的名额归还，否则从队列中移除。"""
+        with self._lock:
+            lane = self._lanes.get(model['provider_id'])
+            if lane is None:
+                return
+            if waiter.granted:
+                lane.put_back(waiter.model_id)
+            else:
+                waiters = lane.queues.get(waiter.user_key)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del lane.queues[waiter.user_key]
+            self._dispatch(lane)
+            self._announce_positions(lane)
+
+    # --- 协程接口 ---
+    @asynccontextmanager
+    async def slot(self, model, user_key, on_queued=None):
+        """
+        获取一个发往该模型所属提供商的请求名额，退出时归还。
+        on_queued: 可选的 async 回调，排队位置变化时以位置调用，获得名额时以 0 调用。
+        """
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+        waiter = self._enqueue(model, user_key, lambda item: loop.call_soon_threadsafe(updates.put_nowait, item))
+        if waiter is not None:
+            try:
+                async with timeout(PROVIDER_QUEUE_TIMEOUT):
+                    while True:
+                        item = await updates.get()
+                        if item is _GRANTED:
+                            break
+                        if on_queued:
+                            await on_queued(item)
+            except asyncio.TimeoutError:
+                self._abandon(model, waiter)
+                raise ProviderBusyError(f"服务繁忙：排队超过 {PROVIDER_QUEUE_TIMEOUT} 秒，请稍后重试。")
+            except BaseException:
+                self._abandon(model, waiter)
+                raise
+            if on_queued:
+                await on_queued(0)
+        try:
+            yield
+        finally:
+            self._release(model)
+
+    # --- 同步接口 ---
+    @contextmanager
+    def slot_sync(self, model, user_key, on_queued=None, should_abort=None):
+        """slot() 的同步版本，供工作线程使用；should_abort 返回 True 时放弃排队并抛出 QueueAbortedError。"""
+        updates = queue.Queue()
+        waiter = self._enqueue(model, user_key, updates.put)
+        if waiter is not None:
+            deadline = time.monotonic() + PROVIDER_QUEUE_TIMEOUT
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise ProviderBusyError(f"服务繁忙：排队超过 {PROVIDER_QUEUE_TIMEOUT} 秒，请稍后重试。")
+                    try:
+                        item = updates.get(timeout=min(remaining, 1.0))
+                    except queue.Empty:
+                        if should_abort and should_abort():
+                            raise QueueAbortedError()
+                        continue
+                    if item is _GRANTED:
+                        break
+                    if on_queued:
+                        on_queued(item)
+            except BaseException:
+                self._abandon(model, waiter)
+                raise
+            if on_queued:
+                on_queued(0)
+        try:
+            yield
+        finally:
+            self._release(model)
+
+    def stats(self):
+        """返回各提供商当前的进行中请求数和排队数。"""
+        with self._lock:
+            return {
+                provider_id: {'active': lane.active, 'waiting': lane.waiting(), 'limit': lane.limit}
+                for provider_id, lane in self._lanes.items()
+            }
+
+
+# 进程级单例
+provider_scheduler = ProviderScheduler()
@@ -1,24 +1,32 @@
 import json
 import logging
 import uuid
-import time
+import itertools
 import asyncio
 from async_timeout import timeout
 import aiohttp
-import requests # For synchronous HTTP requests
 import base64
-import re
-import mimetypes
 import os
+from contextlib import nullcontext
 from asgiref.sync import async_to_sync, sync_to_async
-from channels.layers import get_channel_layer
 from django.shortcuts import get_object_or_404
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
-from django.core.files.base import ContentFile
 
-from .models import AIModel, Conversation, Message
-from .state_utils import get_stop_requested_sync, set_stop_requested_sync, touch_stop_request_sync, clear_stop_request_sync
+from .models import AIModel, Attachment, Conversation, Message
+from .cancellation import cancellation_registry
+from .completion_cache import completion_cache, CachedCompletion
+from .context_builder import build_history_messages, conversation_summary, ContextBudgetError
+from .event_dispatch import event_dispatcher
+from .event_log import generation_event_log
+from .generation_registry import generation_registry
+from .heartbeat import stop_heartbeat
+from .image_pipeline import save_image_upload
+from .scheduler import ProviderBusyError, QueueAbortedError
+from .upstream import open_upstream, open_upstream_sync, UpstreamHTTPError
+from .streaming import SSEDecoder, ContentAccumulator, StreamCoalescer, SyncStreamCoalescer
+from .summarizer import conversation_summarizer
+from .state_utils import (
+    get_stop_requested_sync, set_stop_requested_sync, clear_stop_request_sync, clear_stop_request_async,
+)
 from .utils import ensure_valid_api_url
 
 logger = logging.getLogger(__name__)
@@ -27,6 +35,12 @@ AI_REQUEST_TIMEOUT = 300  # 使用整数，而不是对象
 
 async def _send_event(callback, conversation_id, event_type, data):
     """统一的事件发送函数"""
+    generation_id = data.get('generation_id')
+    if generation_id:
+        # 记录到可重放的事件日志中，断线重连的客户端可以凭序号只重放错过的事件
+        seq = await generation_event_log.aappend(generation_id, conversation_id, event_type, data)
+        if seq is not None:
+            data = {**data, 'seq': seq}
     if callback:
         await callback(event_type, data)
     else:
@@ -43,6 +57,7 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
     """
     conversation = None
     final_status = "unknown"
+    coalescer = None
     
     try:
         uuid.UUID(generation_id)
@@ -50,9 +65,14 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
     except (ValueError, TypeError):
         real_generation_id = str(uuid.uuid4())
 
+    # 注册取消令牌：停止请求会被推送到本地令牌，生成循环只需检查本地标志
+    cancel_token = cancellation_registry.register(real_generation_id)
+    # 停止信号的 TTL 由 worker 级心跳统一续期
+    stop_heartbeat.track(real_generation_id)
+
     try:
         # 在任务开始时，检查是否已存在停止信号。
-        if get_stop_requested_sync(real_generation_id):
+        if await cancellation_registry.check_pending(cancel_token):
             logger.warning(f"Service: Stop request for GenID {real_generation_id} detected at task start. Aborting immediately.")
             final_status = "cancelled"
             await _send_event(event_callback, conversation_id, 'generation_end', {
@@ -65,24 +85,10 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
         if file_data and file_name and user_message_id:
             try:
                 file_content = base64.b64decode(file_data)
-                saved_path = await database_sync_to_async(default_storage.save)(f"uploads/{real_generation_id}_{file_name}", ContentFile(file_content))
-                
-                @database_sync_to_async
-                def _update_db_message(msg_id, text_content, path):
-                    try:
-                        msg = Message.objects.get(id=msg_id)
-                        if text_content.strip():
-                            msg.content = f"{text_content}\n[file:{path}]"
-                        else:
-                            msg.content = f"[file:{path}]"
-                        msg.save()
-                        logger.info(f"已更新用户消息 {msg_id}，添加文件引用: {path}")
-                    except Message.DoesNotExist:
-                        logger.error(f"无法找到用户消息 {msg_id} 来更新")
-                        raise
-                
-                # 当 message 为 None 时，使用空字符串
-                await _update_db_message(user_message_id, message or "", saved_path)
+                # 保存原图，并生成缩放、重新压缩后发送给AI的副本（CPU 密集，在线程中执行）
+                stored = await sync_to_async(save_image_upload, thread_sensitive=False)(file_content, file_name, real_generation_id)
+                await database_sync_to_async(Attachment.objects.create)(message_id=user_message_id, **stored)
+                logger.info(f"已为用户消息 {user_message_id} 添加附件: {stored['file_path']}")
             except Exception as e:
                 logger.error(f"图片处理失败: {e}", exc_info=True)
                 await _send_event(event_callback, conversation_id, 'generation_end', {
@@ -100,7 +106,7 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
             return
 
         # 2. 准备并发送 generation_start 事件
-        await set_db_generation_id(conversation_id, real_generation_id)
+        await generation_registry.astart(conversation_id, real_generation_id, model['id'])
         logger.info(f"Service: Starting generation with ID {real_generation_id} for conversation {conversation_id}")
 
         await _send_event(event_callback, conversation_id, 'generation_start', {
@@ -112,14 +118,10 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
         messages_for_api = await prepare_history_messages(conversation, model, user_message_id, is_regenerate)
 
         # 4. 构建并发送AI请求
-        request_data = {
-            "model": model['model_name'],
-            "messages": messages_for_api,
-            "stream": is_streaming,  # 使用传入的标志
-            **model['default_params']
-        }
-        api_url = ensure_valid_api_url(model['provider_base_url'], "/v1/chat/completions")
-        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {model['provider_api_key']}"}
+        candidates = [model] + await get_equivalent_models_async(model)
+
+        def _build_request(candidate):
+            return build_chat_request(candidate, messages_for_api, is_streaming)
 
         full_content = ""
         
@@ -127,108 +129,119 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
         INTER_CHUNK_TIMEOUT = 20  # 如果20秒内没有收到任何数据（包括空包），则超时
         
         client_timeout = aiohttp.ClientTimeout(total=AI_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=client_timeout) as session:
-            # 在请求前再次检查，以防万一
-            if get_stop_requested_sync(real_generation_id):
-                logger.warning(f"Service: Stop request detected for GenID {real_generation_id} just before making API call. Aborting.")
+
+        async def _emit_queue_position(position):
+            # 在 cancel_token.armed() 区间内调用：停止请求取消本任务时，已开始的发送仍然完成
+            await asyncio.shield(_send_event(event_callback, conversation_id, 'queue_position', {
+                'generation_id': real_generation_id,
+                'temp_id': temp_id,
+                'position': position
+            }))
+
+        # 启用了回复缓存的模型先查缓存，命中时以合成的上游响应重放，不占用提供商的并发名额
+        cache_key, cached_content = await completion_cache.alookup(model, messages_for_api, bypass=is_regenerate)
+        if cached_content is not None:
+            upstream = CachedCompletion(model, cached_content)
+        else:
+            # 排队等待提供商的并发名额和等待上游首个数据块期间，停止请求会直接取消本任务
+            with cancel_token.armed():
+                # 选择上游：必要时对冲或故障转移到等价模型组中的其他提供商（均复用按提供商共享的会话）
+                upstream = await open_upstream(
+                    candidates, conversation['user_id'], _build_request, client_timeout,
+                    first_byte_timeout=INTER_CHUNK_TIMEOUT, is_streaming=is_streaming, on_queued=_emit_queue_position
+                )
+        async with upstream:
+            response = upstream.response
+            # 在读取响应前再次检查，以防万一
+            if cancel_token.cancelled:
+                logger.warning(f"Service: Stop request detected for GenID {real_generation_id} just before reading the response. Aborting.")
                 final_status = "cancelled"
             else:
-                async with session.post(api_url, json=request_data, headers=headers) as response:
-                    if response.status == 200:
-                        if is_streaming:
-                            buffer = b''
-                            last_heartbeat_time = time.time()
-                            HEARTBEAT_INTERVAL = 15  # 每15秒进行一次心跳
-
-                            while True:
-                                try:
-                                    # 心跳逻辑：定期延长停止信号的TTL
-                                    current_time = time.time()
-                                    if current_time - last_heartbeat_time > HEARTBEAT_INTERVAL:
-                                        touch_stop_request_sync(real_generation_id)
-                                        last_heartbeat_time = current_time
-
-                                    # 检查停止信号
-                                    if get_stop_requested_sync(real_generation_id):
-                                        logger.warning(f"Service: Stop request detected for GenID {real_generation_id}. Stopping stream.")
-                                        final_status = "cancelled"
-                                        break
-
-                                    # 使用块间超时来防止无限期挂起（兼容 Py<3.11）
-                                    async with timeout(INTER_CHUNK_TIMEOUT):
-                                        chunk = await response.content.read(4096)
-                                    
-                                    if not chunk:
-                                        break
-
-                                    buffer += chunk
-                                    messages = buffer.split(b'\n\n')
-                                    buffer = messages.pop()
-
-                                    for msg in messages:
-                                        if not msg:
-                                            continue
-                                        
-                                        # 在解析前再次检查，减少延迟
-                                        if get_stop_requested_sync(real_generation_id):
-                                            final_status = "cancelled"
-                                            break
-
-                                        for line in msg.split(b'\n'):
-                                            line_str = line.decode('utf-8').strip()
-                                            if line_str.startswith('data: '):
-                                                chunk_data = line_str[6:]
-                                                if chunk_data == '[DONE]': # 以防万一，还是处理一下
-                                                    continue
-                                                try:
-                                                    chunk_json = json.loads(chunk_data)
-                                                    content_piece = extract_content_from_chunk(chunk_json)
-                                                    if content_piece:
-                                                        full_content += content_piece
-                                                        await _send_event(event_callback, conversation_id, 'stream_update', {
-                                                            'generation_id': real_generation_id,
-                                                            'content': content_piece,
-                                                            'temp_id': temp_id
-                                                        })
-                                                except json.JSONDecodeError:
-                                                    logger.error(f"JSON decode error for chunk: {chunk_data}")
-                                        
-                                    if final_status == "cancelled":
-                                        break
-
-                                except asyncio.TimeoutError:
-                                    logger.error(f"AI response chunk timeout after {INTER_CHUNK_TIMEOUT}s for conversation {conversation_id}")
-                                    final_status = "failed"
-                                    error_detail = f"响应超时：在 {INTER_CHUNK_TIMEOUT} 秒内未收到任何数据"
-                                    break
-                            
-                            if final_status not in ["cancelled", "failed"]:
-                                final_status = "completed" if full_content else "failed"
-
-                        else:
-                            # 5b. 处理非流式响应 (异步)
-                            response_json = await response.json()
-                            full_content = extract_content_from_chunk(response_json)
-                            if full_content:
-                                final_status = "completed"
-                                await _send_event(event_callback, conversation_id, 'full_message', {
-                                    'generation_id': real_generation_id,
-                                    'content': full_content,
-                                    'temp_id': temp_id
-                                })
+                if is_streaming:
+                    decoder = SSEDecoder()
+                    accumulator = ContentAccumulator()
+                    first_chunk = upstream.first_chunk
+
+                    async def _emit_stream_update(content):
+                        await _send_event(event_callback, conversation_id, 'stream_update', {
+                            'generation_id': real_generation_id,
+                            'content': content,
+                            'temp_id': temp_id
+                        })
+
+                    # 合并逐 token 的增量，减少 channel layer 消息数量
+                    coalescer = StreamCoalescer(_emit_stream_update)
+
+                    while True:
+                        try:
+                            # 检查停止信号（本地标志，不涉及任何 I/O）
+                            if cancel_token.cancelled:
+                                logger.warning(f"Service: Stop request detected for GenID {real_generation_id}. Stopping stream.")
+                                final_status = "cancelled"
+                                break
+
+                            if first_chunk is not None:
+                                # 首个数据块已在选择上游时读取
+                                chunk, first_chunk = first_chunk, None
                             else:
-                                logger.error("Non-streaming AI response completed but no content was extracted.")
-                                final_status = "failed"
+                                # 使用块间超时来防止无限期挂起（兼容 Py<3.11）；
+                                # 只有等待上游数据时允许停止请求直接取消，事件发送和合并刷新不会被打断
+                                async with timeout(INTER_CHUNK_TIMEOUT):
+                                    with cancel_token.armed():
+                                        chunk = await response.content.read(4096)
+
+                            payloads = decoder.feed(chunk) if chunk else decoder.close()
+
+                            if payloads and cancel_token.cancelled:
+                                # 在解析前再次检查，减少延迟
+                                final_status = "cancelled"
+                                break
+
+                            for chunk_data in payloads:
+                                try:
+                                    chunk_json = json.loads(chunk_data)
+                                    content_piece = extract_content_from_chunk(chunk_json)
+                                    if content_piece:
+                                        accumulator.append(content_piece)
+                                        await coalescer.add(content_piece)
+                                except json.JSONDecodeError:
+                                    logger.error(f"JSON decode error for chunk: {chunk_data}")
+
+                            if not chunk:
+                                break
+
+                        except asyncio.TimeoutError:
+                            logger.error(f"AI response chunk timeout after {INTER_CHUNK_TIMEOUT}s for conversation {conversation_id}")
+                            final_status = "failed"
+                            error_detail = f"响应超时：在 {INTER_CHUNK_TIMEOUT} 秒内未收到任何数据"
+                            break
+
+                    await coalescer.aclose()
+                    logger.debug(f"Service: GenID {real_generation_id} coalesced {coalescer.pieces_in} deltas into {coalescer.flushes} stream_update events.")
+                    full_content = accumulator.getvalue()
+                    if final_status not in ["cancelled", "failed"]:
+                        final_status = "completed" if full_content else "failed"
+
+                else:
+                    # 5b. 处理非流式响应 (异步)
+                    with cancel_token.armed():
+                        response_json = await response.json()
+                    full_content = extract_content_from_chunk(response_json)
+                    if full_content:
+                        final_status = "completed"
+                        await _send_event(event_callback, conversation_id, 'full_message', {
+                            'generation_id': real_generation_id,
+                            'content': full_content,
+                            'temp_id': temp_id
+                        })
                     else:
-                        error_text = await response.text()
-                        logger.error(f"AI API request failed with status {response.status}: {error_text}")
+                        logger.error("Non-streaming AI response completed but no content was extracted.")
                         final_status = "failed"
-                        error_detail = error_text
 
         # 6. 如果成功，保存AI消息
         if final_status == "completed":
             # 在保存前进行最后一次检查
-            if get_stop_requested_sync(real_generation_id):
+            if cancel_token.cancelled:
                 logger.warning(f"Service: Stop request detected for GenID {real_generation_id} just before saving. Discarding response.")
                 final_status = "cancelled"
             else:
@@ -236,6 +249,9 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
                     await delete_subsequent_ai_messages(conversation_id, user_message_id)
                 
                 ai_message = await save_ai_message(conversation_id, full_content, model['id'])
+                if cached_content is None:
+                    await completion_cache.astore(cache_key, full_content)
+                conversation_summarizer.schedule(conversation_id, model)
                 await _send_event(event_callback, conversation_id, 'id_update', {
                     'generation_id': real_generation_id,
                     'temp_id': temp_id,
@@ -243,8 +259,36 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
                 })
 
     except asyncio.CancelledError:
-        logger.warning(f"Service: Generation task for GenID {real_generation_id} was cancelled externally.")
-        final_status = "stopped"
+        if cancel_token.cancelled:
+            # 由停止请求触发的取消：按用户取消处理，并撤销本次取消以便完成清理
+            logger.warning(f"Service: Generation task for GenID {real_generation_id} was interrupted by a stop request.")
+            final_status = "cancelled"
+            task = asyncio.current_task()
+            if task is not None and hasattr(task, 'uncancel'):
+                task.uncancel()
+        else:
+            logger.warning(f"Service: Generation task for GenID {real_generation_id} was cancelled externally.")
+            final_status = "stopped"
+
+    except ContextBudgetError as e:
+        logger.warning(f"Service: Generation {real_generation_id} exceeds the model's context budget: {e}")
+        final_status = "failed"
+        error_detail = str(e)
+
+    except ProviderBusyError as e:
+        logger.warning(f"Service: Generation {real_generation_id} rejected by provider scheduler: {e}")
+        final_status = "failed"
+        error_detail = str(e)
+
+    except UpstreamHTTPError as e:
+        logger.error(f"AI API request failed with status {e.status}: {e.body}")
+        final_status = "failed"
+        error_detail = e.body
+
+    except asyncio.TimeoutError:
+        logger.error(f"AI response first chunk timeout for conversation {conversation_id}")
+        final_status = "failed"
+        error_detail = "响应超时：未能在规定时间内收到任何数据"
 
     except aiohttp.ClientError as e:
         logger.error(f"Network error in generate_ai_response for conversation {conversation_id}: {e}", exc_info=True)
@@ -257,19 +301,29 @@ async def generate_ai_response(conversation_id, model_id, message=None, user_mes
         error_detail = f"内部服务器错误: {e}"
 
     finally:
+        cancellation_registry.unregister(cancel_token)
+        stop_heartbeat.untrack(real_generation_id)
+
         # --- 新的、更健壮的最终状态检查 ---
         # 在发送最终事件和清理之前，做最后一次检查。
         # 这可以捕获在任务主体执行完毕后、但在 finally 块开始前收到的停止信号。
-        if final_status == "completed" and get_stop_requested_sync(real_generation_id):
+        if final_status == "completed" and cancel_token.cancelled:
             logger.warning(f"Service: Stop request for GenID {real_generation_id} detected in finally block. Overriding status to 'cancelled'.")
             final_status = "cancelled"
 
         # 7. 清理并发送结束信号
+        if coalescer:
+            # 确保所有已缓冲的增量在 generation_end 之前发出
+            try:
+                await coalescer.aclose()
+            except Exception as e:
+                logger.error(f"Service: Failed to flush pending stream updates for GenID {real_generation_id}: {e}")
+
         if conversation and real_generation_id:
-            await clear_db_generation_id(conversation_id, real_generation_id)
+            await generation_registry.afinish(conversation_id, real_generation_id)
             
             # 任务结束时，无论结果如何，都主动、确定地清理停止信号
-            clear_stop_request_sync(real_generation_id)
+            await clear_stop_request_async(real_generation_id)
 
             event_data = {
                 'generation_id': real_generation_id,
@@ -288,123 +342,74 @@ from channels.db import database_sync_to_async
 @database_sync_to_async
 def get_conversation_async(conversation_id):
     try:
-        conv = Conversation.objects.get(id=conversation_id)
+        conv = Conversation.objects.select_related('summary_until').get(id=conversation_id)
         return {
             'id': conv.id,
-            'system_prompt': conv.system_prompt
+            'user_id': conv.user_id,
+            'system_prompt': conv.system_prompt,
+            'summary': conversation_summary(conv)
         }
     except Conversation.DoesNotExist:
         return None
 
+def _model_to_dict(model):
+    """将 AIModel（含提供商）转换为生成任务使用的字典"""
+    return {
+        'id': model.id,
+        'model_name': model.model_name,
+        'max_context': model.max_context,
+        'max_history_messages': model.max_history_messages,
+        'default_params': model.default_params,
+        'max_concurrent': model.max_concurrent_requests,
+        'equivalence_group': model.equivalence_group,
+        'response_cache_enabled': model.response_cache_enabled,
+        'summary_model_id': model.summary_model_id,
+        'provider_id': model.provider_id,
+        'provider_base_url': model.provider.base_url,
+        'provider_api_key': model.provider.api_key,
+        'provider_max_concurrent': model.provider.max_concurrent_requests,
+        'provider_max_queued': model.provider.max_queued_requests,
+    }
+
 @database_sync_to_async
 def get_model_async(model_id):
     try:
-        model = AIModel.objects.select_related('provider').get(id=model_id)
-        return {
-            'id': model.id,
-            'model_name': model.model_name,
-            'max_history_messages': model.max_history_messages,
-            'default_params': model.default_params,
-            'provider_base_url': model.provider.base_url,
-            'provider_api_key': model.provider.api_key
-        }
+        return _model_to_dict(AIModel.objects.select_related('provider').get(id=model_id))
     except AIModel.DoesNotExist:
         return None
 
+def _get_equivalent_models_sync(model):
+    """返回与该模型属于同一等价模型组的其他可用模型，用于对冲和故障转移"""
+    if not model.get('equivalence_group'):
+        return []
+    equivalents = AIModel.objects.select_related('provider').filter(
+        equivalence_group=model['equivalence_group'], is_active=True, provider__is_active=True
+    ).exclude(id=model['id']).order_by('id')
+    return [_model_to_dict(equivalent) for equivalent in equivalents]
+
+get_equivalent_models_async = database_sync_to_async(_get_equivalent_models_sync)
+
+def build_chat_request(model, messages, is_streaming):
+    """为指定模型构建 chat/completions 请求，返回 (api_url, headers, request_data)"""
+    request_data = {
+        "model": model['model_name'],
+        "messages": messages,
+        "stream": is_streaming,
+        **model['default_params']
+    }
+    api_url = ensure_valid_api_url(model['provider_base_url'], "/v1/chat/completions")
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {model['provider_api_key']}"}
+    return api_url, headers, request_data
+
 @database_sync_to_async
 def prepare_history_messages(conversation, model, user_message_id, is_regenerate):
-    """准备用于API请求的消息历史记录，支持多模态内容。"""
-    if is_regenerate:
-        user_message = Message.objects.get(id=user_message_id)
-        history_qs = Message.objects.filter(
-            conversation_id=conversation['id'],
-            timestamp__lte=user_message.timestamp
-        ).order_by('timestamp')
-    else:
-        history_qs = Message.objects.filter(conversation_id=conversation['id']).order_by('timestamp')
-
-    # 预先获取所有消息到列表中，避免在异步上下文中对QuerySet进行多次操作
-    history_messages = list(history_qs)
-
-    if len(history_messages) > model['max_history_messages']:
-        history_messages = history_messages[-model['max_history_messages']:]
-
-    messages = []
-    if conversation.get('system_prompt'):
-        messages.append({"role": "system", "content": conversation['system_prompt']})
-    
-    from .image_config import IMAGE_CONTEXT_STRATEGY, MAX_IMAGES_IN_CONTEXT
-    
-    # --- 健壮的 "一次成型" 方案 ---
-    
-    # 1. 识别所有候选图片消息
-    all_image_message_ids = [
-        msg.id for msg in history_messages
-        if msg.is_user and re.search(r'\[file:(.*?)\]', msg.content)
-    ]
-    
-    # 2. 根据策略确定哪些图片需要被完整包含
-    latest_image_ids_to_include = set()
-    if IMAGE_CONTEXT_STRATEGY == "all":
-        latest_image_ids_to_include = set(all_image_message_ids)
-    elif IMAGE_CONTEXT_STRATEGY == "latest_only":
-        latest_image_ids_to_include = set(all_image_message_ids[-MAX_IMAGES_IN_CONTEXT:])
-    
-    # 3. 一次性构建最终消息列表
-    for msg in history_messages:
-        role = "user" if msg.is_user else "assistant"
-        
-        if msg.id in latest_image_ids_to_include:
-            # --- 处理需要包含完整图片数据的消息 ---
-            file_match = re.search(r'\[file:(.*?)\]', msg.content)
-            file_path = file_match.group(1)
-            text_content = msg.content.replace(file_match.group(0), '').strip()
-            
-            try:
-                if default_storage.exists(file_path):
-                    with default_storage.open(file_path, 'rb') as f:
-                        file_data = f.read()
-                    
-                    base64_content = base64.b64encode(file_data).decode('utf-8')
-                    mime_type, _ = mimetypes.guess_type(file_path)
-                    if not mime_type:
-                        mime_type = 'application/octet-stream'
-                    
-                    multi_modal_content = [
-                        {"type": "text", "text": text_content},
-                        {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_content}"}}
-                    ]
-                    messages.append({"role": role, "content": multi_modal_content})
-                    logger.info(f"已将图片消息 {msg.id} 的完整内容添加到上下文中。")
-                else:
-                    logger.warning(f"文件 '{file_path}' 在消息 {msg.id} 中被引用但未找到。")
-                    final_content = f"{text_content}\n[图片上传失败: 文件不存在]"
-                    messages.append({"role": role, "content": final_content})
-            except Exception as e:
-                logger.error(f"处理消息 {msg.id} 中的文件 '{file_path}' 时出错: {e}", exc_info=True)
-                final_content = f"{text_content}\n[图片处理失败]"
-                messages.append({"role": role, "content": final_content})
-        
-        elif msg.is_user and re.search(r'\[file:(.*?)\]', msg.content):
-            # --- 处理较旧的、不需要包含完整图片数据的图片消息 ---
-            file_match = re.search(r'\[file:(.*?)\]', msg.content)
-            file_path = file_match.group(1)
-            text_content = msg.content.replace(file_match.group(0), '').strip()
-            
-            image_description = f"[用户上传了图片: {os.path.basename(file_path)}]"
-            final_content = f"{text_content}\n{image_description}" if text_content else image_description
-            messages.append({"role": role, "content": final_content})
-            logger.info(f"已将旧图片消息 {msg.id} 的文本描述添加到上下文中。")
-            
-        else:
-            # --- 处理普通文本消息 ---
-            messages.append({"role": role, "content": msg.content})
-            
-    logger.info(f"准备了 {len(messages)} 条消息用于API请求，图片策略: {IMAGE_CONTEXT_STRATEGY}")
-    return messages
+    """准备用于API请求的消息历史记录，按模型的上下文长度裁剪（见 context_builder）。"""
+    return build_history_messages(
+        conversation['id'], conversation.get('system_prompt'), model, user_message_id, is_regenerate, summary=conversation.get('summary')
+    )
 
-@database_sync_to_async
-def save_ai_message(conversation_id, content, model_id, generation_id=None):
+def _save_ai_message_sync(conversation_id, content, model_id, generation_id=None):
+    """保存AI回复（同步版本，WebSocket 和 HTTP 两条路径共用）"""
     conversation = Conversation.objects.get(id=conversation_id)
     model = AIModel.objects.get(id=model_id)
     ai_message = Message.objects.create(
@@ -414,11 +419,13 @@ def save_ai_message(conversation_id, content, model_id, generation_id=None):
         model_used=model,
         generation_id=generation_id
     )
-    conversation.save()
+    # 只刷新 updated_at：整行保存会把读取时的 summary / summary_until 写回，覆盖后台摘要任务的更新
+    conversation.save(update_fields=['updated_at'])
     return {'id': ai_message.id}
 
-@database_sync_to_async
-def delete_subsequent_ai_messages(conversation_id, user_message_id):
+save_ai_message = database_sync_to_async(_save_ai_message_sync)
+
+def _delete_subsequent_ai_messages_sync(conversation_id, user_message_id):
     """删除指定用户消息之后的所有AI消息"""
     try:
         user_message = Message.objects.get(id=user_message_id)
@@ -430,32 +437,12 @@ def delete_subsequent_ai_messages(conversation_id, user_message_id):
     except Message.DoesNotExist:
         logger.error(f"Cannot find user message {user_message_id} to delete subsequent messages.")
 
-@database_sync_to_async
-def set_db_generation_id(conversation_id, generation_id):
-    Conversation.objects.filter(id=conversation_id).update(current_generation_id=generation_id)
-
-@database_sync_to_async
-def clear_db_generation_id(conversation_id, generation_id_to_clear):
-    conv = Conversation.objects.filter(id=conversation_id).first()
-    if conv and str(conv.current_generation_id) == str(generation_id_to_clear):
-        conv.current_generation_id = None
-        conv.save(update_fields=['current_generation_id'])
+delete_subsequent_ai_messages = database_sync_to_async(_delete_subsequent_ai_messages_sync)
 
 # --- 辅助 Channel Layer 函数 ---
 async def send_generation_event(conversation_id, event_type, data):
-    """向客户端发送生成事件"""
-    channel_layer = get_channel_layer()
-    group_name = f'chat_{conversation_id}'
-    
-    message_to_send = {
-        'type': 'broadcast_event',
-        'event': {
-            'type': event_type,
-            'data': data
-        }
-    }
-    
-    await channel_layer.group_send(group_name, message_to_send)
+    """向客户端发送生成事件：订阅者都在本进程时直接投递，否则经过 channel layer（见 event_dispatch）"""
+    await event_dispatcher.dispatch(conversation_id, event_type, data)
 
 # --- 辅助内容提取函数 ---
 def extract_content_from_chunk(chunk_json):
@@ -469,8 +456,6 @@ def extract_content_from_chunk(chunk_json):
     return None
 
 
-import threading
-import queue
 from concurrent.futures import ThreadPoolExecutor
 
 # =====================================================================================
@@ -489,243 +474,197 @@ logger.info(f"Initialized HTTP worker thread pool with max_workers={max_threads}
 def _get_model_sync(model_id):
     """同步获取模型信息"""
     try:
-        model = AIModel.objects.select_related('provider').get(id=model_id)
-        return {
-            'id': model.id,
-            'model_name': model.model_name,
-            'max_history_messages': model.max_history_messages,
-            'default_params': model.default_params,
-            'provider_base_url': model.provider.base_url,
-            'provider_api_key': model.provider.api_key
-        }
+        return _model_to_dict(AIModel.objects.select_related('provider').get(id=model_id))
     except AIModel.DoesNotExist:
         return None
 
-def _prepare_history_messages_sync(conversation_id, system_prompt, model, user_message_id, is_regenerate, generation_id=None):
-    """同步准备API请求的消息历史，支持多模态"""
-    if is_regenerate:
-        user_message = get_object_or_404(Message, id=user_message_id)
-        history_qs = Message.objects.filter(
-            conversation_id=conversation_id,
-            timestamp__lte=user_message.timestamp
-        ).order_by('timestamp')
-    else:
-        history_qs = Message.objects.filter(conversation_id=conversation_id).order_by('timestamp')
-
-    history_messages = list(history_qs.all())
-
-    if len(history_messages) > model['max_history_messages']:
-        history_messages = history_messages[-model['max_history_messages']:]
+async def _running_loop():
+    return asyncio.get_running_loop()
 
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
+def capture_event_loop():
+    """
+    在同步视图中获取 worker 的事件循环，供之后在工作线程中广播事件。
+    ASGI 下同步视图运行在 sync_to_async 的线程中，async_to_sync 会把协程交回 worker 的事件循环执行；
+    没有外层事件循环时（WSGI、测试客户端）async_to_sync 使用的临时循环已经关闭，返回 None。
+    """
+    loop = async_to_sync(_running_loop)()
+    return None if loop.is_closed() else loop
 
-    from .image_config import IMAGE_CONTEXT_STRATEGY, MAX_IMAGES_IN_CONTEXT
-    
-    all_image_message_ids = [msg.id for msg in history_messages if msg.is_user and re.search(r'\[file:(.*?)\]', msg.content)]
-    
-    latest_image_ids_to_include = set()
-    if IMAGE_CONTEXT_STRATEGY == "all":
-        latest_image_ids_to_include = set(all_image_message_ids)
-    elif IMAGE_CONTEXT_STRATEGY == "latest_only":
-        latest_image_ids_to_include = set(all_image_message_ids[-MAX_IMAGES_IN_CONTEXT:])
-
-    for msg in history_messages:
-        role = "user" if msg.is_user else "assistant"
-        file_match = re.search(r'\[file:(.*?)\]', msg.content)
-
-        if msg.id in latest_image_ids_to_include and file_match:
-            file_path = file_match.group(1)
-            text_content = msg.content.replace(file_match.group(0), '').strip()
-            
-            try:
-                if default_storage.exists(file_path):
-                    with default_storage.open(file_path, 'rb') as f:
-                        file_data = f.read()
-                    base64_content = base64.b64encode(file_data).decode('utf-8')
-                    mime_type, _ = mimetypes.guess_type(file_path)
-                    if not mime_type: mime_type = 'application/octet-stream'
-                    multi_modal_content = [
-                        {"type": "text", "text": text_content},
-                        {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_content}"}}
-                    ]
-                    messages.append({"role": role, "content": multi_modal_content})
-                else:
-                    messages.append({"role": role, "content": f"{text_content}\n[图片上传失败: 文件不存在]"})
-            except Exception as e:
-                logger.error(f"处理消息 {msg.id} 中的文件 '{file_path}' 时出错: {e}", exc_info=True)
-                messages.append({"role": role, "content": f"{text_content}\n[图片处理失败]"})
-        
-        elif msg.is_user and file_match:
-            file_path = file_match.group(1)
-            text_content = msg.content.replace(file_match.group(0), '').strip()
-            image_description = f"[用户上传了图片: {os.path.basename(file_path)}]"
-            final_content = f"{text_content}\n{image_description}" if text_content else image_description
-            messages.append({"role": role, "content": final_content})
-        else:
-            messages.append({"role": role, "content": msg.content})
-            
-    return messages
 
-def _http_stream_generator(conversation_id, model_id, message_content, user_message_id, is_regenerate, generation_id, file_data=None, file_name=None):
+class EventBroadcaster:
     """
-    一个生成器函数，它处理线程化的AI请求并产生事件。
-    这是核心的非阻塞逻辑。
+    从工作线程广播生成事件。
+    指定了 worker 的事件循环时，用 run_coroutine_threadsafe 把发送交给该循环，复用循环上的 channel layer 连接，
+    工作线程不等待发送完成；每个事件在前一个事件发送完之后才发送，保持顺序。
+    没有事件循环或事件循环已经关闭时退回 async_to_sync，每次调用都会创建新的事件循环。
     """
-    logger.info(f"Threaded HTTP Stream Generator: Starting with ID {generation_id}")
-    q = queue.Queue()
 
-    def worker():
-        """在后台线程中运行的函数，执行网络请求并将结果放入队列。"""
+    def __init__(self, loop=None):
+        self._loop = loop
+        self._previous = None
+
+    def send(self, conversation_id, event_type, data):
+        if self._loop is not None:
+            coro = self._send_after(self._previous, conversation_id, event_type, data)
+            try:
+                self._previous = asyncio.run_coroutine_threadsafe(coro, self._loop)
+                return
+            except RuntimeError:
+                # 事件循环已关闭（worker 正在退出）
+                coro.close()
+                self._loop = None
         try:
-            conversation = get_object_or_404(Conversation, id=conversation_id)
-            model = _get_model_sync(model_id)
-            if not model: raise ValueError("AI model not found.")
-
-            if file_data and file_name and user_message_id:
-                try:
-                    # 使用 ContentFile 处理二进制数据
-                    file_content = ContentFile(file_data)
-                    saved_path = default_storage.save(f"uploads/{generation_id}_{file_name}", file_content)
-                    msg_to_update = Message.objects.get(id=user_message_id)
-                    new_content = f"{message_content}\n[file:{saved_path}]" if message_content.strip() else f"[file:{saved_path}]"
-                    msg_to_update.content = new_content
-                    msg_to_update.save()
-                except Exception as e:
-                    # 将异常放入队列，以便主线程可以处理它
-                    raise ValueError(f"File upload processing failed: {e}")
-
-            messages_for_api = _prepare_history_messages_sync(
-                conversation.id, conversation.system_prompt, model, user_message_id, is_regenerate, generation_id=generation_id
-            )
-            
-            request_data = {
-                "model": model['model_name'], "messages": messages_for_api,
-                "stream": True, **model['default_params'] # 始终流式请求
-            }
-            api_url = ensure_valid_api_url(model['provider_base_url'], "/v1/chat/completions")
-            headers = {"Content-Type": "application/json", "Authorization": f"Bearer {model['provider_api_key']}"}
-
-            with requests.post(
-                api_url, json=request_data, headers=headers,
-                stream=True, timeout=AI_REQUEST_TIMEOUT
-            ) as response:
-                response.raise_for_status()
-
-                for chunk in response.iter_content(chunk_size=4096):
-                    q.put(chunk)
-                    if get_stop_requested_sync(generation_id):
-                        logger.warning(f"Threaded HTTP Service: Stop detected for GenID {generation_id}. Worker thread terminating.")
-                        break
-        
+            async_to_sync(send_generation_event)(conversation_id, event_type, data)
         except Exception as e:
-            logger.error(f"Error in worker thread for GenID {generation_id}: {e}", exc_info=True)
-            q.put(e)
-        finally:
-            q.put(None) # 哨兵值，表示工作完成
+            logger.error(f"Threaded HTTP Service: Failed to broadcast {event_type} for conversation {conversation_id}: {e}")
+
+    async def _send_after(self, previous, conversation_id, event_type, data):
+        if previous is not None:
+            await asyncio.wrap_future(previous)
+        try:
+            await send_generation_event(conversation_id, event_type, data)
+        except Exception as e:
+            logger.error(f"Threaded HTTP Service: Failed to broadcast {event_type} for conversation {conversation_id}: {e}")
+
 
-    # 将 worker 提交到全局线程池执行
-    http_worker_pool.submit(worker)
+def _emit_event_sync(broadcaster, conversation_id, event_type, data):
+    """从工作线程发布事件：写入可重放的事件日志，并广播给该会话的 WebSocket 订阅者。"""
+    seq = generation_event_log.append(data['generation_id'], conversation_id, event_type, data)
+    if seq is not None:
+        data = {**data, 'seq': seq}
+    broadcaster.send(conversation_id, event_type, data)
 
-    # --- 事件处理循环，现在是生成器的主体 ---
-    full_content = ""
+
+def run_http_generation(conversation_id, model_id, message_content, user_message_id, is_regenerate, generation_id, file_data=None, file_name=None, event_loop=None):
+    """
+    在当前线程中完整地执行一次 HTTP 回退路径的生成，不依赖任何客户端连接。
+    - 所有事件写入 generation_event_log（并广播到 channel layer），SSE 响应或之后接入的订阅者从日志中读取。
+    - 在工作线程中运行时，event_loop 应为发起请求的 worker 的事件循环（见 capture_event_loop），广播在该循环上进行。
+    - 成功时通过 save_ai_message 的同步版本保存回复，与 WebSocket 路径一致。
+    - 对AI的请求始终是流式的，以避免超时并允许中断。
+    返回 {'status', 'content', 'message_id', 'error'}。
+    """
+    logger.info(f"Threaded HTTP Service: Starting generation with ID {generation_id}")
+    accumulator = ContentAccumulator()
     final_status = "unknown"
     error_detail = None
-    buffer = b""
-    
-    last_heartbeat_time = time.time()
-    HEARTBEAT_INTERVAL = 15
+    message_id = None
+    started = False
+    coalescer = None
+    broadcaster = EventBroadcaster(event_loop)
+    stop_heartbeat.track(generation_id)
 
-    while True:
-        if get_stop_requested_sync(generation_id):
-            final_status = "cancelled"
-            logger.warning(f"Threaded HTTP Service: Stop detected for GenID {generation_id} in main thread. Aborting.")
-            break
+    try:
+        conversation = get_object_or_404(Conversation.objects.select_related('summary_until'), id=conversation_id)
+        model = _get_model_sync(model_id)
+        if not model: raise ValueError("AI model not found.")
 
-        try:
-            item = q.get(timeout=1.0)
-        except queue.Empty:
-            if time.time() - last_heartbeat_time > HEARTBEAT_INTERVAL:
-                touch_stop_request_sync(generation_id)
-                last_heartbeat_time = time.time()
-            continue
-
-        if item is None: # 哨兵值，流结束
-            break
-        if isinstance(item, Exception):
-            final_status, error_detail = "failed", f"AI服务请求失败: {item}"
-            break
-
-        buffer += item
-        messages = buffer.split(b'\n\n')
-        buffer = messages.pop()
-
-        for msg in messages:
-            if not msg: continue
-            if get_stop_requested_sync(generation_id):
-                final_status = "cancelled"
-                break
-            
-            for line in msg.split(b'\n'):
-                line_str = line.decode('utf-8').strip()
-                if line_str.startswith('data: '):
-                    chunk_data = line_str[6:]
-                    if chunk_data == '[DONE]': continue
+        if file_data and file_name and user_message_id:
+            try:
+                stored = save_image_upload(file_data, file_name, generation_id)
+                Attachment.objects.create(message_id=user_message_id, **stored)
+            except Exception as e:
+                raise ValueError(f"File upload processing failed: {e}")
+
+        generation_registry.start(conversation_id, generation_id, model_id)
+        started = True
+        _emit_event_sync(broadcaster, conversation_id, 'generation_start', {'generation_id': generation_id, 'temp_id': generation_id})
+
+        messages_for_api = build_history_messages(
+            conversation.id, conversation.system_prompt, model, user_message_id, is_regenerate, summary=conversation_summary(conversation)
+        )
+
+        candidates = [model] + _get_equivalent_models_sync(model)
+
+        def _build_request(candidate):
+            return build_chat_request(candidate, messages_for_api, True) # 始终流式请求
+
+        cache_key, cached_content = completion_cache.lookup(model, messages_for_api, bypass=is_regenerate)
+
+        decoder = SSEDecoder()
+        # 与 WebSocket 路径使用相同的合并策略（STREAM_COALESCE_INTERVAL_MS / STREAM_COALESCE_MAX_BYTES）
+        coalescer = SyncStreamCoalescer(lambda content: _emit_event_sync(broadcaster, conversation_id, 'stream_update', {
+            'generation_id': generation_id, 'content': content, 'temp_id': generation_id
+        }))
+
+        def _emit_queue_position(position):
+            _emit_event_sync(broadcaster, conversation_id, 'queue_position', {
+                'generation_id': generation_id, 'temp_id': generation_id, 'position': position
+            })
+
+        if cached_content is not None:
+            # 命中回复缓存：以合成的流式响应重放
+            upstream_context = nullcontext(CachedCompletion(model, cached_content).response)
+        else:
+            # 连接错误、429 和 5xx 时自动切换到等价模型组中的其他提供商
+            upstream_context = open_upstream_sync(
+                candidates, conversation.user_id, _build_request, AI_REQUEST_TIMEOUT,
+                on_queued=_emit_queue_position, should_abort=lambda: get_stop_requested_sync(generation_id)
+            )
+        with upstream_context as response:
+            for chunk in itertools.chain(response.iter_content(chunk_size=4096), [None]):
+                if get_stop_requested_sync(generation_id):
+                    logger.warning(f"Threaded HTTP Service: Stop detected for GenID {generation_id}. Aborting.")
+                    final_status = "cancelled"
+                    break
+
+                payloads = decoder.feed(chunk) if chunk is not None else decoder.close()
+                for chunk_data in payloads:
                     try:
-                        chunk_json = json.loads(chunk_data)
-                        content_piece = extract_content_from_chunk(chunk_json)
+                        content_piece = extract_content_from_chunk(json.loads(chunk_data))
                         if content_piece:
-                            full_content += content_piece
-                            # 无条件地产生更新事件
-                            yield {'type': 'stream_update', 'data': {'content': content_piece, 'generation_id': generation_id}}
+                            accumulator.append(content_piece)
+                            coalescer.add(content_piece)
                     except json.JSONDecodeError:
                         logger.warning(f"Could not decode stream chunk: {chunk_data}")
-            if final_status == "cancelled": break
-        if final_status == "cancelled": break
-    
-    if final_status not in ["cancelled", "failed"]:
-        final_status = "completed" if full_content else "failed"
-        if final_status == "failed": error_detail = "No content received from AI."
+        coalescer.close()
 
-    end_event_data = {'status': final_status, 'generation_id': generation_id, 'full_content': full_content}
-    if error_detail: end_event_data['error'] = error_detail
-    # 无条件地产生结束事件
-    yield {'type': 'generation_end', 'data': end_event_data}
+        full_content = accumulator.getvalue()
+        if final_status != "cancelled":
+            final_status = "completed" if full_content else "failed"
+            if final_status == "failed": error_detail = "No content received from AI."
 
+        if final_status == "completed":
+            if get_stop_requested_sync(generation_id):
+                final_status = "cancelled"
+            else:
+                if is_regenerate:
+                    _delete_subsequent_ai_messages_sync(conversation_id, user_message_id)
+                message_id = _save_ai_message_sync(conversation_id, full_content, model_id, generation_id=generation_id)['id']
+                if cached_content is None:
+                    completion_cache.store(cache_key, full_content)
+                conversation_summarizer.schedule(conversation_id, model)
+                _emit_event_sync(broadcaster, conversation_id, 'id_update', {
+                    'generation_id': generation_id, 'message_id': message_id, 'temp_id': generation_id
+                })
 
-def generate_ai_response_for_http(conversation_id, model_id, message_content, user_message_id, is_regenerate, generation_id, is_streaming, file_data=None, file_name=None):
-    """
-    为同步的HTTP视图生成AI回复。
-    - 使用后台线程和队列来执行 `requests` 调用，避免阻塞主线程。
-    - 关键：对AI的请求始终是流式的，以避免超时并允许中断。
-    - 根据 is_streaming 参数，返回同步生成器或结果字典。
-    """
-    
-    # 获取生成器
-    response_generator = _http_stream_generator(
-        conversation_id, model_id, message_content, user_message_id, 
-        is_regenerate, generation_id, file_data, file_name
-    )
+    except QueueAbortedError:
+        logger.warning(f"Threaded HTTP Service: Stop detected for GenID {generation_id} while queued. Aborting.")
+        final_status = "cancelled"
 
-    if is_streaming:
-        # 对于流式请求，直接返回生成器。
-        return response_generator
-    else:
-        # 对于非流式请求，消耗生成器并返回最终的字典。
-        final_event_data = None
-        for event in response_generator:
-            if event['type'] == 'generation_end':
-                final_event_data = event['data']
-                # 我们只需要最后一个事件，所以可以跳出循环
-                break
-        
-        if not final_event_data:
-            return {'status': 'failed', 'error': 'Incomplete generation process.'}
-
-        if final_event_data['status'] == 'completed':
-            return {'status': 'completed', 'content': final_event_data['full_content']}
-        elif final_event_data['status'] == 'cancelled':
-            return {'status': 'cancelled', 'error': 'Generation was cancelled by user.'}
-        else: # failed
-            return {'status': 'failed', 'error': final_event_data.get('error') or 'Unknown error.'}
+    except ContextBudgetError as e:
+        logger.warning(f"Threaded HTTP Service: Generation {generation_id} exceeds the model's context budget: {e}")
+        final_status, error_detail = "failed", str(e)
+
+    except ProviderBusyError as e:
+        logger.warning(f"Threaded HTTP Service: Generation {generation_id} rejected by provider scheduler: {e}")
+        final_status, error_detail = "failed", str(e)
+
+    except Exception as e:
+        logger.error(f"Error in HTTP generation for GenID {generation_id}: {e}", exc_info=True)
+        final_status, error_detail = "failed", f"AI服务请求失败: {e}"
+
+    finally:
+        if coalescer is not None:
+            # 异常退出时也先发送已缓冲的内容，保证其在 generation_end 之前
+            coalescer.close()
+        stop_heartbeat.untrack(generation_id)
+        if started:
+            generation_registry.finish(conversation_id, generation_id)
+        clear_stop_request_sync(generation_id)
+        end_event_data = {'status': final_status, 'generation_id': generation_id}
+        if error_detail: end_event_data['error'] = error_detail
+        _emit_event_sync(broadcaster, conversation_id, 'generation_end', end_event_data)
+        logger.info(f"Threaded HTTP Service: Generation {generation_id} finished with status: {final_status}")
+
+    return {'status': final_status, 'content': accumulator.getvalue(), 'message_id': message_id, 'error': error_detail}
@@ -0,0 +1,220 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+# 文件头：魔数、槽位数量、最大探测长度、每个槽位的值字节数
+_HEADER = struct.Struct('<8sIII')
+_MAGIC = b'MCSTOP02'
+_DATA_OFFSET = 64
+
+# 槽位：键的摘要（全零表示从未使用）、过期时间（CLOCK_MONOTONIC，同一主机上的所有进程共用），之后是 value_size 字节的值
+_SLOT = struct.Struct('<16sd')
+_EMPTY_KEY = bytes(16)
+
+# 每个键最多探测的槽位数量；槽位数组末尾多出同样数量的溢出槽位，探测不需要回绕
+MAX_PROBES = 32
+
+
+def _key_digest(generation_id):
+    digest = hashlib.blake2b(str(generation_id).encode('utf-8'), digest_size=16).digest()
+    # 全零摘要保留给空槽位
+    return digest if digest != _EMPTY_KEY else b'\x01' + digest[1:]
+
+
+class SharedStopTable:
+    """
+    基于内存映射文件（默认位于 /dev/shm）的定长哈希表，供同一主机上的多个 worker 进程共享停止标志。
+    - 开放寻址、线性探测：键只会出现在其起始槽位之后的 MAX_PROBES 个槽位中。
+    - 细粒度锁：每次操作只对该键的探测窗口加 fcntl 字节范围锁（读为共享锁，写为排他锁），
+      探测窗口不重叠的操作互不阻塞；同一进程内的线程另由进程内的锁串行化（fcntl 锁按进程持有）。
+    - 条目带过期时间，过期或被清除的槽位可被后续写入复用；窗口中全部是有效条目时淘汰最早过期的一个。
+    - value_size 大于 0 时每个条目另外携带定长的值（不足部分以零字节填充），停止标志表只使用键。
+    表的结构在首次创建时确定，多个进程以相同参数打开同一文件；参数不一致时以文件头为准。
+    """
+
+    def __init__(self, path, slots, clock=time.monotonic, value_size=0):
+        import fcntl
+
+        self._fcntl = fcntl
+        self.path = path
+        self._clock = clock
+        self._local_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self.slots, self.max_probes, self.value_size = self._initialize(slots, value_size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            self._slot_size = _SLOT.size + self.value_size
+            self._map = mmap.mmap(self._fd, self._file_size(self.slots, self.max_probes, self.value_size))
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    @staticmethod
+    def _file_size(slots, max_probes, value_size):
+        return _DATA_OFFSET + (slots + max_probes) * (_SLOT.size + value_size)
+
+    def _initialize(self, slots, value_size):
+        """在文件锁内读取文件头；文件为新建或格式不符时按给定参数初始化。"""
+        header = os.pread(self._fd, _HEADER.size, 0)
+        if len(header) == _HEADER.size:
+            magic, existing_slots, max_probes, existing_value_size = _HEADER.unpack(header)
+            if magic == _MAGIC and os.fstat(self._fd).st_size >= self._file_size(existing_slots, max_probes, existing_value_size):
+                return existing_slots, max_probes, existing_value_size
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, self._file_size(slots, MAX_PROBES, value_size))
+        os.pwrite(self._fd, _HEADER.pack(_MAGIC, slots, MAX_PROBES, value_size), 0)
+        return slots, MAX_PROBES, value_size
+
+    def _window(self, digest):
+        home = int.from_bytes(digest[:8], 'little') % self.slots
+        return home, _DATA_OFFSET + home * self._slot_size, self.max_probes * self._slot_size
+
+    def _locked(self, digest, exclusive):
+        return _WindowLock(self, digest, exclusive)
+
+    def _read_slot(self, index):
+        return _SLOT.unpack_from(self._map, _DATA_OFFSET + index * self._slot_size)
+
+    def _read_value(self, index):
+        start = _DATA_OFFSET + index * self._slot_size + _SLOT.size
+        return self._map[start:start + self.value_size].rstrip(b'\0')
+
+    def _write_slot(self, index, key, expires_at, value=None):
+        offset = _DATA_OFFSET + index * self._slot_size
+        _SLOT.pack_into(self._map, offset, key, expires_at)
+        if value is not None:
+            start = offset + _SLOT.size
+            self._map[start:start + self.value_size] = value.ljust(self.value_size, b'\0')
+
+    def _find(self, digest, home):
+        """返回键所在的槽位；不存在时返回 None。"""
+        for index in range(home, home + self.max_probes):
+            key, _expires_at = self._read_slot(index)
+            if key == digest:
+                return index
+            if key == _EMPTY_KEY:
+                return None
+        return None
+
+    def get(self, generation_id):
+        """返回键是否存在且未过期。"""
+        digest = _key_digest(generation_id)
+        with self._locked(digest, exclusive=False) as home:
+            index = self._find(digest, home)
+            if index is None:
+                return False
+            return self._read_slot(index)[1] > self._clock()
+
+    def get_value(self, generation_id):
+        """返回键的值（去掉末尾的零字节）；键不存在或已过期时返回 None。"""
+        digest = _key_digest(generation_id)
+        with self._locked(digest, exclusive=False) as home:
+            index = self._find(digest, home)
+            if index is None or self._read_slot(index)[1] <= self._clock():
+                return None
+            return self._read_value(index)
+
+    def set(self, generation_id, ttl, value=b''):
+        """写入或覆盖键（及其值）；返回因窗口已满而被淘汰的条目数（0 或 1）。"""
+        if len(value) > self.value_size:
+            raise ValueError(f"值的长度 {len(value)} 超过了槽位的 {self.value_size} 字节")
+        digest = _key_digest(generation_id)
+        expires_at = self._clock() + ttl
+        with self._locked(digest, exclusive=True) as home:
+            now = self._clock()
+            reusable = None
+            oldest = None
+            for index in range(home, home + self.max_probes):
+                key, slot_expires_at = self._read_slot(index)
+                if key == digest:
+                    self._write_slot(index, digest, expires_at, value)
+                    return 0
+                if key == _EMPTY_KEY:
+                    if reusable is None:
+                        reusable = index
+                    break
+                if slot_expires_at <= now:
+                    if reusable is None:
+                        reusable = index
+                elif oldest is None or slot_expires_at < oldest[1]:
+                    oldest = (index, slot_expires_at)
+            if reusable is not None:
+                self._write_slot(reusable, digest, expires_at, value)
+                return 0
+            self._write_slot(oldest[0], digest, expires_at, value)
+            return 1
+
+    def touch(self, generation_id, ttl):
+        """键存在且未过期时延长其过期时间；返回是否续期。"""
+        digest = _key_digest(generation_id)
+        with self._locked(digest, exclusive=True) as home:
+            index = self._find(digest, home)
+            if index is None or self._read_slot(index)[1] <= self._clock():
+                return False
+            self._write_slot(index, digest, self._clock() + ttl)
+            return True
+
+    def clear(self, generation_id, match=None):
+        """
+        清除键（槽位保留为已过期，供后续写入复用）；返回键此前是否有效。
+        指定 match 时只在 match(当前值) 为真时清除，比较和清除在同一次加锁内完成。
+        """
+        digest = _key_digest(generation_id)
+        with self._locked(digest, exclusive=True) as home:
+            index = self._find(digest, home)
+            if index is None:
+                return False
+            if match is not None and not match(self._read_value(index)):
+                return False
+            was_live = self._read_slot(index)[1] > self._clock()
+            self._write_slot(index, digest, 0.0)
+            return was_live
+
+    def live_entries(self):
+        """扫描整个表，返回未过期的条目数（仅用于统计，不加锁）。"""
+        now = self._clock()
+        slot = struct.Struct(f'{_SLOT.format}{self.value_size}x')
+        view = memoryview(self._map)[_DATA_OFFSET:self._file_size(self.slots, self.max_probes, self.value_size)]
+        try:
+            return sum(1 for key, expires_at in slot.iter_unpack(view) if key != _EMPTY_KEY and expires_at > now)
+        finally:
+            view.release()
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class _WindowLock:
+    """对键的探测窗口加锁，进入时返回起始槽位。"""
+
+    __slots__ = ('table', 'home', 'start', 'length', 'exclusive')
+
+    def __init__(self, table, digest, exclusive):
+        self.table = table
+        self.home, self.start, self.length = table._window(digest)
+        self.exclusive = exclusive
+
+    def __enter__(self):
+        table = self.table
+        table._local_lock.acquire()
+        try:
+            mode = table._fcntl.LOCK_EX if self.exclusive else table._fcntl.LOCK_SH
+            table._fcntl.lockf(table._fd, mode, self.length, self.start)
+        except BaseException:
+            table._local_lock.release()
+            raise
+        return self.home
+
+    def __exit__(self, exc_type, exc, tb):
+        table = self.table
+        try:
+            table._fcntl.lockf(table._fd, table._fcntl.LOCK_UN, self.length, self.start)
+        finally:
+            table._local_lock.release()
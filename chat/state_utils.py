@@ -1,15 +1,62 @@
+import asyncio
 import os
 import json
+import heapq
 import logging
 import redis
+import tempfile
 import threading
+import time
+import weakref
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
 # --- 常量 ---
 DEFAULT_STOP_TTL = 120  # 停止请求的默认TTL（秒）
 
+# 内存模式下最多保存的停止请求数量，超过时淘汰最久未使用的条目
+try:
+    STOP_REQUEST_MAX_ENTRIES = int(os.getenv('STOP_REQUEST_MAX_ENTRIES', '10000'))
+except (ValueError, TypeError):
+    STOP_REQUEST_MAX_ENTRIES = 10000
+
+# Redis 模式下每个事件循环的异步连接池大小；连接用尽时等待空闲连接，而不是报错
+try:
+    STOP_REQUEST_REDIS_MAX_CONNECTIONS = int(os.getenv('STOP_REQUEST_REDIS_MAX_CONNECTIONS', '50'))
+except (ValueError, TypeError):
+    STOP_REQUEST_REDIS_MAX_CONNECTIONS = 50
+
+# Redis 模式下停止标志近端缓存的有效期（秒）：订阅失效频道期间，条目最多缓存这么久；设为 0 禁用近端缓存
+try:
+    STOP_NEAR_CACHE_MAX_AGE = float(os.getenv('STOP_NEAR_CACHE_MAX_AGE', '30'))
+except (ValueError, TypeError):
+    STOP_NEAR_CACHE_MAX_AGE = 30.0
+
+# 失效频道的订阅未建立或已断开时，近端缓存条目的有效期（秒）
+try:
+    STOP_NEAR_CACHE_FALLBACK_TTL = float(os.getenv('STOP_NEAR_CACHE_FALLBACK_TTL', '0.5'))
+except (ValueError, TypeError):
+    STOP_NEAR_CACHE_FALLBACK_TTL = 0.5
+
+# 停止标志写入或清除时广播失效消息的 Redis 频道，消息内容为 generation_id
+STOP_INVALIDATION_CHANNEL = "stop_request_invalidate"
+
+# 共享内存模式下停止标志表的文件路径；同一主机上的所有 worker 必须使用同一路径
+STOP_REQUEST_SHM_PATH = os.getenv('STOP_REQUEST_SHM_PATH') or os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'my-chatbox-stop-requests'
+)
+
+# 共享内存模式下停止标志表的槽位数量（每个槽位 24 字节），应明显大于同时进行的生成任务数量
+try:
+    STOP_REQUEST_SHM_SLOTS = int(os.getenv('STOP_REQUEST_SHM_SLOTS', '16384'))
+except (ValueError, TypeError):
+    STOP_REQUEST_SHM_SLOTS = 16384
+
+# 内存模式下批量清理过期条目的最小间隔（秒）
+STOP_REQUEST_SWEEP_INTERVAL = 1.0
+
 # --- 缓存抽象基类 ---
 class StopRequestCache(ABC):
     """处理停止请求状态的抽象基类。"""
@@ -34,6 +81,95 @@ class StopRequestCache(ABC):
         """清除给定 generation_id 的停止请求。"""
         pass
 
+    def touch_stop_requests(self, generation_ids, ttl=DEFAULT_STOP_TTL):
+        """批量续期多个停止请求（供 heartbeat.StopHeartbeatService 使用）。"""
+        for generation_id in generation_ids:
+            self.touch_stop_request(generation_id, ttl)
+
+    def stats(self):
+        """返回用于监控的统计信息。"""
+        return {'backend': type(self).__name__}
+
+# --- 近端缓存 ---
+class StopFlagNearCache:
+    """
+    worker 内的停止标志近端缓存，位于 Redis 之前：停止检查绝大多数结果为“否”，命中时无需网络往返。
+    - 缓存“是”和“否”两种结果，LRU 淘汰，最多 STOP_REQUEST_MAX_ENTRIES 条。
+    - 一致性：RedisCache / AsyncRedisCache 写入或清除标志时向 STOP_INVALIDATION_CHANNEL 发布 generation_id，
+      各 worker 的订阅（见 cancellation.CancellationRegistry._listen）据此删除条目。
+    - 订阅正常时条目最多缓存 max_age 秒；订阅未建立或已断开时只缓存 fallback_ttl 秒。
+    - 订阅状态变化或收到失效消息时递增版本号，查询 Redis 期间版本号变化的结果不会写入缓存，
+      避免把失效消息之前读到的旧值缓存下来。
+    线程安全：同时被事件循环和 HTTP 路径的工作线程使用。
+    """
+
+    def __init__(self, max_age=STOP_NEAR_CACHE_MAX_AGE, fallback_ttl=STOP_NEAR_CACHE_FALLBACK_TTL,
+                 max_entries=STOP_REQUEST_MAX_ENTRIES, clock=time.monotonic):
+        self.max_age = max_age
+        self.fallback_ttl = fallback_ttl
+        self.max_entries = max_entries
+        self.subscribed = False
+        self._entries = OrderedDict()  # generation_id -> (是否请求停止, 读取时间)
+        self._version = 0
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evicted': 0, 'resets': 0}
+
+    @property
+    def enabled(self):
+        return self.max_age > 0
+
+    def lookup(self, generation_id):
+        """返回 (是否命中, 缓存的值, 版本号)；未命中时把版本号传给 store()。"""
+        ttl = self.max_age if self.subscribed else min(self.max_age, self.fallback_ttl)
+        with self._lock:
+            entry = self._entries.get(generation_id)
+            if entry is not None and self._clock() - entry[1] < ttl:
+                self._entries.move_to_end(generation_id)
+                self._counters['hits'] += 1
+                return True, entry[0], self._version
+            self._counters['misses'] += 1
+            return False, None, self._version
+
+    def store(self, generation_id, value, version):
+        if not self.enabled:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[generation_id] = (value, self._clock())
+            self._entries.move_to_end(generation_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evicted'] += 1
+
+    def invalidate(self, generation_id):
+        with self._lock:
+            self._version += 1
+            self._entries.pop(generation_id, None)
+            self._counters['invalidations'] += 1
+
+    def set_subscribed(self, subscribed):
+        """订阅建立或断开时调用：此前的条目可能错过了失效消息，全部丢弃。"""
+        with self._lock:
+            self.subscribed = subscribed
+            self._version += 1
+            self._entries.clear()
+            self._counters['resets'] += 1
+        logger.info(f"停止标志近端缓存的失效订阅已{'建立' if subscribed else '断开'}。")
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {
+                'enabled': self.enabled,
+                'subscribed': self.subscribed,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hit_ratio': round(self._counters['hits'] / lookups, 4) if lookups else None,
+                **self._counters,
+            }
+
 # --- Redis 缓存实现 ---
 class RedisCache(StopRequestCache):
     """使用 Redis 作为后端的停止请求处理器。"""
@@ -47,14 +183,18 @@ class RedisCache(StopRequestCache):
             redis_db = int(os.environ.get('REDIS_DB_STOP_STATE', 1))
             redis_password = os.environ.get('REDIS_PASSWORD', None)
 
-            pool = redis.ConnectionPool(
-                host=redis_host,
-                port=redis_port,
-                db=redis_db,
-                password=redis_password,
-                decode_responses=True
-            )
+            # 保存连接参数，供需要独立连接的组件（如 pub/sub 监听）复用
+            self.connection_kwargs = {
+                'host': redis_host,
+                'port': redis_port,
+                'db': redis_db,
+                'password': redis_password,
+                'decode_responses': True,
+            }
+            pool = redis.ConnectionPool(**self.connection_kwargs)
             self.client = redis.Redis(connection_pool=pool)
+            # 同步和异步实例共享同一个近端缓存
+            self.near_cache = StopFlagNearCache()
             # 测试连接
             self.client.ping()
             logger.info("用于 StopRequestCache 的 Redis 连接成功。")
@@ -68,23 +208,36 @@ class RedisCache(StopRequestCache):
     def get_stop_requested(self, generation_id):
         if not generation_id:
             return False
-        key = self._get_key(str(generation_id))
+        generation_id = str(generation_id)
+        hit, value, version = self.near_cache.lookup(generation_id)
+        if hit:
+            return value
+        key = self._get_key(generation_id)
         try:
-            return self.client.exists(key) > 0
+            value = self.client.exists(key) > 0
         except redis.RedisError as e:
             logger.error(f"从 Redis 获取键 '{key}' 时出错: {e}")
             return False
+        self.near_cache.store(generation_id, value, version)
+        return value
 
     def set_stop_requested(self, generation_id, ttl=DEFAULT_STOP_TTL):
         if not generation_id:
             logger.warning("尝试设置停止请求但未提供 generation_id。")
             return
-        key = self._get_key(str(generation_id))
+        generation_id = str(generation_id)
+        key = self._get_key(generation_id)
         try:
-            self.client.set(key, "1", ex=ttl)
+            # 写入标志并广播失效消息，一次往返
+            pipe = self.client.pipeline(transaction=False)
+            pipe.set(key, "1", ex=ttl)
+            pipe.publish(STOP_INVALIDATION_CHANNEL, generation_id)
+            pipe.execute()
             logger.info(f"为 generation_id '{generation_id}' 设置了停止请求，TTL={ttl}s。")
         except redis.RedisError as e:
             logger.error(f"在 Redis 中设置键 '{key}' 时出错: {e}")
+        finally:
+            self.near_cache.invalidate(generation_id)
 
     def touch_stop_request(self, generation_id, ttl=DEFAULT_STOP_TTL):
         if not generation_id:
@@ -96,50 +249,354 @@ class RedisCache(StopRequestCache):
         except redis.RedisError as e:
             logger.error(f"为键 '{key}' 续期 TTL 时出错: {e}")
 
+    def touch_stop_requests(self, generation_ids, ttl=DEFAULT_STOP_TTL):
+        if not generation_ids:
+            return
+        try:
+            # 所有续期在一次往返中完成
+            pipe = self.client.pipeline(transaction=False)
+            for generation_id in generation_ids:
+                pipe.expire(self._get_key(str(generation_id)), ttl)
+            renewed = sum(1 for result in pipe.execute() if result)
+            if renewed:
+                logger.debug(f"批量为 {renewed} 个停止请求续期，新的 TTL={ttl}s。")
+        except redis.RedisError as e:
+            logger.error(f"批量续期 {len(generation_ids)} 个停止请求时出错: {e}")
+
     def clear_stop_request(self, generation_id):
         if not generation_id:
             return
-        key = self._get_key(str(generation_id))
+        generation_id = str(generation_id)
+        key = self._get_key(generation_id)
         try:
-            if self.client.delete(key) > 0:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.delete(key)
+            pipe.publish(STOP_INVALIDATION_CHANNEL, generation_id)
+            if pipe.execute()[0] > 0:
                 logger.info(f"清除了 generation_id '{generation_id}' 的停止请求。")
         except redis.RedisError as e:
             logger.error(f"从 Redis 清除键 '{key}' 时出错: {e}")
+        finally:
+            self.near_cache.invalidate(generation_id)
+
+    def stats(self):
+        return {'backend': type(self).__name__, 'near_cache': self.near_cache.stats()}
 
 # --- 内存缓存实现 ---
 class InMemoryCache(StopRequestCache):
-    """使用简单字典的内存停止请求处理器。"""
-    
-    def __init__(self):
-        self._cache = {}
+    """
+    进程内的停止请求处理器，语义与 Redis 实现一致：
+    - 每个条目按单调时钟记录过期时间。读取到过期条目时直接删除（惰性），
+      并且每隔 STOP_REQUEST_SWEEP_INTERVAL 秒借助过期时间小顶堆批量清理所有已过期的条目（定期）。
+    - 条目数达到 max_entries 时淘汰最久未使用的条目（LRU）。
+    - 续期只更新字典中的过期时间并向堆中追加新记录，旧记录在出堆时按过期时间不匹配跳过；
+      堆中的失效记录过多时整体重建。
+    """
+
+    def __init__(self, max_entries=STOP_REQUEST_MAX_ENTRIES, clock=time.monotonic):
+        self._cache = OrderedDict()  # generation_id -> 过期时间，顺序即 LRU 顺序
+        self._heap = []              # (过期时间, generation_id)
         self._lock = threading.Lock()
+        self._clock = clock
+        self._next_sweep = 0.0
+        self.max_entries = max_entries
+        self._counters = {'sets': 0, 'touches': 0, 'clears': 0, 'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
         logger.info("正在为停止请求使用内存缓存。")
 
+    # 以下方法均需在持有 self._lock 时调用
+    def _sweep(self, now):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + STOP_REQUEST_SWEEP_INTERVAL
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            if self._cache.get(key) == expires_at:
+                del self._cache[key]
+                self._counters['expired'] += 1
+        if len(heap) > 2 * len(self._cache) + 64:
+            self._heap = [(expires_at, key) for key, expires_at in self._cache.items()]
+            heapq.heapify(self._heap)
+
+    def _schedule(self, key, ttl, now):
+        expires_at = now + ttl
+        self._cache[key] = expires_at
+        self._cache.move_to_end(key)
+        heapq.heappush(self._heap, (expires_at, key))
+
     def get_stop_requested(self, generation_id):
         if not generation_id:
             return False
+        key = str(generation_id)
         with self._lock:
-            return str(generation_id) in self._cache
+            now = self._clock()
+            self._sweep(now)
+            expires_at = self._cache.get(key)
+            if expires_at is None:
+                self._counters['misses'] += 1
+                return False
+            if expires_at <= now:
+                del self._cache[key]
+                self._counters['expired'] += 1
+                self._counters['misses'] += 1
+                return False
+            self._cache.move_to_end(key)
+            self._counters['hits'] += 1
+            return True
 
     def set_stop_requested(self, generation_id, ttl=DEFAULT_STOP_TTL):
         if not generation_id:
             logger.warning("尝试设置停止请求但未提供 generation_id。")
             return
+        key = str(generation_id)
+        with self._lock:
+            now = self._clock()
+            self._sweep(now)
+            self._schedule(key, ttl, now)
+            self._counters['sets'] += 1
+            while len(self._cache) > self.max_entries:
+                evicted, _expires_at = self._cache.popitem(last=False)
+                self._counters['evicted'] += 1
+                logger.warning(f"内存中的停止请求数量超过上限 {self.max_entries}，淘汰了 generation_id '{evicted}'。")
+        logger.info(f"在内存中为 generation_id '{generation_id}' 设置了停止请求，TTL={ttl}s。")
+
+    def touch_stop_request(self, generation_id, ttl=DEFAULT_STOP_TTL):
+        if not generation_id:
+            return
+        key = str(generation_id)
+        with self._lock:
+            now = self._clock()
+            self._sweep(now)
+            expires_at = self._cache.get(key)
+            if expires_at is None or expires_at <= now:
+                return
+            self._schedule(key, ttl, now)
+            self._counters['touches'] += 1
+        logger.debug(f"为内存中 generation_id '{generation_id}' 的停止请求续期，新的 TTL={ttl}s。")
+
+    def clear_stop_request(self, generation_id):
+        if not generation_id:
+            return
+        with self._lock:
+            removed = self._cache.pop(str(generation_id), None) is not None
+            if removed:
+                self._counters['clears'] += 1
+        if removed:
+            logger.info(f"从内存中清除了 generation_id '{generation_id}' 的停止请求。")
+
+    def stats(self):
+        with self._lock:
+            self._sweep(self._clock())
+            return {
+                'backend': type(self).__name__,
+                'entries': len(self._cache),
+                'max_entries': self.max_entries,
+                'heap_size': len(self._heap),
+                **self._counters,
+            }
+
+# --- 共享内存实现 ---
+class SharedMemoryCache(StopRequestCache):
+    """
+    使用同一主机上所有 worker 共享的内存映射哈希表（见 shared_stop_table）作为后端的停止请求处理器。
+    适用于单机多 worker、没有 Redis 的部署：任意 worker 写入的停止请求对其他 worker 立即可见。
+    WebSocket 路径的本地令牌由 cancellation.CancellationRegistry 定期轮询此表触发。
+    """
+
+    def __init__(self, path=STOP_REQUEST_SHM_PATH, slots=STOP_REQUEST_SHM_SLOTS, clock=time.monotonic):
+        from .shared_stop_table import SharedStopTable
+
+        self._table = SharedStopTable(path, slots, clock=clock)
+        self._lock = threading.Lock()
+        self._counters = {'sets': 0, 'touches': 0, 'clears': 0, 'hits': 0, 'misses': 0, 'evicted': 0}
+        logger.info(f"正在为停止请求使用共享内存表: {self._table.path}（{self._table.slots} 个槽位）。")
+
+    def _count(self, name, amount=1):
         with self._lock:
-            self._cache[str(generation_id)] = True
-            logger.info(f"在内存中为 generation_id '{generation_id}' 设置了停止请求。")
+            self._counters[name] += amount
+
+    def get_stop_requested(self, generation_id):
+        if not generation_id:
+            return False
+        requested = self._table.get(generation_id)
+        self._count('hits' if requested else 'misses')
+        return requested
+
+    def set_stop_requested(self, generation_id, ttl=DEFAULT_STOP_TTL):
+        if not generation_id:
+            logger.warning("尝试设置停止请求但未提供 generation_id。")
+            return
+        evicted = self._table.set(generation_id, ttl)
+        self._count('sets')
+        if evicted:
+            self._count('evicted', evicted)
+            logger.warning("共享停止请求表的探测窗口已满，淘汰了最早过期的条目。考虑增大 STOP_REQUEST_SHM_SLOTS。")
+        logger.info(f"在共享内存中为 generation_id '{generation_id}' 设置了停止请求，TTL={ttl}s。")
 
     def touch_stop_request(self, generation_id, ttl=DEFAULT_STOP_TTL):
-        # 内存缓存没有 TTL，所以这是一个空操作，但为了日志一致性而记录。
-        if self.get_stop_requested(generation_id):
-             logger.debug(f"内存中 generation_id '{generation_id}' 的停止请求心跳。")
+        if not generation_id:
+            return
+        if self._table.touch(generation_id, ttl):
+            self._count('touches')
+            logger.debug(f"为共享内存中 generation_id '{generation_id}' 的停止请求续期，新的 TTL={ttl}s。")
 
     def clear_stop_request(self, generation_id):
         if not generation_id:
             return
+        if self._table.clear(generation_id):
+            self._count('clears')
+            logger.info(f"从共享内存中清除了 generation_id '{generation_id}' 的停止请求。")
+
+    def stats(self):
         with self._lock:
-            if self._cache.pop(str(generation_id), None):
-                logger.info(f"从内存中清除了 generation_id '{generation_id}' 的停止请求。")
+            counters = dict(self._counters)
+        return {
+            'backend': type(self).__name__,
+            'path': self._table.path,
+            'slots': self._table.slots,
+            'entries': self._table.live_entries(),
+            **counters,
+        }
+
+# --- 异步接口 ---
+class AsyncStopRequestCache(ABC):
+    """StopRequestCache 的异步版本，供事件循环中的调用方使用，与同步版本共享同一份停止状态。"""
+
+    @abstractmethod
+    async def get_stop_requested(self, generation_id):
+        pass
+
+    @abstractmethod
+    async def set_stop_requested(self, generation_id, ttl=DEFAULT_STOP_TTL):
+        pass
+
+    @abstractmethod
+    async def touch_stop_request(self, generation_id, ttl=DEFAULT_STOP_TTL):
+        pass
+
+    @abstractmethod
+    async def clear_stop_request(self, generation_id):
+        pass
+
+    async def close(self):
+        """释放当前事件循环持有的连接。"""
+
+
+class AsyncRedisCache(AsyncStopRequestCache):
+    """
+    基于 redis.asyncio 的停止请求处理器，键格式与 RedisCache 相同。
+    连接池与事件循环绑定，每个事件循环使用自己的连接池（最多 STOP_REQUEST_REDIS_MAX_CONNECTIONS 个连接），
+    并发的流较多时在连接池上排队等待，不会阻塞事件循环。
+    """
+
+    def __init__(self, connection_kwargs, near_cache, max_connections=STOP_REQUEST_REDIS_MAX_CONNECTIONS):
+        self.connection_kwargs = connection_kwargs
+        self.near_cache = near_cache
+        self.max_connections = max_connections
+        self._clients = weakref.WeakKeyDictionary()  # 事件循环 -> redis.asyncio.Redis
+
+    def client(self):
+        import redis.asyncio as aioredis
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            pool = aioredis.BlockingConnectionPool(max_connections=self.max_connections, **self.connection_kwargs)
+            client = aioredis.Redis(connection_pool=pool)
+            self._clients[loop] = client
+        return client
+
+    def _get_key(self, generation_id):
+        return f"{RedisCache.STOP_REQUEST_PREFIX}{generation_id}"
+
+    async def get_stop_requested(self, generation_id):
+        if not generation_id:
+            return False
+        generation_id = str(generation_id)
+        hit, value, version = self.near_cache.lookup(generation_id)
+        if hit:
+            return value
+        key = self._get_key(generation_id)
+        try:
+            value = await self.client().exists(key) > 0
+        except redis.RedisError as e:
+            logger.error(f"从 Redis 获取键 '{key}' 时出错: {e}")
+            return False
+        self.near_cache.store(generation_id, value, version)
+        return value
+
+    async def set_stop_requested(self, generation_id, ttl=DEFAULT_STOP_TTL):
+        if not generation_id:
+            logger.warning("尝试设置停止请求但未提供 generation_id。")
+            return
+        generation_id = str(generation_id)
+        key = self._get_key(generation_id)
+        try:
+            pipe = self.client().pipeline(transaction=False)
+            pipe.set(key, "1", ex=ttl)
+            pipe.publish(STOP_INVALIDATION_CHANNEL, generation_id)
+            await pipe.execute()
+            logger.info(f"为 generation_id '{generation_id}' 设置了停止请求，TTL={ttl}s。")
+        except redis.RedisError as e:
+            logger.error(f"在 Redis 中设置键 '{key}' 时出错: {e}")
+        finally:
+            self.near_cache.invalidate(generation_id)
+
+    async def touch_stop_request(self, generation_id, ttl=DEFAULT_STOP_TTL):
+        if not generation_id:
+            return
+        key = self._get_key(str(generation_id))
+        try:
+            if await self.client().expire(key, ttl):
+                logger.debug(f"为 generation_id '{generation_id}' 的停止请求续期，新的 TTL={ttl}s。")
+        except redis.RedisError as e:
+            logger.error(f"为键 '{key}' 续期 TTL 时出错: {e}")
+
+    async def clear_stop_request(self, generation_id):
+        if not generation_id:
+            return
+        generation_id = str(generation_id)
+        key = self._get_key(generation_id)
+        try:
+            pipe = self.client().pipeline(transaction=False)
+            pipe.delete(key)
+            pipe.publish(STOP_INVALIDATION_CHANNEL, generation_id)
+            if (await pipe.execute())[0] > 0:
+                logger.info(f"清除了 generation_id '{generation_id}' 的停止请求。")
+        except redis.RedisError as e:
+            logger.error(f"从 Redis 清除键 '{key}' 时出错: {e}")
+        finally:
+            self.near_cache.invalidate(generation_id)
+
+    async def publish(self, channel, message):
+        await self.client().publish(channel, message)
+
+    async def close(self):
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            # redis-py 5 起 close() 更名为 aclose()
+            await getattr(client, 'aclose', client.close)()
+            await client.connection_pool.disconnect()
+
+
+class AsyncInMemoryCache(AsyncStopRequestCache):
+    """InMemoryCache / SharedMemoryCache 的异步包装：内存操作不涉及网络 I/O，直接在事件循环中执行。"""
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    async def get_stop_requested(self, generation_id):
+        return self._cache.get_stop_requested(generation_id)
+
+    async def set_stop_requested(self, generation_id, ttl=DEFAULT_STOP_TTL):
+        self._cache.set_stop_requested(generation_id, ttl)
+
+    async def touch_stop_request(self, generation_id, ttl=DEFAULT_STOP_TTL):
+        self._cache.touch_stop_request(generation_id, ttl)
+
+    async def clear_stop_request(self, generation_id):
+        self._cache.clear_stop_request(generation_id)
+
 
 # --- 工厂和单例实例 ---
 def _get_cache_instance():
@@ -151,11 +608,24 @@ def _get_cache_instance():
         except redis.RedisError:
             logger.warning("Redis 连接失败。回退到内存缓存。")
             return InMemoryCache()
+    if cache_type == 'shm':
+        try:
+            return SharedMemoryCache()
+        except (ImportError, OSError, ValueError) as e:
+            logger.warning(f"无法打开共享内存停止请求表 ({e})。回退到内存缓存。")
+            return InMemoryCache()
     return InMemoryCache()
 
+def _get_async_cache_instance(cache):
+    """创建与同步实例共享状态的异步实例。"""
+    if isinstance(cache, RedisCache):
+        return AsyncRedisCache(cache.connection_kwargs, cache.near_cache)
+    return AsyncInMemoryCache(cache)
+
 # --- 公共 API ---
-# 缓存的单例实例
+# 缓存的单例实例（同步版本供线程化的 HTTP 路径使用，异步版本供事件循环中的调用方使用）
 stop_request_manager = _get_cache_instance()
+async_stop_request_manager = _get_async_cache_instance(stop_request_manager)
 
 # 暴露包装了管理器方法的函数，以实现向后兼容
 def get_stop_requested_sync(generation_id):
@@ -169,3 +639,16 @@ def touch_stop_request_sync(generation_id, ttl=DEFAULT_STOP_TTL):
 
 def clear_stop_request_sync(generation_id):
     stop_request_manager.clear_stop_request(generation_id)
+
+# 异步版本：在事件循环中调用，不会阻塞事件循环
+async def get_stop_requested_async(generation_id):
+    return await async_stop_request_manager.get_stop_requested(generation_id)
+
+async def set_stop_requested_async(generation_id, ttl=DEFAULT_STOP_TTL):
+    await async_stop_request_manager.set_stop_requested(generation_id, ttl)
+
+async def touch_stop_request_async(generation_id, ttl=DEFAULT_STOP_TTL):
+    await async_stop_request_manager.touch_stop_request(generation_id, ttl)
+
+async def clear_stop_request_async(generation_id):
+    await async_stop_request_manager.clear_stop_request(generation_id)
@@ -0,0 +1,233 @@
+import asyncio
+import codecs
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# --- stream_update 合并配置 ---
+# 合并窗口（毫秒），设置为 0 时关闭合并，每个 token 单独发送
+try:
+    STREAM_COALESCE_INTERVAL_MS = int(os.getenv('STREAM_COALESCE_INTERVAL_MS', '50'))
+except (ValueError, TypeError):
+    STREAM_COALESCE_INTERVAL_MS = 50
+
+# 累计达到该字节数时立即发送，不等待合并窗口结束
+try:
+    STREAM_COALESCE_MAX_BYTES = int(os.getenv('STREAM_COALESCE_MAX_BYTES', '1024'))
+except (ValueError, TypeError):
+    STREAM_COALESCE_MAX_BYTES = 1024
+
+
+class SSEDecoder:
+    """
+    增量式 SSE (text/event-stream) 解码器。
+    - 使用 bytearray 作为缓冲区，并记录扫描偏移量，每个字节只扫描一次，避免 split 带来的二次复杂度。
+    - 使用增量 UTF-8 解码器，跨数据块边界的多字节字符不会导致解码失败。
+    - 每个 `data:` 行作为一个负载返回（与 OpenAI 兼容的流式接口一致）。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.done = False  # 是否收到了 [DONE] 标记
+
+    def _parse_lines(self, text):
+        payloads = []
+        for line in text.split('\n'):
+            if not line.startswith('data:'):
+                continue  # 忽略空行、注释以及 event/id 等字段
+            value = line[6:] if line.startswith('data: ') else line[5:]
+            if value.endswith('\r'):  # 兼容 \r\n 行尾
+                value = value[:-1]
+            if value.strip() == '[DONE]':
+                self.done = True
+            else:
+                payloads.append(value)
+        return payloads
+
+    def feed(self, chunk):
+        """输入一段原始字节，返回其中所有已完整的 data 负载（字符串）列表。"""
+        buf = self._buffer
+        # 缓冲区中的旧数据不含换行符，只需扫描新追加的部分
+        scan = len(buf)
+        buf += chunk
+        last_newline = buf.rfind(b'\n', scan)
+        if last_newline == -1:
+            return []
+        # 一次性解码所有完整的行，剩余的不完整行留在缓冲区中
+        text = self._decoder.decode(bytes(buf[:last_newline]))
+        del buf[:last_newline + 1]
+        return self._parse_lines(text)
+
+    def close(self):
+        """流结束时调用，处理最后一行没有换行符的残留数据。"""
+        text = self._decoder.decode(bytes(self._buffer), final=True)
+        self._buffer.clear()
+        return self._parse_lines(text) if text else []
+
+
+class ContentAccumulator:
+    """基于列表的内容累加器，避免在长回复中反复拼接字符串。"""
+
+    __slots__ = ('_parts', '_length')
+
+    def __init__(self):
+        self._parts = []
+        self._length = 0
+
+    def append(self, piece):
+        if piece:
+            self._parts.append(piece)
+            self._length += len(piece)
+
+    def getvalue(self):
+        if len(self._parts) > 1:
+            self._parts = [''.join(self._parts)]
+        return self._parts[0] if self._parts else ''
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    def __str__(self):
+        return self.getvalue()
+
+
+class StreamCoalescer:
+    """
+    在发送到 channel layer 之前合并流式增量。
+    - 自第一个未发送的增量起，每隔 interval_ms 毫秒或累计 max_bytes 字节（先到者为准）发送一次。
+    - 调用 aclose() 会立即发送剩余内容，必须在发送 generation_end 之前调用。
+    - interval_ms 为 0 时不做合并，每个增量直接发送。
+    """
+
+    def __init__(self, flush_callback, interval_ms=None, max_bytes=None):
+        self._flush_callback = flush_callback  # async def callback(content)
+        if interval_ms is None:
+            interval_ms = STREAM_COALESCE_INTERVAL_MS
+        self._interval = max(interval_ms, 0) / 1000
+        self._max_bytes = STREAM_COALESCE_MAX_BYTES if max_bytes is None else max_bytes
+        self._parts = []
+        self._size = 0
+        self._timer = None
+        self._timer_task = None
+        self._lock = asyncio.Lock()
+        self.pieces_in = 0
+        self.flushes = 0
+
+    async def add(self, piece):
+        if not piece:
+            return
+        self.pieces_in += 1
+        if self._interval <= 0:
+            self.flushes += 1
+            await self._flush_callback(piece)
+            return
+        self._parts.append(piece)
+        self._size += len(piece.encode('utf-8'))
+        if self._size >= self._max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._interval, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_task = asyncio.ensure_future(self._flush_from_timer())
+
+    async def _flush_from_timer(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"定时发送合并后的流式内容失败: {e}", exc_info=True)
+
+    async def flush(self):
+        """立即发送所有已缓冲的增量。"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # 通过锁保证多次发送之间的顺序与到达顺序一致
+        async with self._lock:
+            if not self._parts:
+                return
+            content = ''.join(self._parts)
+            self._parts = []
+            self._size = 0
+            self.flushes += 1
+            await self._flush_callback(content)
+
+    async def aclose(self):
+        """发送剩余内容并停止定时器，可重复调用。"""
+        await self.flush()
+        if self._timer_task is not None and not self._timer_task.done():
+            await self._timer_task
+        self._timer_task = None
+
+
+class SyncStreamCoalescer:
+    """
+    StreamCoalescer 的同步版本，供线程化的 HTTP 回退路径使用，合并策略和配置与 StreamCoalescer 相同。
+    合并窗口由 threading.Timer 计时，上游停顿时已缓冲的内容也会按时发送；发送在锁内进行，顺序与到达顺序一致。
+    调用 close() 会立即发送剩余内容，必须在发送 generation_end 之前调用。
+    """
+
+    def __init__(self, flush_callback, interval_ms=None, max_bytes=None):
+        self._flush_callback = flush_callback  # def callback(content)
+        if interval_ms is None:
+            interval_ms = STREAM_COALESCE_INTERVAL_MS
+        self._interval = max(interval_ms, 0) / 1000
+        self._max_bytes = STREAM_COALESCE_MAX_BYTES if max_bytes is None else max_bytes
+        self._parts = []
+        self._size = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        self.pieces_in = 0
+        self.flushes = 0
+
+    def add(self, piece):
+        if not piece:
+            return
+        with self._lock:
+            self.pieces_in += 1
+            if self._interval <= 0:
+                self.flushes += 1
+                self._flush_callback(piece)
+                return
+            self._parts.append(piece)
+            self._size += len(piece.encode('utf-8'))
+            if self._size >= self._max_bytes:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self._interval, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"定时发送合并后的流式内容失败: {e}", exc_info=True)
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._parts:
+            return
+        content = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        self.flushes += 1
+        self._flush_callback(content)
+
+    def flush(self):
+        """立即发送所有已缓冲的增量。"""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        """发送剩余内容并停止定时器，可重复调用。"""
+        self.flush()
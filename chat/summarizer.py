@@ -0,0 +1,152 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+# --- 对话摘要配置 ---
+# 会话中未被摘要覆盖的消息超过该数量时，在后台压缩较早的部分
+try:
+    SUMMARY_TRIGGER_MESSAGES = int(os.getenv('SUMMARY_TRIGGER_MESSAGES', '40'))
+except (ValueError, TypeError):
+    SUMMARY_TRIGGER_MESSAGES = 40
+
+# 压缩后保留原文、不并入摘要的最近消息数量
+try:
+    SUMMARY_KEEP_RECENT_MESSAGES = int(os.getenv('SUMMARY_KEEP_RECENT_MESSAGES', '10'))
+except (ValueError, TypeError):
+    SUMMARY_KEEP_RECENT_MESSAGES = 10
+
+# 单次压缩最多并入摘要的消息数量，剩余部分由后续的压缩继续处理
+try:
+    SUMMARY_MAX_INPUT_MESSAGES = int(os.getenv('SUMMARY_MAX_INPUT_MESSAGES', '200'))
+except (ValueError, TypeError):
+    SUMMARY_MAX_INPUT_MESSAGES = 200
+
+# 摘要请求的超时时间（秒）
+try:
+    SUMMARY_REQUEST_TIMEOUT = int(os.getenv('SUMMARY_REQUEST_TIMEOUT', '120'))
+except (ValueError, TypeError):
+    SUMMARY_REQUEST_TIMEOUT = 120
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你是对话摘要助手。请把给出的对话记录（以及已有的摘要）合并为一份简洁的摘要，"
+    "保留用户的目标、偏好、已确认的事实、结论和未解决的问题，省略寒暄和重复内容。"
+    "使用对话所用的语言，只输出摘要本身。"
+)
+
+
+def _format_transcript(messages):
+    lines = []
+    for message in messages:
+        speaker = "用户" if message.is_user else "助手"
+        content = message.content
+        attachments = [os.path.basename(attachment.file_path) for attachment in message.attachments.all()]
+        if attachments:
+            content = f"{content}\n" + "\n".join(f"[用户上传了图片: {name}]" for name in attachments)
+        lines.append(f"{speaker}: {content}")
+    return "\n\n".join(lines)
+
+
+def _request_summary(summary_model, user_key, previous_summary, messages):
+    """同步调用摘要模型（经过提供商调度和故障转移），返回摘要文本。"""
+    from .response_handlers import handle_json_response
+    from .services import _get_equivalent_models_sync, build_chat_request
+    from .upstream import open_upstream_sync
+
+    transcript = _format_transcript(messages)
+    if previous_summary:
+        user_content = f"已有的摘要：\n{previous_summary}\n\n之后的对话记录：\n{transcript}"
+    else:
+        user_content = f"对话记录：\n{transcript}"
+    prompt = [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": user_content},
+    ]
+    candidates = [summary_model] + _get_equivalent_models_sync(summary_model)
+    with open_upstream_sync(candidates, user_key, lambda model: build_chat_request(model, prompt, False), SUMMARY_REQUEST_TIMEOUT) as response:
+        return handle_json_response(response.json()).strip()
+
+
+class ConversationSummarizer:
+    """
+    后台对话压缩：会话中未被摘要覆盖的消息超过 SUMMARY_TRIGGER_MESSAGES 时，
+    用模型配置的摘要模型把除最近 SUMMARY_KEEP_RECENT_MESSAGES 条以外的消息并入 Conversation.summary，
+    并把 Conversation.summary_until 移到最后一条被并入的消息。
+    任务在独立的线程池中执行，同一会话同时只有一个任务，不占用生成请求的时间。
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def schedule(self, conversation_id, model):
+        """生成完成后调用；模型未配置摘要模型时直接返回。只做内存操作，不阻塞调用方。"""
+        if not model.get('summary_model_id'):
+            return
+        with self._lock:
+            if conversation_id in self._pending:
+                return
+            self._pending.add(conversation_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summarizer')
+        self._executor.submit(self._run, conversation_id, model['summary_model_id'])
+
+    def _run(self, conversation_id, summary_model_id):
+        close_old_connections()
+        try:
+            self.compact(conversation_id, summary_model_id)
+        except Exception as e:
+            logger.error(f"Summarizer: 压缩会话 {conversation_id} 失败: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._pending.discard(conversation_id)
+            close_old_connections()
+
+    def compact(self, conversation_id, summary_model_id):
+        """需要时压缩会话，返回是否更新了摘要。"""
+        from .models import AIModel, Conversation, Message
+        from .services import _model_to_dict
+
+        conversation = Conversation.objects.select_related('summary_until').get(id=conversation_id)
+        watermark = conversation.summary_until
+        unsummarized = Message.objects.filter(conversation_id=conversation_id)
+        if watermark is not None:
+            unsummarized = unsummarized.filter(timestamp__gt=watermark.timestamp)
+        pending_count = unsummarized.count()
+        if pending_count <= SUMMARY_TRIGGER_MESSAGES:
+            return False
+
+        fold_count = min(pending_count - SUMMARY_KEEP_RECENT_MESSAGES, SUMMARY_MAX_INPUT_MESSAGES)
+        if fold_count <= 0:
+            return False
+        messages = list(unsummarized.order_by('timestamp').prefetch_related('attachments')[:fold_count])
+        summary_model = _model_to_dict(AIModel.objects.select_related('provider').get(id=summary_model_id))
+        previous_summary = conversation.summary if watermark is not None else ""
+
+        summary = _request_summary(summary_model, conversation.user_id, previous_summary, messages)
+        if not summary:
+            logger.warning(f"Summarizer: 摘要模型没有为会话 {conversation_id} 返回内容。")
+            return False
+
+        # 只有在摘要期间水位没有被其他任务或删除操作改变时才写入
+        updated = Conversation.objects.filter(id=conversation_id, summary_until=watermark).update(
+            summary=summary, summary_until=messages[-1]
+        )
+        if updated:
+            logger.info(f"Summarizer: 会话 {conversation_id} 的 {len(messages)} 条消息已并入摘要（{len(summary)} 个字符）。")
+        return bool(updated)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# 进程级单例
+conversation_summarizer = ConversationSummarizer()
@@ -1,3 +1,1378 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache, caches
+from django.test import SimpleTestCase, override_settings
+
+from .cancellation import CancellationRegistry, CancellationToken
+from .completion_cache import CompletionCache
+from .context_builder import CONTEXT_RESPONSE_RESERVE_TOKENS, context_budget
+from .context_cache import ConversationContextCache
+from .disconnect import CancelOnDisconnectMiddleware
+from .event_dispatch import ConversationEventDispatcher, RedisSubscriberPresence
+from .event_log import EVENT_LOG_TTL, InMemoryEventLog, SharedFileEventLog, find_gap
+from .generation_registry import (
+    GENERATION_REGISTRY_TTL, InMemoryGenerationRegistry, SharedMemoryGenerationRegistry,
+)
+from .http_sessions import ProviderSessionRegistry
+from .image_cache import DataURLCache
+from .request_body import (
+    PreEncodedMessage, StoredDataURL, StoredFileChangedError, StreamingJSONBody, encode_message,
+)
+from .scheduler import ProviderBusyError, ProviderScheduler, _GRANTED, provider_scheduler
+from .services import EventBroadcaster
+from .shared_stop_table import MAX_PROBES, SharedStopTable, _key_digest
+from .state_utils import InMemoryCache, StopFlagNearCache, clear_stop_request_sync
+from .streaming import SSEDecoder, StreamCoalescer, SyncStreamCoalescer
+from .summarizer import (
+    SUMMARY_KEEP_RECENT_MESSAGES, SUMMARY_MAX_INPUT_MESSAGES, SUMMARY_TRIGGER_MESSAGES, ConversationSummarizer,
+)
+from .upstream import UpstreamHTTPError, open_upstream
+
+
+class FakeClock:
+    """可手动推进的单调时钟，代替 time.monotonic。"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class SSEDecoderTests(SimpleTestCase):
+    def feed_all(self, decoder, chunks):
+        payloads = []
+        for chunk in chunks:
+            payloads.extend(decoder.feed(chunk))
+        return payloads
+
+    def test_multibyte_character_split_across_chunks(self):
+        raw = 'data: {"content": "你好"}\n\n'.encode('utf-8')
+        split = raw.index('你'.encode('utf-8')) + 1  # 切在“你”的第一个字节之后
+        decoder = SSEDecoder()
+        self.assertEqual(self.feed_all(decoder, [raw[:split], raw[split:]]), ['{"content": "你好"}'])
+
+    def test_every_byte_boundary(self):
+        raw = 'data: 一\n\ndata: 二三\n\n'.encode('utf-8')
+        for split in range(1, len(raw)):
+            decoder = SSEDecoder()
+            self.assertEqual(self.feed_all(decoder, [raw[:split], raw[split:]]), ['一', '二三'], split)
+
+    def test_done_marker_sets_flag_and_is_not_returned(self):
+        decoder = SSEDecoder()
+        payloads = self.feed_all(decoder, [b'data: {"a": 1}\n\ndata: [DO', b'NE]\n\n'])
+        self.assertEqual(payloads, ['{"a": 1}'])
+        self.assertTrue(decoder.done)
+
+    def test_ignores_comments_and_other_fields(self):
+        decoder = SSEDecoder()
+        payloads = decoder.feed(b': keep-alive\nevent: message\nid: 3\ndata:x\r\n\r\n')
+        self.assertEqual(payloads, ['x'])
+        self.assertFalse(decoder.done)
+
+    def test_close_returns_trailing_line_without_newline(self):
+        decoder = SSEDecoder()
+        self.assertEqual(decoder.feed(b'data: first\ndata: last'), ['first'])
+        self.assertEqual(decoder.close(), ['last'])
+        self.assertEqual(decoder.close(), [])
+
+
+class CancellationTokenTests(SimpleTestCase):
+    async def test_trigger_while_armed_cancels_waiting_task(self):
+        token = CancellationToken('gen-1', asyncio.get_running_loop())
+        waiting = asyncio.ensure_future(asyncio.sleep(60))
+        token.arm(waiting)
+        token.trigger()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertTrue(token.cancelled)
+        self.assertTrue(token.event.is_set())
+
+    async def test_trigger_after_disarm_only_sets_flag(self):
+        token = CancellationToken('gen-2', asyncio.get_running_loop())
+        waiting = asyncio.ensure_future(asyncio.sleep(60))
+        token.arm(waiting)
+        token.disarm()
+        token.trigger()
+        await asyncio.sleep(0)
+        self.assertTrue(token.cancelled)
+        self.assertFalse(waiting.cancelled())
+        waiting.cancel()
+
+    async def test_armed_only_covers_the_with_block(self):
+        token = CancellationToken('gen-5', asyncio.get_running_loop())
+        reads = []
+
+        async def generation():
+            with token.armed():
+                await asyncio.sleep(0)
+                reads.append('read')
+            # 离开 armed() 之后的发送不会被停止请求打断
+            await asyncio.sleep(0)
+            token.trigger()
+            await asyncio.sleep(0)
+            return 'sent'
+
+        self.assertEqual(await generation(), 'sent')
+        self.assertEqual(reads, ['read'])
+        self.assertTrue(token.cancelled)
+
+    async def test_trigger_is_idempotent(self):
+        token = CancellationToken('gen-3', asyncio.get_running_loop())
+        token.trigger()
+        waiting = asyncio.ensure_future(asyncio.sleep(60))
+        token.arm(waiting)
+        token.trigger()  # 已取消的令牌不会再次取消新的任务
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.cancelled())
+        waiting.cancel()
+
+    async def test_stop_requested_from_worker_thread_reaches_token(self):
+        registry = CancellationRegistry(InMemoryCache())
+        token = registry.register('gen-4')
+        waiting = asyncio.ensure_future(asyncio.sleep(60))
+        token.arm(waiting)
+        # HTTP 视图在工作线程中请求停止，令牌在其所属的事件循环中被触发
+        await asyncio.to_thread(registry.request_stop_sync, 'gen-4')
+        await asyncio.wait_for(token.event.wait(), 1)
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        registry.unregister(token)
+        clear_stop_request_sync('gen-4')
+
+
+class ContextBudgetTests(SimpleTestCase):
+    def test_budget_reserves_max_tokens(self):
+        model = {'max_context': 8192, 'default_params': {'max_tokens': 1000}}
+        self.assertEqual(context_budget(model), (7192, 8192, 1000))
+
+    def test_budget_uses_max_completion_tokens(self):
+        model = {'max_context': 8192, 'default_params': {'max_completion_tokens': 2000}}
+        self.assertEqual(context_budget(model), (6192, 8192, 2000))
+
+    def test_budget_falls_back_to_default_reserve(self):
+        model = {'max_context': 8192, 'default_params': {}}
+        self.assertEqual(context_budget(model), (8192 - CONTEXT_RESPONSE_RESERVE_TOKENS, 8192, CONTEXT_RESPONSE_RESERVE_TOKENS))
+
+    def test_unconfigured_max_context_has_no_budget(self):
+        for max_context in (0, None, -1):
+            self.assertEqual(context_budget({'max_context': max_context, 'default_params': {'max_tokens': 10}})[0], None)
+
+    def test_reserve_not_smaller_than_max_context_has_no_budget(self):
+        for max_tokens in (4096, 8000):
+            model = {'max_context': 4096, 'default_params': {'max_tokens': max_tokens}}
+            with self.assertLogs('chat.context_builder', 'WARNING'):
+                self.assertEqual(context_budget(model), (None, 4096, max_tokens))
+
+    def test_reserve_one_below_max_context(self):
+        model = {'max_context': 4096, 'default_params': {'max_tokens': 4095}}
+        self.assertEqual(context_budget(model)[0], 1)
+
+
+class InMemoryCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = InMemoryCache(max_entries=3, clock=self.clock)
+
+    def test_entry_expires_after_ttl(self):
+        self.cache.set_stop_requested('a', ttl=10)
+        self.clock.advance(9.9)
+        self.assertTrue(self.cache.get_stop_requested('a'))
+        self.clock.advance(0.1)
+        self.assertFalse(self.cache.get_stop_requested('a'))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_touch_extends_live_entry_only(self):
+        self.cache.set_stop_requested('a', ttl=10)
+        self.clock.advance(8)
+        self.cache.touch_stop_request('a', ttl=10)
+        self.clock.advance(8)
+        self.assertTrue(self.cache.get_stop_requested('a'))
+        self.clock.advance(3)
+        self.cache.touch_stop_request('a', ttl=10)  # 已过期，续期不会使其复活
+        self.assertFalse(self.cache.get_stop_requested('a'))
+
+    def test_sweep_removes_expired_entries_without_reads(self):
+        for key in ('a', 'b'):
+            self.cache.set_stop_requested(key, ttl=1)
+        self.cache.set_stop_requested('c', ttl=100)
+        self.clock.advance(5)
+        stats = self.cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['expired'], 2)
+
+    def test_evicts_least_recently_used_entry(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set_stop_requested(key, ttl=100)
+        self.assertTrue(self.cache.get_stop_requested('a'))  # a 变为最近使用
+        with self.assertLogs('chat.state_utils', 'WARNING'):
+            self.cache.set_stop_requested('d', ttl=100)
+        self.assertFalse(self.cache.get_stop_requested('b'))
+        for key in ('a', 'c', 'd'):
+            self.assertTrue(self.cache.get_stop_requested(key), key)
+        self.assertEqual(self.cache.stats()['evicted'], 1)
+
+    def test_clear_removes_entry(self):
+        self.cache.set_stop_requested('a', ttl=100)
+        self.cache.clear_stop_request('a')
+        self.assertFalse(self.cache.get_stop_requested('a'))
+        self.assertEqual(self.cache.stats()['clears'], 1)
+
+
+class StopFlagNearCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = StopFlagNearCache(max_age=30, fallback_ttl=1, max_entries=2, clock=self.clock)
+
+    def subscribe(self):
+        with self.assertLogs('chat.state_utils', 'INFO'):
+            self.cache.set_subscribed(True)
+
+    def test_miss_then_hit(self):
+        hit, _value, version = self.cache.lookup('a')
+        self.assertFalse(hit)
+        self.cache.store('a', True, version)
+        self.assertEqual(self.cache.lookup('a')[:2], (True, True))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_ratio']), (1, 1, 0.5))
+
+    def test_store_dropped_after_invalidate_during_lookup(self):
+        _hit, _value, version = self.cache.lookup('a')
+        self.cache.invalidate('a')  # 查询 Redis 期间收到失效消息
+        self.cache.store('a', False, version)
+        self.assertFalse(self.cache.lookup('a')[0])
+
+    def test_store_dropped_after_subscription_change_during_lookup(self):
+        _hit, _value, version = self.cache.lookup('a')
+        self.subscribe()
+        self.cache.store('a', False, version)
+        self.assertFalse(self.cache.lookup('a')[0])
+
+    def test_subscription_change_drops_entries(self):
+        self.cache.store('a', False, self.cache.lookup('a')[2])
+        self.subscribe()
+        self.assertFalse(self.cache.lookup('a')[0])
+
+    def test_unsubscribed_entries_use_fallback_ttl(self):
+        self.cache.store('a', False, self.cache.lookup('a')[2])
+        self.clock.advance(1)
+        self.assertFalse(self.cache.lookup('a')[0])
+
+    def test_subscribed_entries_use_max_age(self):
+        self.subscribe()
+        self.cache.store('a', False, self.cache.lookup('a')[2])
+        self.clock.advance(29)
+        self.assertTrue(self.cache.lookup('a')[0])
+        self.clock.advance(1)
+        self.assertFalse(self.cache.lookup('a')[0])
+
+    def test_evicts_least_recently_used_entry(self):
+        self.subscribe()
+        for key in ('a', 'b'):
+            self.cache.store(key, False, self.cache.lookup(key)[2])
+        self.assertTrue(self.cache.lookup('a')[0])  # a 变为最近使用
+        self.cache.store('c', False, self.cache.lookup('c')[2])
+        self.assertFalse(self.cache.lookup('b')[0])
+        self.assertTrue(self.cache.lookup('a')[0])
+        self.assertEqual(self.cache.stats()['evicted'], 1)
+
+    def test_zero_max_age_disables_cache(self):
+        cache = StopFlagNearCache(max_age=0, fallback_ttl=1, max_entries=2, clock=self.clock)
+        self.assertFalse(cache.enabled)
+        cache.store('a', True, cache.lookup('a')[2])
+        self.assertFalse(cache.lookup('a')[0])
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class SharedStopTableTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='stop-table-')
+        os.close(fd)
+        self.clock = FakeClock()
+        # 只有一个起始槽位：所有键都落在同一个探测窗口中，便于构造冲突
+        self.table = SharedStopTable(self.path, slots=1, clock=self.clock)
+
+    def tearDown(self):
+        self.table.close()
+        os.unlink(self.path)
+
+    def slot_of(self, generation_id):
+        digest = _key_digest(generation_id)
+        for index in range(MAX_PROBES):
+            if self.table._read_slot(index)[0] == digest:
+                return index
+        return None
+
+    def test_set_get_clear(self):
+        self.assertFalse(self.table.get('a'))
+        self.assertEqual(self.table.set('a', 10), 0)
+        self.assertTrue(self.table.get('a'))
+        self.assertTrue(self.table.clear('a'))
+        self.assertFalse(self.table.get('a'))
+        self.assertFalse(self.table.clear('a'))
+        self.assertEqual(self.table.live_entries(), 0)
+
+    def test_entry_expires_and_touch_extends_it(self):
+        self.table.set('a', 10)
+        self.clock.advance(8)
+        self.assertTrue(self.table.touch('a', 10))
+        self.clock.advance(8)
+        self.assertTrue(self.table.get('a'))
+        self.clock.advance(2)
+        self.assertFalse(self.table.get('a'))
+        self.assertFalse(self.table.touch('a', 10))  # 已过期，续期不会使其复活
+        self.assertFalse(self.table.touch('missing', 10))
+
+    def test_probe_continues_past_cleared_slot(self):
+        self.table.set('a', 10)
+        self.table.set('b', 10)
+        self.assertEqual((self.slot_of('a'), self.slot_of('b')), (0, 1))
+        self.table.clear('a')
+        self.assertTrue(self.table.get('b'))
+        self.assertTrue(self.table.clear('b'))
+
+    def test_set_reuses_cleared_and_expired_slots(self):
+        self.table.set('a', 10)
+        self.table.set('b', 1)
+        self.table.set('c', 10)
+        self.table.clear('a')
+        self.table.set('d', 10)
+        self.assertEqual(self.slot_of('d'), 0)
+        self.clock.advance(1)
+        self.table.set('e', 10)
+        self.assertEqual(self.slot_of('e'), 1)
+        self.assertEqual(self.table.live_entries(), 3)
+
+    def test_set_overwrites_existing_key(self):
+        self.table.set('a', 1)
+        self.table.set('a', 10)
+        self.clock.advance(5)
+        self.assertTrue(self.table.get('a'))
+        self.assertEqual(self.table.live_entries(), 1)
+
+    def test_full_window_evicts_earliest_expiry(self):
+        for i in range(MAX_PROBES):
+            self.assertEqual(self.table.set(f'gen-{i}', 100 + i), 0)
+        self.table.set('gen-0', 500)  # 续写后 gen-1 变为最早过期的条目
+        self.assertEqual(self.table.set('new', 10), 1)
+        self.assertTrue(self.table.get('new'))
+        self.assertFalse(self.table.get('gen-1'))
+        self.assertTrue(self.table.get('gen-0'))
+        self.assertEqual(self.table.live_entries(), MAX_PROBES)
+
+    def test_second_instance_shares_entries(self):
+        other = SharedStopTable(self.path, slots=64, clock=self.clock)
+        try:
+            self.assertEqual(other.slots, 1)  # 参数不一致时以文件头为准
+            self.table.set('a', 10)
+            self.assertTrue(other.get('a'))
+            other.clear('a')
+            self.assertFalse(self.table.get('a'))
+        finally:
+            other.close()
+
+
+class FakeConsumer:
+    def __init__(self, channel_name):
+        self.channel_name = channel_name
+        self.received = []
+
+    async def broadcast_event(self, message):
+        self.received.append(message['event'])
+
+
+class FakePresence:
+    def __init__(self):
+        self.remote = False
+
+    async def add(self, group, channel_name):
+        pass
+
+    async def remove(self, group, channel_name):
+        pass
+
+    async def has_remote(self, group):
+        return self.remote
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class FakeChannelLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message['event']))
+
+
+class ConversationEventDispatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.presence = FakePresence()
+        self.dispatcher = ConversationEventDispatcher(self.presence)
+        self.layer = FakeChannelLayer()
+        patcher = mock.patch('chat.event_dispatch.get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def emit(self, generation_id, seq, event_type='stream_update'):
+        await self.dispatcher.dispatch(1, event_type, {'generation_id': generation_id, 'seq': seq})
+
+    async def test_local_only_subscribers_bypass_channel_layer(self):
+        consumer = FakeConsumer('local')
+        await self.dispatcher.subscribe('chat_1', consumer)
+        for seq in (1, 2, 3):
+            await self.emit('gen', seq)
+        self.assertEqual([event['data']['seq'] for event in consumer.received], [1, 2, 3])
+        self.assertEqual(self.layer.sent, [])
+
+    async def test_no_local_subscribers_uses_channel_layer(self):
+        await self.emit('gen', 1)
+        self.assertEqual(len(self.layer.sent), 1)
+
+    async def test_generation_stays_on_channel_layer_after_remote_subscriber_joins(self):
+        consumer = FakeConsumer('local')
+        await self.dispatcher.subscribe('chat_1', consumer)
+        await self.emit('gen', 1)
+        self.presence.remote = True
+        await self.emit('gen', 2)
+        # 远程订阅者离开后，该生成任务仍走 channel layer，直接投递不会越过队列中的事件
+        self.presence.remote = False
+        await self.emit('gen', 3)
+        await self.emit('gen', 4, 'generation_end')
+        self.assertEqual([event['data']['seq'] for event in consumer.received], [1])
+        self.assertEqual([event['data']['seq'] for _group, event in self.layer.sent], [2, 3, 4])
+        # 生成结束后路径被忘记，新的生成任务重新选择直接投递
+        await self.emit('next', 1)
+        self.assertEqual(consumer.received[-1]['data'], {'generation_id': 'next', 'seq': 1})
+        self.assertEqual(self.dispatcher.stats()['channel_layer_generations'], 0)
+
+    async def test_mixed_generations_choose_paths_independently(self):
+        consumer = FakeConsumer('local')
+        await self.dispatcher.subscribe('chat_1', consumer)
+        await self.emit('local-gen', 1)
+        self.presence.remote = True
+        await self.emit('mixed-gen', 1)
+        self.presence.remote = False
+        await self.emit('local-gen', 2)
+        await self.emit('mixed-gen', 2)
+        self.assertEqual([(e['data']['generation_id'], e['data']['seq']) for e in consumer.received],
+                         [('local-gen', 1), ('local-gen', 2)])
+        self.assertEqual([(e['data']['generation_id'], e['data']['seq']) for _g, e in self.layer.sent],
+                         [('mixed-gen', 1), ('mixed-gen', 2)])
+
+
+class CountingPresence(RedisSubscriberPresence):
+    """用计数代替 Redis 查询的 RedisSubscriberPresence。"""
+
+    def __init__(self, clock):
+        super().__init__({}, cache_ttl=5, clock=clock)
+        self.remote = False
+        self.fetches = 0
+        self.before_fetch_returns = None
+
+    async def _fetch_has_remote(self, group):
+        self.fetches += 1
+        remote = self.remote
+        if self.before_fetch_returns is not None:
+            self.before_fetch_returns()
+        return remote
+
+
+class RedisSubscriberPresenceCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.presence = CountingPresence(self.clock)
+        self.presence.set_subscribed(True)
+
+    async def test_lookups_are_cached_until_ttl(self):
+        for _ in range(3):
+            self.assertFalse(await self.presence.has_remote('chat_1'))
+        self.assertEqual(self.presence.fetches, 1)
+        self.clock.advance(5)
+        await self.presence.has_remote('chat_1')
+        self.assertEqual(self.presence.fetches, 2)
+
+    async def test_invalidation_refetches(self):
+        await self.presence.has_remote('chat_1')
+        self.presence.remote = True
+        self.presence.invalidate('chat_1')
+        self.assertTrue(await self.presence.has_remote('chat_1'))
+
+    async def test_result_read_before_invalidation_is_not_cached(self):
+        def join_during_fetch():
+            self.presence.before_fetch_returns = None
+            self.presence.remote = True
+            self.presence.invalidate('chat_1')
+        self.presence.before_fetch_returns = join_during_fetch
+        self.assertFalse(await self.presence.has_remote('chat_1'))
+        self.assertTrue(await self.presence.has_remote('chat_1'))
+
+    async def test_not_cached_while_unsubscribed(self):
+        self.presence.set_subscribed(False)
+        await self.presence.has_remote('chat_1')
+        await self.presence.has_remote('chat_1')
+        self.assertEqual(self.presence.fetches, 2)
+
+
+class EventLogTestsMixin:
+    """InMemoryEventLog 和 SharedFileEventLog 共用的测试。"""
+
+    def seqs(self, events):
+        return [event['data']['seq'] for event in events]
+
+    def append(self, log, generation_id='gen', event_type='stream_update', **data):
+        return log.append(generation_id, 7, event_type, {'generation_id': generation_id, **data})
+
+    def test_replays_events_after_last_seq(self):
+        for piece in ('a', 'b', 'c'):
+            self.append(self.log, content=piece)
+        events = self.log.read_since('gen', 1)
+        self.assertEqual(self.seqs(events), [2, 3])
+        self.assertEqual(events[0], {'type': 'stream_update', 'data': {'generation_id': 'gen', 'content': 'b', 'seq': 2}})
+        self.assertEqual(self.log.get_conversation_id('gen'), '7')
+        self.assertIsNone(find_gap('gen', 1, events))
+
+    def test_log_expires_after_ttl_since_last_append(self):
+        self.append(self.log)
+        self.clock.advance(EVENT_LOG_TTL - 1)
+        self.append(self.log)
+        self.clock.advance(EVENT_LOG_TTL - 1)
+        self.assertEqual(self.seqs(self.log.read_since('gen')), [1, 2])
+        self.clock.advance(1)
+        self.assertEqual(self.log.read_since('gen'), [])
+        self.assertIsNone(self.log.get_conversation_id('gen'))
+
+    def test_trimmed_start_is_reported_as_gap(self):
+        for _ in range(10):
+            self.append(self.log)
+        events = self.log.read_since('gen', 0)
+        self.assertLess(len(events), 10)
+        self.assertEqual(self.seqs(events)[-1], 10)
+        gap = find_gap('gen', 0, events)
+        self.assertEqual(gap['type'], 'generation_gap')
+        self.assertEqual(gap['data']['first_seq'], events[0]['data']['seq'])
+
+    async def test_await_for_events_wakes_on_append(self):
+        self.append(self.log)
+        waiting = asyncio.ensure_future(self.log.await_for_events('gen', 1, 5))
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        await asyncio.to_thread(self.append, self.log)
+        self.assertEqual(self.seqs(await asyncio.wait_for(waiting, 1)), [2])
+
+
+class InMemoryEventLogTests(EventLogTestsMixin, SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.log = InMemoryEventLog(max_events=4, clock=self.clock)
+
+
+class SharedFileEventLogTests(EventLogTestsMixin, SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory(prefix='event-log-')
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.clock = FakeClock(now=1_700_000_000.0)
+        self.log = self.open_worker()
+
+    def open_worker(self):
+        """同一目录上的另一个实例，相当于同一主机上的另一个 worker。"""
+        return SharedFileEventLog(self.directory, max_events=4, poll_interval=0.01, clock=self.clock)
+
+    def test_other_worker_resumes_the_generation(self):
+        self.append(self.log, content='a')
+        self.append(self.log, content='b')
+        other = self.open_worker()
+        self.assertEqual(other.get_conversation_id('gen'), '7')
+        self.assertEqual([event['data']['content'] for event in other.read_since('gen', 1)], ['b'])
+        self.assertEqual(other.read_since('unknown'), [])
+
+    async def test_other_worker_sees_new_events_while_waiting(self):
+        self.append(self.log)
+        other = self.open_worker()
+        waiting = asyncio.ensure_future(other.await_for_events('gen', 1, 5))
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiting.done())
+        self.append(self.log)
+        self.assertEqual(self.seqs(await asyncio.wait_for(waiting, 1)), [2])
+
+    def test_incomplete_last_line_is_ignored(self):
+        self.append(self.log)
+        with open(self.log._path('gen'), 'ab') as f:
+            f.write(b'2\t{"type": "stream_up')
+        self.assertEqual(self.seqs(self.log.read_since('gen')), [1])
+
+    def test_writer_continues_numbering_after_losing_its_state(self):
+        self.append(self.log)
+        self.append(self.log)
+        self.assertEqual(self.append(self.open_worker()), 3)
+
+    def test_sweep_removes_expired_and_excess_files(self):
+        self.append(self.log, 'old')
+        self.clock.advance(EVENT_LOG_TTL)
+        self.append(self.log, 'new')
+        self.log.sweep()
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(self.log._path('new'))])
+        with mock.patch('chat.event_log.EVENT_LOG_MAX_GENERATIONS', 1):
+            self.clock.advance(1)
+            self.append(self.log, 'newer')
+            self.log.sweep()
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(self.log._path('newer'))])
+
+    def test_generation_id_is_not_used_as_a_path(self):
+        self.append(self.log, '../../escape')
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(self.seqs(self.log.read_since('../../escape')), [1])
+
+
+class EventBroadcasterTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def fake_send(self, conversation_id, event_type, data):
+        if data['n'] == 0:
+            await asyncio.sleep(0.01)
+        self.sent.append((event_type, data['n']))
+
+    async def test_events_from_a_thread_are_sent_in_order_on_the_loop(self):
+        broadcaster = EventBroadcaster(asyncio.get_running_loop())
+
+        def emit():
+            for n in range(3):
+                broadcaster.send(1, 'stream_update', {'n': n})
+
+        with mock.patch('chat.services.send_generation_event', self.fake_send):
+            await asyncio.to_thread(emit)
+            await asyncio.wrap_future(broadcaster._previous)
+        self.assertEqual(self.sent, [('stream_update', 0), ('stream_update', 1), ('stream_update', 2)])
+
+    def test_closed_loop_falls_back_to_async_to_sync(self):
+        loop = asyncio.new_event_loop()
+        loop.close()
+        broadcaster = EventBroadcaster(loop)
+        with mock.patch('chat.services.send_generation_event', self.fake_send):
+            broadcaster.send(1, 'generation_end', {'n': 1})
+        self.assertEqual(self.sent, [('generation_end', 1)])
+
+
+class CancelOnDisconnectMiddlewareTests(SimpleTestCase):
+    async def test_only_listed_paths_are_wrapped(self):
+        calls = []
+
+        async def app(scope, receive, send):
+            calls.append((scope['path'], receive))
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        middleware = CancelOnDisconnectMiddleware(app, paths=['/chat/api/http_chat/'])
+        await middleware({'type': 'http', 'path': '/chat/api/models/'}, receive, None)
+        await middleware({'type': 'http', 'path': '/prefix/chat/api/http_chat/', 'root_path': '/prefix'}, receive, None)
+        self.assertIs(calls[0][1], receive)
+        self.assertIsNot(calls[1][1], receive)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.chunks = []
+
+    async def write(self, chunk):
+        self.chunks.append(chunk)
+
+
+class StreamingJSONBodyTests(SimpleTestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.media_root = media_root.name
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch('chat.request_body.image_data_url_cache', DataURLCache(1024 * 1024, 1024 * 1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_file(self, name, content):
+        with open(os.path.join(self.media_root, name), 'wb') as f:
+            f.write(content)
+        return name
+
+    def assertBodyIsValid(self, body):
+        data = b''.join(body)
+        self.assertEqual(len(data), len(body))
+        return json.loads(data)
+
+    def test_plain_request_matches_json(self):
+        request_data = {'model': 'm', 'messages': [{'role': 'user', 'content': '你好'}], 'stream': True}
+        body = StreamingJSONBody(request_data)
+        self.assertFalse(body.has_files)
+        self.assertEqual(self.assertBodyIsValid(body), request_data)
+
+    def test_pre_encoded_message_bytes_are_used_verbatim(self):
+        message = PreEncodedMessage({'role': 'user', 'content': 'dict'}, encode_message({'role': 'user', 'content': 'cached'}))
+        # 其他场景仍按普通字典处理
+        self.assertEqual(json.loads(json.dumps(message)), {'role': 'user', 'content': 'dict'})
+        body = StreamingJSONBody({'messages': [message, {'role': 'assistant', 'content': 'plain'}]})
+        self.assertEqual(self.assertBodyIsValid(body)['messages'], [
+            {'role': 'user', 'content': 'cached'}, {'role': 'assistant', 'content': 'plain'},
+        ])
+
+    def test_stored_image_is_streamed_as_data_url(self):
+        content = bytes(range(10))  # 长度不是 3 的倍数
+        stored = StoredDataURL(self.write_file('a.png', content))
+        request_data = {'messages': [{'role': 'user', 'content': [{'type': 'image_url', 'image_url': {'url': stored}}]}]}
+        with mock.patch('chat.request_body.READ_CHUNK_BYTES', 3):
+            body = StreamingJSONBody(request_data)
+            self.assertTrue(body.has_files)
+            for _attempt in range(2):  # 故障转移时重复发送
+                url = self.assertBodyIsValid(body)['messages'][0]['content'][0]['image_url']['url']
+                self.assertEqual(url, 'data:image/png;base64,' + base64.b64encode(content).decode('ascii'))
+
+    def test_changed_file_aborts_instead_of_sending_a_wrong_length(self):
+        for replacement in (b'longer content', b'short'):
+            name = self.write_file('b.png', b'original')
+            body = StreamingJSONBody({'messages': [{'role': 'user', 'content': StoredDataURL(name)}]})
+            self.write_file(name, replacement)
+            with self.assertRaises(StoredFileChangedError):
+                b''.join(body)
+
+    async def test_async_payload_writes_all_segments(self):
+        name = self.write_file('c.png', b'image bytes')
+        body = StreamingJSONBody({'messages': [{'role': 'user', 'content': StoredDataURL(name)}], 'stream': True})
+        writer = FakeWriter()
+        await body.as_aiohttp_payload().write(writer)
+        self.assertEqual(b''.join(writer.chunks), b''.join(body))
+
+    async def test_cancelled_write_closes_iterator_after_pending_read(self):
+        entered, release, closed = threading.Event(), threading.Event(), threading.Event()
+
+        def blocking_image(stored):
+            try:
+                entered.set()
+                release.wait(5)
+                yield b'AAAA'
+            finally:
+                closed.set()
+
+        name = self.write_file('d.png', b'abc')
+        body = StreamingJSONBody({'messages': [{'role': 'user', 'content': StoredDataURL(name)}]})
+        with mock.patch.object(StreamingJSONBody, '_iter_image', staticmethod(blocking_image)):
+            task = asyncio.ensure_future(body.as_aiohttp_payload().write(FakeWriter()))
+            await asyncio.to_thread(entered.wait, 5)
+            task.cancel()
+            # 线程中的读取仍在进行，取消不能因为关闭生成器而变成其他错误
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertFalse(closed.is_set())
+            release.set()
+            await asyncio.to_thread(closed.wait, 5)
+        self.assertTrue(closed.is_set())
+
+
+class SharedStopTableValueTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='value-table-')
+        os.close(fd)
+        self.clock = FakeClock()
+        self.table = SharedStopTable(self.path, slots=1, clock=self.clock, value_size=8)
+
+    def tearDown(self):
+        self.table.close()
+        os.unlink(self.path)
+
+    def test_values_are_stored_per_key(self):
+        self.table.set('a', 10, b'first')
+        self.table.set('b', 10, b'second')
+        self.table.set('a', 10, b'x')  # 覆盖时不残留旧值
+        self.assertEqual((self.table.get_value('a'), self.table.get_value('b')), (b'x', b'second'))
+        self.assertEqual(self.table.live_entries(), 2)
+        self.clock.advance(10)
+        self.assertIsNone(self.table.get_value('a'))
+        with self.assertRaises(ValueError):
+            self.table.set('a', 10, b'too long!')
+
+    def test_clear_with_match_compares_under_the_same_lock(self):
+        self.table.set('a', 10, b'gen-1')
+        self.assertFalse(self.table.clear('a', match=lambda value: value == b'gen-2'))
+        self.assertEqual(self.table.get_value('a'), b'gen-1')
+        self.assertTrue(self.table.clear('a', match=lambda value: value == b'gen-1'))
+        self.assertIsNone(self.table.get_value('a'))
+
+    def test_existing_file_keeps_its_layout(self):
+        self.table.set('a', 10, b'value')
+        other = SharedStopTable(self.path, slots=64, clock=self.clock, value_size=0)
+        try:
+            self.assertEqual((other.slots, other.value_size), (1, 8))
+            self.assertEqual(other.get_value('a'), b'value')
+        finally:
+            other.close()
+
+
+class GenerationRegistryTestsMixin:
+    def test_start_get_finish(self):
+        self.registry.start(1, 'gen-1', model_id=7)
+        entry = self.registry.get('1')
+        self.assertEqual((entry['generation_id'], entry['conversation_id'], entry['model_id']), ('gen-1', '1', 7))
+        self.assertEqual(self.registry.current_generation_id(1), 'gen-1')
+        self.registry.finish(1, 'gen-1')
+        self.assertIsNone(self.registry.current_generation_id(1))
+
+    def test_finish_keeps_a_newer_generation(self):
+        self.registry.start(1, 'gen-1')
+        self.registry.start(1, 'gen-2')
+        self.registry.finish(1, 'gen-1')
+        self.assertEqual(self.registry.current_generation_id(1), 'gen-2')
+
+    def test_entry_expires_after_ttl(self):
+        self.registry.start(1, 'gen-1')
+        self.clock.advance(GENERATION_REGISTRY_TTL)
+        self.assertIsNone(self.registry.current_generation_id(1))
+
+    async def test_async_interface(self):
+        await self.registry.astart(2, 'gen-3')
+        self.assertEqual(await self.registry.acurrent_generation_id(2), 'gen-3')
+        await self.registry.afinish(2, 'gen-3')
+        self.assertIsNone(await self.registry.acurrent_generation_id(2))
+
+
+class InMemoryGenerationRegistryTests(GenerationRegistryTestsMixin, SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.registry = InMemoryGenerationRegistry(clock=self.clock)
+
+
+class SharedMemoryGenerationRegistryTests(GenerationRegistryTestsMixin, SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='generation-registry-')
+        os.close(fd)
+        self.clock = FakeClock()
+        self.registry = SharedMemoryGenerationRegistry(self.path, slots=64, clock=self.clock)
+
+    def tearDown(self):
+        self.registry._table.close()
+        os.unlink(self.path)
+
+    def test_other_worker_sees_and_finishes_the_entry(self):
+        other = SharedMemoryGenerationRegistry(self.path, slots=64, clock=self.clock)
+        try:
+            self.registry.start(1, 'gen-1')
+            self.assertEqual(other.current_generation_id(1), 'gen-1')
+            other.finish(1, 'gen-1')
+            self.assertIsNone(self.registry.current_generation_id(1))
+        finally:
+            other._table.close()
+
+    def test_long_worker_id_still_fits(self):
+        with mock.patch('chat.generation_registry.WORKER_ID', 'h' * 300):
+            self.registry.start(1, 'gen-1')
+        self.assertEqual(self.registry.current_generation_id(1), 'gen-1')
+
+
+class FakeSortedSetClient:
+    """只实现回复缓存条目索引用到的 Redis 命令。"""
+
+    def __init__(self):
+        self.zsets = {}
+        self.deleted = []
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.zsets.get(key, {})
+        for member in [member for member, score in zset.items() if score <= high]:
+            del zset[member]
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    def expire(self, key, ttl):
+        return True
+
+    def zpopmin(self, key, count):
+        zset = self.zsets.get(key, {})
+        popped = sorted(zset.items(), key=lambda item: (item[1], item[0]))[:count]
+        for member, _score in popped:
+            del zset[member]
+        return popped
+
+    def delete(self, *keys):
+        self.deleted.extend(keys)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+@override_settings(COMPLETION_CACHE_TTL=100, COMPLETION_CACHE_MAX_ENTRIES=2)
+class CompletionCacheTests(SimpleTestCase):
+    model = {'id': 1, 'model_name': 'm', 'response_cache_enabled': True, 'default_params': {'temperature': 0}}
+
+    def setUp(self):
+        self.completions = CompletionCache()
+        caches['completions'].clear()
+        self.addCleanup(caches['completions'].clear)
+
+    def messages(self, text):
+        return [{'role': 'user', 'content': text}]
+
+    def test_regenerate_bypasses_lookup_but_stores(self):
+        key, cached = self.completions.lookup(self.model, self.messages('hi'))
+        self.assertIsNone(cached)
+        self.completions.store(key, 'first')
+        self.assertEqual(self.completions.lookup(self.model, self.messages('hi')), (key, 'first'))
+        self.assertEqual(self.completions.lookup(self.model, self.messages('hi'), bypass=True), (key, None))
+        self.completions.store(key, 'regenerated')
+        self.assertEqual(self.completions.lookup(self.model, self.messages('hi'))[1], 'regenerated')
+        # 跳过缓存的查询不计入命中统计
+        self.assertEqual(self.completions.stats([1]), {1: {'hits': 2, 'misses': 1}})
+
+    async def test_async_regenerate_bypasses_lookup(self):
+        key, _cached = self.completions.lookup(self.model, self.messages('hi'))
+        self.completions.store(key, 'first')
+        self.assertEqual(await self.completions.alookup(self.model, self.messages('hi'), bypass=True), (key, None))
+
+    def test_redis_index_evicts_oldest_entries_beyond_the_limit(self):
+        client = FakeSortedSetClient()
+        clock = FakeClock()
+        with mock.patch.object(CompletionCache, '_index_client', return_value=client), \
+                mock.patch('chat.completion_cache.time.time', clock):
+            keys = []
+            for text in ('a', 'b', 'c'):
+                keys.append(self.completions.lookup(self.model, self.messages(text))[0])
+                self.completions.store(keys[-1], text)
+                clock.advance(1)
+            index = self.completions.cache.make_key('reply_index')
+            self.assertEqual(client.deleted, [self.completions.cache.make_key(keys[0])])
+            self.assertEqual(client.zcard(index), 2)
+            # 已过期的索引成员不占用名额
+            clock.advance(100)
+            self.completions.store(keys[0], 'a')
+            self.assertEqual(client.zcard(index), 1)
+            self.assertEqual(len(client.deleted), 1)
+
+
+class ProviderSessionRegistryTests(SimpleTestCase):
+    async def test_session_is_rebuilt_when_fingerprint_changes(self):
+        registry = ProviderSessionRegistry()
+        try:
+            async with registry.session_for(1, 'https://a', 'key-1') as first:
+                async with registry.session_for(1, 'https://a', 'key-1') as same:
+                    self.assertIs(same, first)
+                # api_key 变化：新请求使用新会话，旧会话在进行中的请求结束后才关闭
+                async with registry.session_for(1, 'https://a', 'key-2') as rebuilt:
+                    self.assertIsNot(rebuilt, first)
+                    self.assertFalse(first.closed)
+            await asyncio.sleep(0)
+            self.assertTrue(first.closed)
+            async with registry.session_for(1, 'https://b', 'key-2') as moved:
+                self.assertIsNot(moved, rebuilt)
+        finally:
+            await registry.close_all()
+
+    async def test_invalidate_from_a_worker_thread(self):
+        registry = ProviderSessionRegistry()
+        try:
+            async with registry.session_for(1, 'https://a', 'key') as first:
+                pass
+            # 管理接口在同步视图的线程中调用 invalidate
+            await asyncio.to_thread(registry.invalidate, 1)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            self.assertTrue(first.closed)
+            async with registry.session_for(1, 'https://a', 'key') as rebuilt:
+                self.assertIsNot(rebuilt, first)
+        finally:
+            await registry.close_all()
+
+
+class ProviderSchedulerTests(SimpleTestCase):
+    model = {'id': 1, 'provider_id': 10, 'provider_max_concurrent': 1, 'provider_max_queued': 0}
+
+    def setUp(self):
+        self.scheduler = ProviderScheduler()
+        self.events = []
+
+    def enqueue(self, user_key, name, model=None):
+        def notify(item):
+            self.events.append((name, 'granted' if item is _GRANTED else item))
+        return self.scheduler._enqueue(model or self.model, user_key, notify)
+
+    def granted(self):
+        return [name for name, item in self.events if item == 'granted']
+
+    def test_waiters_are_served_round_robin_across_users(self):
+        self.assertIsNone(self.enqueue('a', 'a0'))  # 直接获得名额
+        for user_key, name in (('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1'), ('c', 'c1')):
+            self.enqueue(user_key, name)
+        positions = {name: item for name, item in self.events}
+        self.assertEqual(positions, {'a1': 1, 'b1': 2, 'c1': 3, 'a2': 4, 'a3': 5})
+        for _ in range(5):
+            self.scheduler._release(self.model)
+        self.assertEqual(self.granted(), ['a1', 'b1', 'c1', 'a2', 'a3'])
+        self.assertEqual(self.scheduler.stats()[10], {'active': 1, 'waiting': 0, 'limit': 1})
+
+    def test_full_queue_rejects_immediately(self):
+        model = {**self.model, 'provider_max_queued': 2}
+        self.enqueue('a', 'a0', model)
+        self.enqueue('a', 'a1', model)
+        self.enqueue('b', 'b1', model)
+        with self.assertRaises(ProviderBusyError):
+            self.enqueue('c', 'c1', model)
+        self.assertEqual(self.scheduler.stats()[10]['waiting'], 2)
+
+    def test_model_limit_does_not_block_other_models(self):
+        limited = {**self.model, 'provider_max_concurrent': 0, 'max_concurrent': 1}
+        other = {**limited, 'id': 2}
+        self.assertIsNone(self.enqueue('a', 'm1-first', limited))
+        waiter = self.enqueue('a', 'm1-second', limited)
+        self.assertIsNotNone(waiter)
+        # 另一个模型不受 model 1 的上限影响，即使有请求在排队
+        self.enqueue('b', 'm2', other)
+        self.assertEqual(self.granted(), ['m2'])
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        positions = []
+
+        async def on_queued(position):
+            positions.append(position)
+
+        async with self.scheduler.slot(self.model, 'a'):
+            waiting = asyncio.ensure_future(self._hold(self.scheduler.slot(self.model, 'b', on_queued=on_queued)))
+            await asyncio.sleep(0.01)
+            self.assertEqual((positions, self.scheduler.stats()[10]['waiting']), ([1], 1))
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            self.assertEqual(self.scheduler.stats()[10]['waiting'], 0)
+        self.assertEqual(self.scheduler.stats()[10]['active'], 0)
+
+    @staticmethod
+    async def _hold(slot):
+        async with slot:
+            await asyncio.sleep(60)
+
+
+class FakeUpstreamResponse:
+    def __init__(self, status, first_byte_delay):
+        self.status = status
+        self.first_byte_delay = first_byte_delay
+        self.closed = False
+
+    async def text(self):
+        return 'error'
+
+    @property
+    def content(self):
+        return self
+
+    async def read(self, n=-1):
+        await asyncio.sleep(self.first_byte_delay)
+        return b'data: {}\n\n'
+
+
+class FakeUpstreamSession:
+    """按 URL 返回预设的响应，记录每个响应是否已被释放。"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.posted = []
+
+    @asynccontextmanager
+    async def _post(self, url):
+        self.posted.append(url)
+        response = self.responses[url]
+        try:
+            yield response
+        finally:
+            response.closed = True
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        return self._post(url)
+
+
+class OpenUpstreamTests(SimpleTestCase):
+    primary = {'id': 1, 'provider_id': 901, 'provider_base_url': 'primary', 'provider_api_key': 'k'}
+    secondary = {'id': 2, 'provider_id': 902, 'provider_base_url': 'secondary', 'provider_api_key': 'k'}
+
+    def setUp(self):
+        self.session = FakeUpstreamSession({})
+
+        @asynccontextmanager
+        async def session_for(provider_id, base_url, api_key):
+            yield self.session
+
+        for patcher in (
+            mock.patch('chat.upstream.provider_sessions.session_for', session_for),
+            mock.patch('chat.upstream.HEDGE_ENABLED', True),
+            mock.patch('chat.upstream.ttft_tracker.hedge_delay', return_value=0.01),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def build_request(model):
+        return model['provider_base_url'], {}, {'messages': []}
+
+    async def open(self, is_streaming=True):
+        return await open_upstream(
+            [self.primary, self.secondary], 'user', self.build_request, None, first_byte_timeout=5, is_streaming=is_streaming
+        )
+
+    def assertSlotsReleased(self):
+        stats = provider_scheduler.stats()
+        for model in (self.primary, self.secondary):
+            self.assertEqual(stats.get(model['provider_id'], {'active': 0})['active'], 0)
+
+    async def test_slow_first_chunk_is_hedged_and_loser_is_closed(self):
+        slow, fast = FakeUpstreamResponse(200, 60), FakeUpstreamResponse(200, 0)
+        self.session.responses = {'primary': slow, 'secondary': fast}
+        async with await self.open() as attempt:
+            self.assertIs(attempt.model, self.secondary)
+            self.assertEqual(attempt.first_chunk, b'data: {}\n\n')
+            # 落败的请求已被取消，响应和调度名额都已释放
+            self.assertTrue(slow.closed)
+            self.assertFalse(fast.closed)
+            self.assertEqual(provider_scheduler.stats()[self.primary['provider_id']]['active'], 0)
+        self.assertTrue(fast.closed)
+        self.assertSlotsReleased()
+
+    async def test_fast_primary_is_not_hedged(self):
+        self.session.responses = {'primary': FakeUpstreamResponse(200, 0), 'secondary': FakeUpstreamResponse(200, 0)}
+        async with await self.open() as attempt:
+            self.assertIs(attempt.model, self.primary)
+        self.assertEqual(self.session.posted, ['primary'])
+
+    async def test_non_streaming_request_is_not_hedged(self):
+        self.session.responses = {'primary': FakeUpstreamResponse(200, 60), 'secondary': FakeUpstreamResponse(200, 0)}
+        async with await self.open(is_streaming=False) as attempt:
+            self.assertIs(attempt.model, self.primary)
+            self.assertIsNone(attempt.first_chunk)
+        self.assertEqual(self.session.posted, ['primary'])
+
+    async def test_server_error_fails_over_but_client_error_does_not(self):
+        failing = FakeUpstreamResponse(503, 0)
+        self.session.responses = {'primary': failing, 'secondary': FakeUpstreamResponse(200, 0)}
+        async with await self.open() as attempt:
+            self.assertIs(attempt.model, self.secondary)
+        self.assertTrue(failing.closed)
+        self.session.responses['primary'] = FakeUpstreamResponse(401, 0)
+        with self.assertRaises(UpstreamHTTPError):
+            await self.open()
+        self.assertSlotsReleased()
+
+
+class StreamCoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append(content)
+
+    async def test_pieces_within_the_interval_are_sent_together(self):
+        coalescer = StreamCoalescer(self.send, interval_ms=20, max_bytes=1000)
+        for piece in ('a', 'b', 'c'):
+            await coalescer.add(piece)
+        self.assertEqual(self.sent, [])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, ['abc'])
+        await coalescer.add('d')
+        await coalescer.aclose()
+        self.assertEqual(self.sent, ['abc', 'd'])
+        self.assertEqual((coalescer.pieces_in, coalescer.flushes), (4, 2))
+
+    async def test_max_bytes_flushes_before_the_interval(self):
+        coalescer = StreamCoalescer(self.send, interval_ms=10000, max_bytes=6)
+        await coalescer.add('你')  # 3 字节
+        await coalescer.add('好')
+        await coalescer.add('x')
+        self.assertEqual(self.sent, ['你好'])
+        await coalescer.aclose()
+        self.assertEqual(self.sent, ['你好', 'x'])
+
+    async def test_zero_interval_sends_every_piece(self):
+        coalescer = StreamCoalescer(self.send, interval_ms=0)
+        await coalescer.add('a')
+        await coalescer.add('')
+        await coalescer.add('b')
+        self.assertEqual(self.sent, ['a', 'b'])
+
+
+class SyncStreamCoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.flushed = threading.Event()
+
+    def send(self, content):
+        self.sent.append(content)
+        self.flushed.set()
+
+    def test_timer_flushes_buffered_pieces(self):
+        coalescer = SyncStreamCoalescer(self.send, interval_ms=20, max_bytes=1000)
+        coalescer.add('a')
+        coalescer.add('b')
+        self.assertEqual(self.sent, [])
+        # 上游停顿时已缓冲的内容也会按时发送
+        self.assertTrue(self.flushed.wait(1))
+        self.assertEqual(self.sent, ['ab'])
+        coalescer.close()
+        self.assertEqual(self.sent, ['ab'])
+
+    def test_max_bytes_and_close_flush_in_order(self):
+        coalescer = SyncStreamCoalescer(self.send, interval_ms=10000, max_bytes=4)
+        for piece in ('ab', 'cd', 'e'):
+            coalescer.add(piece)
+        self.assertEqual(self.sent, ['abcd'])
+        coalescer.close()
+        self.assertEqual(self.sent, ['abcd', 'e'])
+        self.assertEqual((coalescer.pieces_in, coalescer.flushes), (3, 2))
+
+
+class FakeAttachments:
+    def all(self):
+        return []
+
+
+class FakeMessage:
+    def __init__(self, message_id, conversation_id=1, content='text'):
+        self.id = message_id
+        self.conversation_id = conversation_id
+        self.timestamp = message_id
+        self.is_user = message_id % 2 == 1
+        self.content = content
+        self.token_count = 1
+        self.attachments = FakeAttachments()
+
+
+class ConversationContextCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.messages = [FakeMessage(1), FakeMessage(2)]
+        self.fetches = 0
+
+        def fetch_history_window(conversation_id, limit, user_message_id=None, is_regenerate=False):
+            self.fetches += 1
+            return list(self.messages[-limit:] if limit > 0 else self.messages)
+
+        patcher = mock.patch('chat.context_builder.fetch_history_window', fetch_history_window)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # 两个 worker 共享同一个 Django 缓存中的版本号（Redis 模式）
+        self.worker = ConversationContextCache()
+        self.other_worker = ConversationContextCache()
+
+    def ids(self, entries):
+        return [entry.id for entry in entries]
+
+    def test_window_is_served_from_cache_until_version_changes(self):
+        self.assertEqual(self.ids(self.worker.get_window(1, 10)), [1, 2])
+        self.assertEqual(self.ids(self.worker.get_window(1, 10)), [1, 2])
+        self.assertEqual((self.fetches, self.worker.hits, self.worker.misses), (1, 1, 1))
+        # 另一个 worker 写入了消息：版本号递增，本地缓存下次读取时重新加载
+        self.messages.append(FakeMessage(3))
+        self.other_worker.on_message_saved(self.messages[-1])
+        self.assertEqual(self.ids(self.worker.get_window(1, 10)), [1, 2, 3])
+        self.assertEqual(self.fetches, 2)
+
+    def test_local_write_updates_cache_in_place(self):
+        self.worker.get_window(1, 10)
+        self.messages.append(FakeMessage(3))
+        self.worker.on_message_saved(self.messages[-1])
+        self.worker.on_message_deleted(1, 2)
+        self.assertEqual(self.ids(self.worker.get_window(1, 10)), [1, 3])
+        self.assertEqual(self.fetches, 1)
+
+    def test_missed_version_drops_local_copy(self):
+        self.worker.get_window(1, 10)
+        self.other_worker.on_conversation_changed(1)
+        # 本地缓存不是上一个版本，不能原地更新
+        self.messages.append(FakeMessage(3))
+        self.worker.on_message_saved(self.messages[-1])
+        self.assertEqual(self.worker.stats()['conversations'], 0)
+        self.assertEqual(self.ids(self.worker.get_window(1, 10)), [1, 2, 3])
+        self.assertEqual(self.fetches, 2)
+
+    def test_regenerate_window_stops_at_user_message(self):
+        self.messages.append(FakeMessage(3))
+        self.assertEqual(self.ids(self.worker.get_window(1, 10, user_message_id=1, is_regenerate=True)), [1])
+
+
+class ConversationSummarizerCompactTests(SimpleTestCase):
+    def setUp(self):
+        self.watermark = FakeMessage(10)
+        self.conversation = mock.Mock(user_id=7, summary='旧摘要', summary_until=self.watermark)
+        self.messages = [FakeMessage(message_id) for message_id in range(11, 11 + SUMMARY_TRIGGER_MESSAGES + 5)]
+
+        unsummarized = mock.MagicMock()
+        unsummarized.filter.return_value = unsummarized
+        unsummarized.count.return_value = len(self.messages)
+        unsummarized.order_by.return_value.prefetch_related.return_value.__getitem__.side_effect = (
+            lambda index: self.messages[index]
+        )
+        self.conversations = mock.MagicMock()
+        self.conversations.select_related.return_value.get.return_value = self.conversation
+        self.messages_manager = mock.MagicMock()
+        self.messages_manager.filter.return_value = unsummarized
+        self.request_summary = mock.Mock(return_value='新摘要')
+
+        for target, value in (
+            ('chat.models.Conversation.objects', self.conversations),
+            ('chat.models.Message.objects', self.messages_manager),
+            ('chat.models.AIModel.objects', mock.MagicMock()),
+            ('chat.services._model_to_dict', mock.Mock(return_value={'id': 2})),
+            ('chat.summarizer._request_summary', self.request_summary),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fold_count(self):
+        return min(len(self.messages) - SUMMARY_KEEP_RECENT_MESSAGES, SUMMARY_MAX_INPUT_MESSAGES)
+
+    def test_update_is_conditional_on_watermark(self):
+        self.conversations.filter.return_value.update.return_value = 1
+        self.assertTrue(ConversationSummarizer().compact(1, 2))
+        self.conversations.filter.assert_called_once_with(id=1, summary_until=self.watermark)
+        self.conversations.filter.return_value.update.assert_called_once_with(
+            summary='新摘要', summary_until=self.messages[self.fold_count() - 1]
+        )
+        self.assertEqual(self.request_summary.call_args.args[2], '旧摘要')
+
+    def test_moved_watermark_discards_summary(self):
+        # 摘要期间水位被其他任务或删除操作改变：条件 UPDATE 不匹配任何行
+        self.conversations.filter.return_value.update.return_value = 0
+        self.assertFalse(ConversationSummarizer().compact(1, 2))
+        self.conversations.filter.assert_called_once_with(id=1, summary_until=self.watermark)
+
+    def test_below_trigger_skips_summary_request(self):
+        self.messages = self.messages[:SUMMARY_TRIGGER_MESSAGES]
+        self.messages_manager.filter.return_value.count.return_value = len(self.messages)
+        self.assertFalse(ConversationSummarizer().compact(1, 2))
+        self.request_summary.assert_not_called()
+        self.conversations.filter.assert_not_called()
@@ -0,0 +1,26 @@
+"""
+本地的近似 token 计数，用于按模型的上下文长度裁剪历史消息。
+不依赖具体模型的分词器：中日韩字符约 1 个 token/字，其余文本约 4 个字符/token。
+结果偏保守，足以在发送前判断请求是否会超出上下文窗口。
+"""
+import math
+import re
+
+# 中日韩文字、假名、谚文和全角符号
+_CJK_RE = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+# 每条消息的格式开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """估算一段文本的 token 数。"""
+    if not text:
+        return 0
+    other = len(_CJK_RE.sub('', text))
+    return (len(text) - other) + math.ceil(other / 4)
+
+
+def estimate_message_tokens(text):
+    """估算一条消息（含格式开销）的 token 数。"""
+    return estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
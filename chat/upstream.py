@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import AsyncExitStack, ExitStack, contextmanager
+
+import aiohttp
+import requests
+from async_timeout import timeout
+
+from .http_sessions import provider_sessions
+from .request_body import StreamingJSONBody
+from .scheduler import provider_scheduler
+
+logger = logging.getLogger(__name__)
+
+# --- 对冲请求配置 ---
+# 是否开启对冲：主请求在延迟时间内没有收到首个数据块时，向等价模型组中的下一个提供商发起第二个请求，
+# 保留先开始返回数据的一方。无论是否开启，连接错误、429 和 5xx 都会自动切换到等价的提供商。
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+
+# 对冲延迟取该模型最近首字节时间 (TTFT) 的哪个百分位
+try:
+    HEDGE_PERCENTILE = int(os.getenv('HEDGE_PERCENTILE', '95'))
+except (ValueError, TypeError):
+    HEDGE_PERCENTILE = 95
+
+# 样本数不足时使用的默认对冲延迟（毫秒）
+try:
+    HEDGE_DEFAULT_DELAY_MS = int(os.getenv('HEDGE_DEFAULT_DELAY_MS', '3000'))
+except (ValueError, TypeError):
+    HEDGE_DEFAULT_DELAY_MS = 3000
+
+# 对冲延迟的下限和上限（毫秒）
+try:
+    HEDGE_MIN_DELAY_MS = int(os.getenv('HEDGE_MIN_DELAY_MS', '300'))
+except (ValueError, TypeError):
+    HEDGE_MIN_DELAY_MS = 300
+
+try:
+    HEDGE_MAX_DELAY_MS = int(os.getenv('HEDGE_MAX_DELAY_MS', '15000'))
+except (ValueError, TypeError):
+    HEDGE_MAX_DELAY_MS = 15000
+
+# 计算百分位所需的最少样本数，以及每个模型保留的样本数
+HEDGE_MIN_SAMPLES = 20
+TTFT_WINDOW = 200
+
+
+class UpstreamHTTPError(Exception):
+    """上游返回了非 200 的状态码。"""
+
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status = status
+        self.body = body
+
+
+def is_retryable(error):
+    """连接错误、超时、429 和 5xx 可以切换到等价的提供商重试；其余错误（如 400/401）直接返回给用户。"""
+    if isinstance(error, UpstreamHTTPError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class TTFTTracker:
+    """按模型记录最近的首字节时间，用于计算对冲延迟。"""
+
+    def __init__(self, window=TTFT_WINDOW):
+        self._window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_id, seconds):
+        with self._lock:
+            samples = self._samples.get(model_id)
+            if samples is None:
+                samples = self._samples[model_id] = deque(maxlen=self._window)
+            samples.append(seconds)
+
+    def percentile(self, model_id, pct):
+        """返回第 pct 百分位的首字节时间（秒），样本不足时返回 None。"""
+        with self._lock:
+            samples = sorted(self._samples.get(model_id, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, max(0, round(pct / 100 * len(samples)) - 1))
+        return samples[index]
+
+    def hedge_delay(self, model_id):
+        """返回该模型的对冲延迟（秒）。"""
+        observed = self.percentile(model_id, HEDGE_PERCENTILE)
+        delay_ms = HEDGE_DEFAULT_DELAY_MS if observed is None else observed * 1000
+        return min(max(delay_ms, HEDGE_MIN_DELAY_MS), HEDGE_MAX_DELAY_MS) / 1000
+
+
+ttft_tracker = TTFTTracker()
+
+
+class UpstreamAttempt:
+    """
+    发往单个提供商的一次请求：依次获取调度名额、共享会话和响应，流式请求还会读取首个数据块。
+    所有资源由内部的 AsyncExitStack 持有，调用 aclose()（或退出 async with）时释放。
+    """
+
+    def __init__(self, model, user_key, build_request, client_timeout, on_queued=None):
+        self.model = model
+        self.user_key = user_key
+        self.build_request = build_request
+        self.client_timeout = client_timeout
+        self.on_queued = on_queued
+        self.response = None
+        self.first_chunk = None
+        self._stack = AsyncExitStack()
+
+    async def open(self, first_byte_timeout, read_first):
+        model = self.model
+        try:
+            await self._stack.enter_async_context(provider_scheduler.slot(model, self.user_key, on_queued=self.on_queued))
+            session = await self._stack.enter_async_context(
+                provider_sessions.session_for(model['provider_id'], model['provider_base_url'], model['provider_api_key'])
+            )
+            api_url, headers, request_data = self.build_request(model)
+            posted_at = time.monotonic()
+            self.response = await self._stack.enter_async_context(
+                session.post(api_url, data=StreamingJSONBody(request_data).as_aiohttp_payload(), headers=headers, timeout=self.client_timeout)
+            )
+            if self.response.status != 200:
+                raise UpstreamHTTPError(self.response.status, await self.response.text())
+            if read_first:
+                async with timeout(first_byte_timeout):
+                    self.first_chunk = await self.response.content.read(4096)
+                ttft_tracker.record(model['id'], time.monotonic() - posted_at)
+        except BaseException:
+            await self._stack.aclose()
+            raise
+        return self
+
+    async def aclose(self):
+        await self._stack.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+
+async def open_upstream(candidates, user_key, build_request, client_timeout, first_byte_timeout, is_streaming, on_queued=None):
+    """
+    向 candidates[0] 发起请求，并在需要时使用等价模型组中的其余候选：
+    - 连接错误、超时、429、5xx：自动切换到下一个候选（故障转移）。
+    - 开启对冲且为流式请求时：主请求超过对冲延迟仍未收到首个数据块，则并行向下一个候选发起请求，
+      先收到数据的一方胜出，其余请求被取消。
+    返回胜出的 UpstreamAttempt（调用方负责关闭），所有候选都失败时抛出最后一个错误。
+    """
+    remaining = list(candidates)
+    hedge = HEDGE_ENABLED and is_streaming and len(remaining) > 1
+    hedge_delay = ttft_tracker.hedge_delay(candidates[0]['id']) if hedge else None
+    running = {}
+    last_error = None
+
+    def launch():
+        model = remaining.pop(0)
+        # 只有主请求推送排队位置，避免对冲请求的排队信息干扰客户端
+        attempt = UpstreamAttempt(model, user_key, build_request, client_timeout, on_queued if model is candidates[0] else None)
+        running[asyncio.ensure_future(attempt.open(first_byte_timeout, read_first=is_streaming))] = attempt
+
+    launch()
+    try:
+        while running:
+            wait_timeout = hedge_delay if hedge and remaining else None
+            done, _pending = await asyncio.wait(running, timeout=wait_timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 对冲只进行一次
+                hedge = False
+                logger.info(f"Upstream: 模型 {candidates[0]['id']} 在 {hedge_delay:.2f} 秒内未返回首个数据块，向等价提供商 {remaining[0]['provider_id']} 发起对冲请求。")
+                launch()
+                continue
+            for task in done:
+                attempt = running.pop(task)
+                error = task.exception()
+                if error is None:
+                    if attempt.model is not candidates[0]:
+                        logger.info(f"Upstream: 请求由等价模型 {attempt.model['id']}（提供商 {attempt.model['provider_id']}）完成。")
+                    return attempt
+                last_error = error
+                logger.warning(f"Upstream: 提供商 {attempt.model['provider_id']} 的请求失败: {error!r}")
+                if is_retryable(error) and remaining and not running:
+                    logger.info(f"Upstream: 故障转移到等价提供商 {remaining[0]['provider_id']}。")
+                    launch()
+        raise last_error
+    finally:
+        # 取消并释放所有未胜出的请求
+        for task in running:
+            task.cancel()
+        if running:
+            results = await asyncio.gather(*running, return_exceptions=True)
+            for attempt, result in zip(running.values(), results):
+                if result is attempt:
+                    await attempt.aclose()
+
+
+@contextmanager
+def open_upstream_sync(candidates, user_key, build_request, request_timeout, on_queued=None, should_abort=None):
+    """
+    open_upstream 的同步版本（仅故障转移，不做对冲），供 HTTP 回退路径的工作线程使用。
+    产出已确认状态为 200 的流式 requests 响应。
+    """
+    last_error = None
+    for model in candidates:
+        stack = ExitStack()
+        try:
+            stack.enter_context(provider_scheduler.slot_sync(
+                model, user_key, on_queued=on_queued if model is candidates[0] else None, should_abort=should_abort
+            ))
+            api_url, headers, request_data = build_request(model)
+            response = stack.enter_context(requests.post(
+                api_url, data=StreamingJSONBody(request_data), headers=headers, stream=True, timeout=request_timeout
+            ))
+            response.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            stack.close()
+            status = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None else None
+            if status is not None and status < 500 and status != 429:
+                raise
+            last_error = e
+            logger.warning(f"Upstream: 提供商 {model['provider_id']} 的请求失败: {e!r}，尝试等价提供商。")
+            continue
+        except BaseException:
+            stack.close()
+            raise
+        with stack:
+            yield response
+        return
+    raise last_error
@@ -17,6 +17,7 @@ urlpatterns = [
     path('api/sync_conversation/', user_api.sync_conversation_api, name='api-sync-conversation'),
     path('api/http_chat/', user_api.http_chat_view, name='api_http_chat'),
     path('api/stop_generation/', user_api.stop_generation_api, name='api-stop-generation'),
+    path('api/generation_events/', user_api.generation_events_api, name='api-generation-events'),
     # API接口 - Admin/Management
     path('api/models/', admin_api.get_models_api, name='api-models'),
     path('api/providers/', admin_api.manage_providers_api, name='api-providers'),
@@ -28,6 +29,7 @@ urlpatterns = [
     path('api/admin/set_admin_status/', admin_api.set_admin_status, name='api-admin-set-admin-status'),
     path('api/admin/delete_user/', admin_api.delete_user_api, name='api-admin-delete-user'), # 新增：删除用户
     path('api/debug_response/', admin_api.debug_api_response, name='api-debug-response'),
+    path('api/admin/runtime_stats/', admin_api.runtime_stats_api, name='api-admin-runtime-stats'),
 
     # WebSocket测试（保留）
     path('test_ws/', pages.ws_test, name='ws-test'), # Moved to pages.py
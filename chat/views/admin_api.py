@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 import requests
 import traceback
 
@@ -13,6 +14,8 @@ from django.utils import timezone # Added import
 from datetime import timedelta # Added import
 
 from chat.models import AIProvider, AIModel
+from chat.completion_cache import completion_cache
+from chat.http_sessions import provider_sessions
 from chat.utils import ensure_valid_api_url # Import from local utils
 from .decorators import admin_required # Import from local decorators
 from users.models import UserProfile # Assuming UserProfile is in users.models
@@ -60,6 +63,10 @@ def get_models_api(request):
                         'max_history_messages': model.max_history_messages,
                         'is_active': model.is_active,
                         'default_params': model.default_params, # Include default params
+                        'max_concurrent_requests': model.max_concurrent_requests,
+                        'equivalence_group': model.equivalence_group,
+                        'response_cache_enabled': model.response_cache_enabled,
+                        'summary_model_id': model.summary_model_id,
                     }]
                 })
             except Exception as e:
@@ -89,8 +96,19 @@ def get_models_api(request):
                 'max_history_messages': model.max_history_messages,
                 'is_active': model.is_active, # Include active status
                 'default_params': model.default_params, # Include default params
+                'max_concurrent_requests': model.max_concurrent_requests,
+                'equivalence_group': model.equivalence_group,
+                'response_cache_enabled': model.response_cache_enabled,
+                'summary_model_id': model.summary_model_id,
             })
 
+        if is_admin:
+            # 管理员可以看到各模型回复缓存的命中统计
+            cache_stats = completion_cache.stats([item['id'] for item in models_data])
+            for item in models_data:
+                item['response_cache_hits'] = cache_stats[item['id']]['hits']
+                item['response_cache_misses'] = cache_stats[item['id']]['misses']
+
         return JsonResponse({'models': models_data})
 
     # --- 以下操作需要管理员权限 ---
@@ -130,7 +148,11 @@ def add_model(request):
             max_context=data.get('max_context', 4096),
             max_history_messages=data.get('max_history_messages', 10),
             is_active=data.get('is_active', True),
-            default_params=data.get('default_params', {}) # Add default params
+            default_params=data.get('default_params', {}), # Add default params
+            max_concurrent_requests=data.get('max_concurrent_requests', 0),
+            equivalence_group=data.get('equivalence_group', ''),
+            response_cache_enabled=data.get('response_cache_enabled', False),
+            summary_model_id=data.get('summary_model_id') or None
         )
 
         return JsonResponse({
@@ -173,6 +195,14 @@ def update_model(request):
             model.is_active = data['is_active']
         if 'default_params' in data: # Add default params update
             model.default_params = data['default_params']
+        if 'max_concurrent_requests' in data:
+            model.max_concurrent_requests = data['max_concurrent_requests']
+        if 'equivalence_group' in data:
+            model.equivalence_group = data['equivalence_group'] or ''
+        if 'response_cache_enabled' in data:
+            model.response_cache_enabled = data['response_cache_enabled']
+        if 'summary_model_id' in data:
+            model.summary_model_id = data['summary_model_id'] or None
 
 
         model.save()
@@ -240,6 +270,8 @@ def manage_providers_api(request):
                 'name': provider.name,
                 'base_url': provider.base_url,
                 'is_active': provider.is_active,
+                'max_concurrent_requests': provider.max_concurrent_requests,
+                'max_queued_requests': provider.max_queued_requests,
                 'created_at': provider.created_at,
                 # Do NOT return api_key here for security
             })
@@ -258,7 +290,9 @@ def manage_providers_api(request):
                 name=data['name'],
                 base_url=data['base_url'],
                 api_key=data['api_key'],
-                is_active=data.get('is_active', True)
+                is_active=data.get('is_active', True),
+                max_concurrent_requests=data.get('max_concurrent_requests', 0),
+                max_queued_requests=data.get('max_queued_requests', 100)
             )
 
             return JsonResponse({
@@ -294,8 +328,14 @@ def manage_providers_api(request):
                 provider.api_key = data['api_key']
             if 'is_active' in data:
                 provider.is_active = data['is_active']
+            if 'max_concurrent_requests' in data:
+                provider.max_concurrent_requests = data['max_concurrent_requests']
+            if 'max_queued_requests' in data:
+                provider.max_queued_requests = data['max_queued_requests']
 
             provider.save()
+            # 本 worker 的共享 HTTP 会话按新配置重建
+            provider_sessions.invalidate(provider.id)
 
             return JsonResponse({
                 'success': True,
@@ -325,7 +365,9 @@ def manage_providers_api(request):
 
             provider = get_object_or_404(AIProvider, id=provider_id)
             provider_name = provider.name
+            deleted_id = provider.id
             provider.delete()
+            provider_sessions.invalidate(deleted_id)
 
             return JsonResponse({
                 'success': True,
@@ -995,3 +1037,27 @@ def debug_api_response(request):
             'success': False,
             'message': f"处理请求失败: {str(e)}"
         }, status=500)
+
+
+@admin_required
+@require_http_methods(["GET"])
+def runtime_stats_api(request):
+    """返回当前 worker 的运行时统计（调度队列和各级缓存），用于观察缓存命中率和内存占用 (管理员)"""
+    from chat.context_cache import context_cache
+    from chat.event_dispatch import event_dispatcher
+    from chat.generation_manager import generation_manager
+    from chat.heartbeat import stop_heartbeat
+    from chat.image_cache import image_data_url_cache
+    from chat.scheduler import provider_scheduler
+    from chat.state_utils import stop_request_manager
+    return JsonResponse({
+        'success': True,
+        'pid': os.getpid(),
+        'active_generations': generation_manager.active_count(),
+        'provider_scheduler': provider_scheduler.stats(),
+        'context_cache': context_cache.stats(),
+        'image_data_url_cache': image_data_url_cache.stats(),
+        'stop_requests': stop_request_manager.stats(),
+        'stop_heartbeat': stop_heartbeat.stats(),
+        'event_dispatch': event_dispatcher.stats(),
+    })
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import traceback
@@ -60,16 +61,21 @@ def conversations_api(request):
             if conversation_id:
                 # 更新现有对话
                 conversation = get_object_or_404(Conversation, id=conversation_id, user=request.user)
+                update_fields = ['updated_at']
                 if 'title' in data:
                     conversation.title = data['title']
+                    update_fields.append('title')
                 if 'selected_model_id' in data:
                     model = get_object_or_404(AIModel, id=data['selected_model_id'])
                     conversation.selected_model = model
+                    update_fields.append('selected_model')
                 # 持久化更新系统提示词
                 if 'system_prompt' in data:
                     conversation.system_prompt = data.get('system_prompt') or ''
+                    update_fields.append('system_prompt')
 
-                conversation.save()
+                # 只写入修改过的字段，避免覆盖后台摘要任务写入的 summary / summary_until
+                conversation.save(update_fields=update_fields)
 
                 return JsonResponse({
                     'success': True,
@@ -386,10 +392,48 @@ def sync_conversation_api(request):
 
 
 from django.http import StreamingHttpResponse
-from chat.services import generate_ai_response_for_http
-from chat.state_utils import set_stop_requested_sync
+from chat.services import capture_event_loop, run_http_generation
+from chat.cancellation import cancellation_registry
+from chat.event_log import find_gap, generation_event_log, EVENT_LOG_TTL
+from chat.generation_manager import generation_manager
+from chat.generation_registry import generation_registry
+from chat.image_pipeline import ImageValidationError, validate_image_upload
 import uuid
 
+# 续传接口在没有新事件时发送心跳注释的间隔（秒）
+EVENT_STREAM_KEEPALIVE = 15
+
+
+def _format_sse_event(event_type, data):
+    """格式化 SSE 事件；带序号的事件附加 id 行，以便客户端凭 Last-Event-ID 续传。"""
+    event_id = f"id: {data['seq']}\n" if 'seq' in data else ''
+    return f"{event_id}event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _tail_generation_events(generation_id, last_seq=0):
+    """
+    从事件日志中读取 last_seq 之后的事件并持续推送，直到 generation_end 或长时间没有新事件。
+    必须是异步生成器：ASGI 下 Django 4.2 会把同步迭代器一次性读完（sync_to_async(list)）再发送，整个流会被缓冲。
+    """
+    cursor = last_seq
+    idle_seconds = 0
+    while idle_seconds < EVENT_LOG_TTL:
+        events = await generation_event_log.await_for_events(generation_id, cursor, EVENT_STREAM_KEEPALIVE)
+        if not events:
+            idle_seconds += EVENT_STREAM_KEEPALIVE
+            yield ": keep-alive\n\n"
+            continue
+        idle_seconds = 0
+        gap = find_gap(generation_id, cursor, events)
+        if gap is not None:
+            logger.warning(f"HTTP event stream: Events after seq {cursor} of GenID {generation_id} were trimmed from the log.")
+            yield _format_sse_event(gap['type'], gap['data'])
+        for event in events:
+            cursor = event['data']['seq']
+            yield _format_sse_event(event['type'], event['data'])
+            if event['type'] == 'generation_end':
+                return
+
 
 @login_required
 @csrf_exempt
@@ -408,8 +452,8 @@ def stop_generation_api(request):
 
         logger.info(f"HTTP stop_generation_api: 收到终止生成请求，GenID: {generation_id}")
         
-        # 使用与WebSocket相同的状态管理功能来请求停止
-        set_stop_requested_sync(generation_id)
+        # 与WebSocket相同：发布一次停止请求，由拥有该生成任务的 worker 处理
+        cancellation_registry.request_stop_sync(generation_id)
 
         return JsonResponse({'success': True, 'message': '已发送停止请求。'})
 
@@ -439,6 +483,11 @@ def http_chat_view(request):
             file = request.FILES.get('file')
             if not file:
                 return HttpResponseBadRequest("Missing file in multipart/form-data request")
+            # 在读取和解码之前校验图片的类型和大小
+            try:
+                validate_image_upload(file.name, file.content_type, file.size)
+            except ImageValidationError as e:
+                return HttpResponseBadRequest(str(e))
         else:
             data = json.loads(request.body)
             file = None
@@ -465,6 +514,7 @@ def http_chat_view(request):
                 # 可选的安全校验：会话一致性
                 if conversation_id and str(user_message.conversation_id) != str(conversation_id):
                     return HttpResponseBadRequest("会话ID与目标消息不匹配。")
+                conversation_id = conversation_id or user_message.conversation_id
                 user_message_id = user_message.id
             except Exception:
                 return HttpResponseBadRequest("要重新生成的用户消息不存在或参数无效。")
@@ -489,7 +539,6 @@ def http_chat_view(request):
             'user_message_id': user_message_id,
             'is_regenerate': is_regenerate,
             'generation_id': generation_id,
-            'is_streaming': is_streaming,
         }
         if is_image_upload and file:
             service_kwargs.update({
@@ -499,9 +548,12 @@ def http_chat_view(request):
 
         # --- 4. 根据流式或非流式返回响应 ---
         if is_streaming:
-            event_generator = generate_ai_response_for_http(**service_kwargs)
+            # 生成任务在后台线程中运行并写入事件日志，响应只是日志的一个订阅者：
+            # 客户端断开不会丢弃已生成的内容，之后也可以通过 generation_events_api 重新接入
+            # 工作线程中的事件交给本 worker 的事件循环广播，复用其 channel layer 连接
+            generation_manager.submit(generation_id, run_http_generation, event_loop=capture_event_loop(), **service_kwargs)
 
-            def sse_stream_wrapper(generator):
+            async def sse_stream_wrapper():
                 # 在开始推送AI流之前，先把用户消息ID映射通知给前端（与WS逻辑对齐）
                 if not is_regenerate and user_message_id:
                     try:
@@ -509,82 +561,33 @@ def http_chat_view(request):
                         yield f"event: user_message_id_update\ndata: {json.dumps(user_id_update)}\n\n"
                     except Exception:
                         pass
-                final_event_data = None
-                for event in generator:
-                    if event['type'] == 'generation_end':
-                        final_event_data = event['data']
-                        break
-                    sse_event = f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
-                    yield sse_event
-
-                if not final_event_data:
-                    final_event_data = {'status': 'failed', 'error': 'Stream ended unexpectedly.', 'generation_id': generation_id}
-
-                status = final_event_data.get('status')
-                if status == 'completed':
-                    try:
-                        full_content = final_event_data.get('full_content', '')
-                        conversation = get_object_or_404(Conversation, id=conversation_id)
-                        model = get_object_or_404(AIModel, id=model_id)
-                        if is_regenerate:
-                            user_message = get_object_or_404(Message, id=user_message_id)
-                            Message.objects.filter(conversation_id=conversation_id, is_user=False, timestamp__gt=user_message.timestamp).delete()
-                        
-                        ai_message = Message.objects.create(
-                            conversation=conversation, content=full_content, is_user=False, model_used=model, generation_id=generation_id
-                        )
-                        conversation.save()
-
-                        id_update_data = {'generation_id': generation_id, 'message_id': ai_message.id, 'temp_id': generation_id}
-                        yield f"event: id_update\ndata: {json.dumps(id_update_data)}\n\n"
-                        
-                        end_event_data = {'status': 'completed', 'generation_id': generation_id}
-                        yield f"event: generation_end\ndata: {json.dumps(end_event_data)}\n\n"
-                        logger.info(f"HTTP Service: Stream for GenID {generation_id} finished and saved with status: completed")
-                    except Exception as db_error:
-                        logger.error(f"Error during DB ops for GenID {generation_id}: {db_error}", exc_info=True)
-                        error_end_data = {'status': 'failed', 'error': f'数据库操作失败: {db_error}', 'generation_id': generation_id}
-                        yield f"event: generation_end\ndata: {json.dumps(error_end_data)}\n\n"
-                else:
-                    yield f"event: generation_end\ndata: {json.dumps(final_event_data)}\n\n"
-                    logger.info(f"HTTP Service: Stream for GenID {generation_id} finished with status: {status}")
-
-            response = StreamingHttpResponse(sse_stream_wrapper(event_generator), content_type='text/event-stream')
+                try:
+                    async for chunk in _tail_generation_events(generation_id):
+                        yield chunk
+                except (asyncio.CancelledError, GeneratorExit):
+                    # 客户端断开：CancelOnDisconnectMiddleware 取消请求任务，或 Django 关闭生成器
+                    await generation_manager.detach([generation_id])
+                    raise
+
+            response = StreamingHttpResponse(sse_stream_wrapper(), content_type='text/event-stream')
             response['Cache-Control'] = 'no-cache'
             return response
         else:
-            # --- 非流式响应处理 ---
-            result = generate_ai_response_for_http(**service_kwargs)
+            # --- 非流式响应处理：在当前请求线程中完成生成和保存 ---
+            result = run_http_generation(**service_kwargs)
             status = result.get('status')
 
             logger.info(f"HTTP Service: Non-stream for GenID {generation_id} finished with status: {status}")
 
             if status == 'completed':
-                try:
-                    full_content = result.get('content', '')
-                    conversation = get_object_or_404(Conversation, id=conversation_id)
-                    model = get_object_or_404(AIModel, id=model_id)
-
-                    if is_regenerate:
-                        user_message = get_object_or_404(Message, id=user_message_id)
-                        Message.objects.filter(conversation_id=conversation_id, is_user=False, timestamp__gt=user_message.timestamp).delete()
-
-                    ai_message = Message.objects.create(
-                        conversation=conversation, content=full_content, is_user=False, model_used=model, generation_id=generation_id
-                    )
-                    conversation.save()
-                    
-                    return JsonResponse({
-                        'success': True,
-                        'content': full_content,
-                        'message_id': ai_message.id,
-                        'generation_id': generation_id,
-                        'user_message_id': user_message_id,
-                    })
-                except Exception as db_error:
-                    logger.error(f"Error during DB ops for non-stream GenID {generation_id}: {db_error}", exc_info=True)
-                    return JsonResponse({'success': False, 'error': f'数据库操作失败: {db_error}', 'generation_id': generation_id}, status=500)
-            
+                return JsonResponse({
+                    'success': True,
+                    'content': result['content'],
+                    'message_id': result['message_id'],
+                    'generation_id': generation_id,
+                    'user_message_id': user_message_id,
+                })
+
             elif status == 'cancelled':
                 return JsonResponse({
                     'success': True, # 请求本身是成功的
@@ -596,7 +599,7 @@ def http_chat_view(request):
             else: # failed 或其他状态
                 return JsonResponse({
                     'success': False,
-                    'error': result.get('error', '未知错误'),
+                    'error': result.get('error') or '未知错误',
                     'generation_id': generation_id,
                 }, status=500)
 
@@ -605,3 +608,33 @@ def http_chat_view(request):
     except Exception as e:
         logger.error(f"HTTP chat view error: {e}", exc_info=True)
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@login_required
+@require_http_methods(["GET"])
+def generation_events_api(request):
+    """
+    以 SSE 形式重放并继续推送某个生成任务的事件，用于断线续传或接入进行中的生成。
+    参数: generation_id（或 conversation_id，接入该会话当前正在进行的生成），
+    以及 last_seq（或标准的 Last-Event-ID 请求头）。
+    """
+    generation_id = request.GET.get('generation_id')
+    conversation_id = request.GET.get('conversation_id')
+    if not generation_id and conversation_id:
+        conversation = get_object_or_404(Conversation, id=conversation_id, user=request.user)
+        generation_id = generation_registry.current_generation_id(conversation.id)
+    if not generation_id:
+        return HttpResponseBadRequest("Missing generation_id")
+    try:
+        last_seq = int(request.GET.get('last_seq') or request.headers.get('Last-Event-ID') or 0)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid last_seq")
+
+    conversation_id = generation_event_log.get_conversation_id(generation_id)
+    if not conversation_id or not Conversation.objects.filter(id=conversation_id, user=request.user).exists():
+        return JsonResponse({'success': False, 'message': '生成任务不存在或已过期。'}, status=404)
+
+    logger.info(f"HTTP generation_events_api: Resuming GenID {generation_id} after seq {last_seq}")
+    response = StreamingHttpResponse(_tail_generation_events(generation_id, last_seq), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
@@ -16,16 +16,22 @@ django.setup()  # 确保Django完全初始化
 
 # 在Django初始化之后导入
 from django.core.asgi import get_asgi_application
+from django.urls import reverse
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import chat.routing  # 在Django初始化后导入
+from chat.disconnect import CancelOnDisconnectMiddleware
+from chat.lifespan import lifespan_app
+
+GENERATION_STREAM_PATHS = [reverse('api_http_chat'), reverse('api-generation-events')]
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    # 客户端断开时取消流式响应（只对生成相关的 SSE 接口生效）
+    "http": CancelOnDisconnectMiddleware(get_asgi_application(), paths=GENERATION_STREAM_PATHS),
     "websocket": AuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
         )
     ),
-    "lifespan": get_asgi_application(),  # 添加这行来处理lifespan协议
+    "lifespan": lifespan_app,  # 在 worker 启停时管理共享 HTTP 会话等进程级资源
 })
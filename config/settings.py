@@ -191,8 +191,21 @@ ASGI_APPLICATION = 'config.asgi.application'
 # Use a single environment variable to control the backend for both Cache and Channels.
 # - 'redis': Use Redis for production (requires Redis server).
 # - 'memory': Use in-memory backend for local development.
+# - 'shm': Like 'memory' for Cache and Channels, but stop requests are shared between the
+#   workers on one host through a memory-mapped table (see chat.state_utils.SharedMemoryCache).
 BACKEND_TYPE = os.getenv('CACHE_TYPE', 'memory').lower()
 
+# Completion cache (chat.completion_cache): exact-match replies for opted-in models.
+# Stored in its own cache alias so that its TTL and entry limit do not affect the default cache.
+try:
+    COMPLETION_CACHE_TTL = int(os.getenv('COMPLETION_CACHE_TTL', '3600'))
+except (ValueError, TypeError):
+    COMPLETION_CACHE_TTL = 3600
+try:
+    COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv('COMPLETION_CACHE_MAX_ENTRIES', '1000'))
+except (ValueError, TypeError):
+    COMPLETION_CACHE_MAX_ENTRIES = 1000
+
 if BACKEND_TYPE == 'redis':
     # When using Redis, default the host to 'localhost'.
     # This allows local development without setting REDIS_HOST in .env.
@@ -209,7 +222,18 @@ if BACKEND_TYPE == 'redis':
             "OPTIONS": {
                 "CLIENT_CLASS": "django_redis.client.DefaultClient",
             }
-        }
+        },
+        # Redis has no entry limit of its own: chat.completion_cache keeps an index of the stored
+        # replies and deletes the oldest ones beyond COMPLETION_CACHE_MAX_ENTRIES.
+        "completions": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB_CACHE}",
+            "KEY_PREFIX": "completion",
+            "TIMEOUT": COMPLETION_CACHE_TTL,
+            "OPTIONS": {
+                "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            }
+        },
     }
 
     # --- Channels Layer Configuration ---
@@ -229,7 +253,15 @@ else: # 'memory' or any other value
         'default': {
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
             'LOCATION': 'unique-snowflake',
-        }
+        },
+        'completions': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'completion-cache',
+            'TIMEOUT': COMPLETION_CACHE_TTL,
+            'OPTIONS': {
+                'MAX_ENTRIES': COMPLETION_CACHE_MAX_ENTRIES,
+            },
+        },
     }
     
     # --- Channels Layer Configuration (In-Memory) ---
@@ -264,6 +264,8 @@ document.addEventListener('DOMContentLoaded', () => {
         const providerUrlInput = document.getElementById('provider-url');
         const providerKeyInput = document.getElementById('provider-key');
         const providerActiveInput = document.getElementById('provider-active');
+        const providerMaxConcurrentInput = document.getElementById('provider-max-concurrent');
+        const providerMaxQueuedInput = document.getElementById('provider-max-queued');
         const saveProviderBtn = document.getElementById('save-provider-btn');
         const providerList = document.getElementById('provider-list');
 
@@ -273,6 +275,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (providerIdInput) providerIdInput.value = '';
                 if (providerForm) providerForm.reset();
                 if (providerActiveInput) providerActiveInput.checked = true; // Default to active
+                if (providerMaxConcurrentInput) providerMaxConcurrentInput.value = 0;
+                if (providerMaxQueuedInput) providerMaxQueuedInput.value = 100;
                 providerModal.show();
             });
         }
@@ -293,6 +297,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
                 const method = providerId ? 'PUT' : 'POST';
                 const data = { name, base_url: baseUrl, is_active: isActive };
+                if (providerMaxConcurrentInput) data.max_concurrent_requests = parseInt(providerMaxConcurrentInput.value, 10) || 0;
+                if (providerMaxQueuedInput) data.max_queued_requests = parseInt(providerMaxQueuedInput.value, 10) || 0;
                 if (providerId) data.id = providerId;
                 // Only include API key if adding or if it's provided during edit
                 if (!providerId || apiKey) data.api_key = apiKey;
@@ -371,6 +377,8 @@ document.addEventListener('DOMContentLoaded', () => {
                     if (providerKeyInput) providerKeyInput.value = ''; // Clear key field for editing
                     if (providerKeyInput) providerKeyInput.placeholder = '如需更新，请输入新密钥';
                     if (providerActiveInput) providerActiveInput.checked = isActive;
+                    if (providerMaxConcurrentInput) providerMaxConcurrentInput.value = providerItem.dataset.maxConcurrent ?? 0;
+                    if (providerMaxQueuedInput) providerMaxQueuedInput.value = providerItem.dataset.maxQueued ?? 100;
                     providerModal.show();
 
                 } else if (deleteBtn) {
@@ -617,6 +625,9 @@ document.addEventListener('DOMContentLoaded', () => {
         const modelDisplayNameInput = document.getElementById('model-display-name');
         const modelContextInput = document.getElementById('model-context');
         const modelHistoryInput = document.getElementById('model-history');
+        const modelEquivalenceGroupInput = document.getElementById('model-equivalence-group');
+        const modelResponseCacheInput = document.getElementById('model-response-cache');
+        const modelSummaryModelSelect = document.getElementById('model-summary-model');
         const modelActiveInput = document.getElementById('model-active');
         const saveModelBtn = document.getElementById('save-model-btn');
         const modelList = document.getElementById('model-list');
@@ -655,6 +666,9 @@ document.addEventListener('DOMContentLoaded', () => {
                     max_history_messages: maxHistory,
                     is_active: isActive
                 };
+                if (modelEquivalenceGroupInput) data.equivalence_group = modelEquivalenceGroupInput.value.trim();
+                if (modelResponseCacheInput) data.response_cache_enabled = modelResponseCacheInput.checked;
+                if (modelSummaryModelSelect) data.summary_model_id = modelSummaryModelSelect.value || null;
                 if (modelId) data.id = modelId;
 
                 fetch('/chat/api/models/', {
@@ -732,6 +746,9 @@ document.addEventListener('DOMContentLoaded', () => {
                              if (modelDisplayNameInput) modelDisplayNameInput.value = model.display_name;
                              if (modelContextInput) modelContextInput.value = model.max_context;
                              if (modelHistoryInput) modelHistoryInput.value = model.max_history_messages;
+                             if (modelEquivalenceGroupInput) modelEquivalenceGroupInput.value = model.equivalence_group || '';
+                             if (modelResponseCacheInput) modelResponseCacheInput.checked = !!model.response_cache_enabled;
+                             if (modelSummaryModelSelect) modelSummaryModelSelect.value = model.summary_model_id || '';
                              if (modelActiveInput) modelActiveInput.checked = model.is_active;
                              modelModal.show();
                          } else {
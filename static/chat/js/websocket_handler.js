@@ -1,12 +1,55 @@
 /* eslint-env browser */
-/* globals renderMessageContent, escapeHtml, storeConversationId, getChatSettings, displaySystemError */
+/* globals renderMessageContent, escapeHtml, storeConversationId, getChatSettings, displaySystemError, syncConversationData */
 
 let chatSocket = null;
 
+// 每个生成任务已处理的最大事件序号，用于断线续传和过滤重放的重复事件
+const generationSeqTracker = new Map();
+// 收到的事件序号不连续（事件日志已被截断，或实时事件在投递路径切换时丢失）的生成任务，结束后从数据库同步
+const generationsWithGap = new Set();
+// HTTP 流断开后尝试续传的最大次数
+const HTTP_RESUME_MAX_ATTEMPTS = 3;
+
 if (typeof window !== 'undefined') {
     window.chatSocket = null;
 }
 
+/**
+ * 检查事件是否已处理过（重连重放时可能与实时事件重叠）。
+ * @param {object} data - 事件数据，可能包含 generation_id 和 seq。
+ * @returns {boolean} - 已处理过则返回 true。
+ */
+function isDuplicateGenerationEvent(data) {
+    if (!data || !data.generation_id || typeof data.seq !== 'number') return false;
+    const lastSeq = generationSeqTracker.get(data.generation_id) || 0;
+    if (data.seq <= lastSeq) return true;
+    if (data.seq > lastSeq + 1) markGenerationGap(data.generation_id);
+    generationSeqTracker.set(data.generation_id, data.seq);
+    return false;
+}
+
+/**
+ * 标记某个生成任务错过了部分事件：流式显示的内容不完整，生成结束后从数据库同步该会话。
+ * @param {string} generationId - 生成任务ID。
+ */
+function markGenerationGap(generationId) {
+    if (!generationId || generationsWithGap.has(generationId)) return;
+    console.warn(`Missed events for generation ${generationId}; the conversation will be re-synced when it ends.`);
+    generationsWithGap.add(generationId);
+}
+
+/**
+ * 为重连构建续传游标：如果当前有进行中的生成任务，只请求错过的事件。
+ * @returns {string} - URL 查询字符串（可能为空）。
+ */
+function buildResumeQuery() {
+    const state = window.ChatStateManager.getState();
+    const generationId = state.activeGenerationId;
+    if (!generationId || !state.activeGenerationIds.has(generationId)) return '';
+    const lastSeq = generationSeqTracker.get(generationId) || 0;
+    return `?generation_id=${encodeURIComponent(generationId)}&last_seq=${lastSeq}`;
+}
+
 function getWebSocketStateText(readyState) {
     switch (readyState) {
         case WebSocket.CONNECTING: return "CONNECTING (0) - 连接中";
@@ -90,7 +133,8 @@ function initWebSocket(options = {}) {
     }
 
     const wsProtocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
-    const wsUrl = `${wsProtocol}${window.location.host}/ws/chat/${conversationIdForUrl}/`;
+    const resumeQuery = isNewConversation ? '' : buildResumeQuery();
+    const wsUrl = `${wsProtocol}${window.location.host}/ws/chat/${conversationIdForUrl}/${resumeQuery}`;
 
     if (chatSocket && chatSocket.readyState !== WebSocket.CLOSED) {
         console.log(`Closing existing WebSocket (State: ${getWebSocketStateText(chatSocket.readyState)}) before creating a new one.`);
@@ -143,6 +187,7 @@ function handleIncomingMessage(eventData) {
     const { type, data } = eventData;
     const messageContainer = document.querySelector('#message-container');
     if (!messageContainer) return;
+    if (isDuplicateGenerationEvent(data)) return;
 
     switch (type) {
         case 'new_conversation_created':
@@ -228,9 +273,18 @@ function handleIncomingMessage(eventData) {
             }
 
             window.ChatStateManager.handleGenerationEnd(generation_id, status);
+            if (generationsWithGap.delete(generation_id)) {
+                // 已显示的内容缺少部分增量，以数据库中保存的回复为准
+                syncConversationData(true).catch(error => console.error('Error re-syncing conversation after missed events:', error));
+            }
             break;
         }
 
+        case 'generation_gap':
+            // 服务器重放时发现请求的序号之后有事件已从日志中截断
+            markGenerationGap(data.generation_id);
+            break;
+
         case 'full_message': {
             const { generation_id, temp_id, content } = data;
             if (window.ChatStateManager.isGenerationCancelled(generation_id)) return;
@@ -245,6 +299,25 @@ function handleIncomingMessage(eventData) {
             break;
         }
 
+        case 'queue_position': {
+            // 上游提供商繁忙时请求在服务器端排队，在加载指示器中显示排队位置
+            const { temp_id, position } = data;
+            const loadingIndicator = document.getElementById(`ai-response-loading-${temp_id}`);
+            if (!loadingIndicator) break;
+            let queueStatus = loadingIndicator.querySelector('.queue-status');
+            if (position > 0) {
+                if (!queueStatus) {
+                    queueStatus = document.createElement('p');
+                    queueStatus.className = 'queue-status small text-muted mb-0';
+                    loadingIndicator.appendChild(queueStatus);
+                }
+                queueStatus.textContent = `服务繁忙，正在排队（第 ${position} 位）…`;
+            } else if (queueStatus) {
+                queueStatus.remove();
+            }
+            break;
+        }
+
         case 'stream_update': {
             const { generation_id, temp_id, content } = data;
             if (window.ChatStateManager.isGenerationCancelled(generation_id)) return;
@@ -380,35 +453,18 @@ async function sendHttpRequestFallback(type, payload, settings) { // settings ca
 
         const contentType = response.headers.get("content-type");
         if (contentType && contentType.indexOf("text/event-stream") !== -1) {
-            // 处理SSE流
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder();
-            let buffer = '';
-
-            while (true) {
-                const { done, value } = await reader.read();
-                if (done) break;
-                buffer += decoder.decode(value, { stream: true });
-                const events = buffer.split('\n\n');
-                buffer = events.pop();
-                for (const eventString of events) {
-                    if (!eventString.trim()) continue;
-                    const eventTypeMatch = eventString.match(/event: (.*)/);
-                    const eventDataMatch = eventString.match(/data: (.*)/);
-                    if (eventTypeMatch && eventDataMatch) {
-                        const eventType = eventTypeMatch[1];
-                        const eventData = JSON.parse(eventDataMatch[1]);
-
-                        // 关键修复：如果HTTP流事件数据中缺少temp_id，则从父函数作用域注入它
-                        if (eventType === 'stream_update' && !eventData.temp_id) {
-                            console.log(`[HTTP Fallback] Injecting missing temp_id '${tempId}' into stream_update event.`);
-                            eventData.temp_id = tempId;
-                        }
-
-                        const eventPayload = { type: eventType, data: eventData };
-                        handleIncomingMessage(eventPayload);
-                    }
-                }
+            // 处理SSE流；如果连接中途断开，凭最后的事件序号续传
+            let ended = false;
+            try {
+                ended = await readSseEvents(response, tempId);
+            } catch (streamError) {
+                console.warn('[HTTP Fallback] SSE stream interrupted:', streamError);
+            }
+            for (let attempt = 1; !ended && attempt <= HTTP_RESUME_MAX_ATTEMPTS; attempt++) {
+                ended = await resumeHttpGenerationStream(payload.generation_id, tempId, attempt);
+            }
+            if (!ended) {
+                throw new Error('流式连接中断且无法续传');
             }
         } else {
             // 处理JSON响应
@@ -442,6 +498,64 @@ async function sendHttpRequestFallback(type, payload, settings) { // settings ca
     }
 }
 
+/**
+ * 读取 SSE 响应体并分发事件。
+ * @returns {Promise<boolean>} - 是否收到了 generation_end 事件。
+ */
+async function readSseEvents(response, tempId) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let ended = false;
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const eventString of events) {
+            if (!eventString.trim()) continue;
+            const eventTypeMatch = eventString.match(/event: (.*)/);
+            const eventDataMatch = eventString.match(/data: (.*)/);
+            if (eventTypeMatch && eventDataMatch) {
+                const eventType = eventTypeMatch[1];
+                const eventData = JSON.parse(eventDataMatch[1]);
+
+                // 关键修复：如果HTTP流事件数据中缺少temp_id，则从父函数作用域注入它
+                if (eventType === 'stream_update' && !eventData.temp_id) {
+                    console.log(`[HTTP Fallback] Injecting missing temp_id '${tempId}' into stream_update event.`);
+                    eventData.temp_id = tempId;
+                }
+
+                const eventPayload = { type: eventType, data: eventData };
+                handleIncomingMessage(eventPayload);
+                if (eventType === 'generation_end') ended = true;
+            }
+        }
+    }
+    return ended;
+}
+
+/**
+ * 在 HTTP 流断开后，从最后收到的事件序号处续传。
+ * @returns {Promise<boolean>} - 是否收到了 generation_end 事件。
+ */
+async function resumeHttpGenerationStream(generationId, tempId, attempt) {
+    if (!generationId) return false;
+    const lastSeq = generationSeqTracker.get(generationId) || 0;
+    console.log(`[HTTP Fallback] Resuming generation ${generationId} after seq ${lastSeq} (attempt ${attempt}).`);
+    await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+    try {
+        const response = await fetch(`/chat/api/generation_events/?generation_id=${encodeURIComponent(generationId)}&last_seq=${lastSeq}`);
+        if (!response.ok) return false;
+        return await readSseEvents(response, tempId);
+    } catch (error) {
+        console.warn('[HTTP Fallback] Resume attempt failed:', error);
+        return false;
+    }
+}
+
 function getCookie(name) {
     let cookieValue = null;
     if (document.cookie && document.cookie !== '') {